@@ -1,24 +1,45 @@
 import os
 import sys
 import time
-import tweepy
 import json
 import requests
 from requests_oauthlib import OAuth1
-from flask import Flask, render_template, request, flash, redirect, url_for, jsonify
+from flask import Flask, Request, render_template, request, flash, redirect, url_for, jsonify
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
 import logging
 from logging.handlers import RotatingFileHandler
 import sqlite3
 import random
 from cryptography.fernet import Fernet
 import threading
+import queue
+import mmap
+import uuid
+import socket
+import urllib.parse
+import heapq
+import bisect
+import itertools
+import contextlib
+from collections import deque
 from datetime import datetime, timedelta
 from requests.exceptions import RequestException
+from requests.adapters import HTTPAdapter
 from moviepy.editor import VideoFileClip
+from moviepy.config import get_setting
 import tempfile
+import hashlib
+import struct
+import math
+import re
+import shutil
+import subprocess
+import multiprocessing
+import atexit
+import asyncio
+import aiohttp
+from concurrent.futures import Future, CancelledError, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError, InvalidStateError
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
@@ -44,6 +65,7 @@ app.logger.info("アプリケーションの初期化を開始")
 # アップロードされたファイルの保存先
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'mp4', 'mov', 'avi'}
+CONTAINER_PROBE_EXTENSIONS = {'mp4', 'mov'}  # ffprobeがなくても中身を読める形式
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
@@ -52,6 +74,96 @@ if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
     app.logger.info(f"アップロードフォルダを作成しました: {UPLOAD_FOLDER}")
 
+class HashingUploadFile:
+    # 受信中のファイルをアップロードフォルダの一時ファイルへ直接書き込みながらSHA-256を計算する
+    def __init__(self, directory):
+        fd, self.name = tempfile.mkstemp(prefix='.ingest_', dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self.sha256 = hashlib.sha256()
+        self.persisted = False
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def close(self):
+        # リクエストの終了時に呼ばれる。保存先に移していない一時ファイルは削除する
+        if not self.file.closed:
+            self.file.close()
+        if not self.persisted and os.path.exists(self.name):
+            os.remove(self.name)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class IngestRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingUploadFile(UPLOAD_FOLDER)
+
+app.request_class = IngestRequest
+
+class StagedUpload:
+    # 内容のハッシュをファイル名にして保存する。同じ内容のファイルは1つだけ置く
+    def __init__(self, file):
+        stream = file.stream
+        if not isinstance(stream, HashingUploadFile):
+            stream = HashingUploadFile(UPLOAD_FOLDER)
+            for block in iter(lambda: file.stream.read(1024 * 1024), b''):
+                stream.write(block)
+        stream.flush()
+        self.stream = stream
+        self.content_hash = stream.hexdigest()
+        self.original_filename = os.path.basename(file.filename.replace('\\', '/'))
+        self.filename = f"{self.content_hash}.{file.filename.rsplit('.', 1)[1].lower()}"
+        self.path = os.path.join(UPLOAD_FOLDER, self.filename)
+        self.temp_path = stream.name
+
+    def commit(self):
+        # DBに行を追加した後に呼ぶ。行より先にファイルを置くと、参照を数えて削除する処理と競合する
+        if os.path.exists(self.path):
+            app.logger.info(f"同じ内容の動画ファイルを再利用します: {self.path} ({self.original_filename})")
+        else:
+            self.stream.file.close()
+            os.replace(self.stream.name, self.path)
+            self.stream.persisted = True
+            app.logger.info(f"ファイルをアップロードしました: {self.path} ({self.original_filename})")
+        self.stream.close()
+
+    def discard(self):
+        self.stream.close()
+
+def remove_video_row(post_id):
+    # ファイルを保存できなかった投稿の行を取り消す
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.execute("DELETE FROM videos WHERE id = ?", (post_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    content_selector.remove(post_id)
+
+def release_upload(filename):
+    # 参照しているvideosの行がなくなったファイルだけを削除する
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        # 同じファイルを参照する行の追加と競合しないよう、書き込みロックを取ってから数える
+        if not conn.in_transaction:
+            c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT COUNT(*) FROM videos WHERE filename = ?", (filename,))
+        if c.fetchone()[0] == 0:
+            filepath = os.path.join(UPLOAD_FOLDER, filename)
+            if os.path.exists(filepath):
+                os.remove(filepath)
+                app.logger.info(f"動画ファイルを削除しました: {filepath}")
+        conn.commit()
+    finally:
+        conn.close()
+
 # 暗号化キーの生成（実際の運用では安全に管理する必要があります）
 ENCRYPTION_KEY = Fernet.generate_key()
 cipher_suite = Fernet(ENCRYPTION_KEY)
@@ -62,8 +174,59 @@ def encrypt_data(data):
 def decrypt_data(encrypted_data):
     return cipher_suite.decrypt(encrypted_data.encode()).decode()
 
+# SQLiteの接続管理（WAL・スレッドごとの接続の再利用・読み取り専用接続の分離）
+DATABASE = 'videos.db'
+DB_BUSY_TIMEOUT_MS = 10000
+DB_CACHED_STATEMENTS = 256
+db_local = threading.local()
+
+class PooledConnection:
+    # close()では実際には閉じず、未コミットの変更を破棄してスレッドに返却する
+    def __init__(self, holder):
+        self._holder = holder
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._holder['conn'], name)
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._holder['depth'] -= 1
+        conn = self._holder['conn']
+        if self._holder['depth'] == 0 and conn.in_transaction:
+            conn.rollback()
+
+def open_db_connection(read_only=False):
+    conn = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT_MS / 1000, cached_statements=DB_CACHED_STATEMENTS)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    if read_only:
+        # ダッシュボード用の読み取りは別接続にし、書き込み側のトランザクションと混ざらないようにする
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+def _checkout_db(name, read_only):
+    holder = getattr(db_local, name, None)
+    # fork後の子プロセスでは親の接続を使わない
+    if holder is None or holder['pid'] != os.getpid():
+        holder = {'conn': open_db_connection(read_only), 'pid': os.getpid(), 'depth': 0}
+        setattr(db_local, name, holder)
+    if holder['depth'] == 0 and holder['conn'].in_transaction:
+        holder['conn'].rollback()
+    holder['depth'] += 1
+    return PooledConnection(holder)
+
+def get_db():
+    return _checkout_db('write_holder', False)
+
+def get_read_db():
+    return _checkout_db('read_holder', True)
+
 def init_db():
-    conn = sqlite3.connect('videos.db')
+    conn = get_db()
     c = conn.cursor()
     
     # videosテーブルが存在しない場合は作成
@@ -80,6 +243,32 @@ def init_db():
         c.execute("ALTER TABLE videos ADD COLUMN start_time INTEGER")
     if 'end_time' not in columns:
         c.execute("ALTER TABLE videos ADD COLUMN end_time INTEGER")
+    # 取り込み時の事前変換の結果を保存するカラム
+    if 'processed_path' not in columns:
+        c.execute("ALTER TABLE videos ADD COLUMN processed_path TEXT")
+    if 'processing_status' not in columns:
+        c.execute("ALTER TABLE videos ADD COLUMN processing_status TEXT")
+    if 'processing_method' not in columns:
+        c.execute("ALTER TABLE videos ADD COLUMN processing_method TEXT")
+    if 'processing_error' not in columns:
+        c.execute("ALTER TABLE videos ADD COLUMN processing_error TEXT")
+    if 'processing_updated_at' not in columns:
+        c.execute("ALTER TABLE videos ADD COLUMN processing_updated_at INTEGER")
+    # 投稿内容の選択で使う重み（大きいほどローテーション内で多く選ばれる）
+    if 'weight' not in columns:
+        c.execute("ALTER TABLE videos ADD COLUMN weight INTEGER NOT NULL DEFAULT 1")
+    # 取り込み時に計算した内容のハッシュと、アップロード時の元のファイル名
+    if 'content_hash' not in columns:
+        c.execute("ALTER TABLE videos ADD COLUMN content_hash TEXT")
+    if 'original_filename' not in columns:
+        c.execute("ALTER TABLE videos ADD COLUMN original_filename TEXT")
+    # 同じファイルを参照している行を数えるための索引
+    c.execute("CREATE INDEX IF NOT EXISTS idx_videos_filename ON videos (filename)")
+    # 取り込み時にコンテナから読み取ったメタデータ
+    for column, column_type in (('duration', 'REAL'), ('video_codec', 'TEXT'), ('audio_codec', 'TEXT'), ('width', 'INTEGER'),
+                                ('height', 'INTEGER'), ('bitrate', 'INTEGER'), ('file_size', 'INTEGER')):
+        if column not in columns:
+            c.execute(f"ALTER TABLE videos ADD COLUMN {column} {column_type}")
     
     c.execute('''CREATE TABLE IF NOT EXISTS twitter_accounts
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -89,13 +278,132 @@ def init_db():
                   access_token TEXT NOT NULL,
                   access_token_secret TEXT NOT NULL,
                   post_flag INTEGER NOT NULL)''')
+
+    # メディア共有（additional_owners）に使うユーザーIDのカラム
+    c.execute("PRAGMA table_info(twitter_accounts)")
+    account_columns = [column[1] for column in c.fetchall()]
+    if 'user_id' not in account_columns:
+        c.execute("ALTER TABLE twitter_accounts ADD COLUMN user_id TEXT")
     
+    # 再起動をまたいでアップロードを再開するためのセッションと確認済みセグメント
+    c.execute('''CREATE TABLE IF NOT EXISTS upload_sessions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  file_hash TEXT NOT NULL,
+                  account_id INTEGER NOT NULL,
+                  additional_owners TEXT NOT NULL,
+                  media_id TEXT NOT NULL,
+                  total_bytes INTEGER NOT NULL,
+                  chunk_size INTEGER NOT NULL,
+                  finalized INTEGER NOT NULL DEFAULT 0,
+                  expires_at INTEGER NOT NULL,
+                  updated_at INTEGER NOT NULL,
+                  UNIQUE (file_hash, account_id, additional_owners))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS upload_segments
+                 (session_id INTEGER NOT NULL,
+                  segment_index INTEGER NOT NULL,
+                  byte_offset INTEGER NOT NULL,
+                  length INTEGER NOT NULL,
+                  confirmed INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (session_id, segment_index))''')
+
+    # ツイート後に時間をおいて送るリプライの予約
+    c.execute('''CREATE TABLE IF NOT EXISTS pending_replies
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  parent_tweet_id TEXT NOT NULL,
+                  account_id INTEGER NOT NULL,
+                  text TEXT NOT NULL,
+                  due_at INTEGER NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  last_error TEXT,
+                  updated_at INTEGER NOT NULL)''')
+
+    # 一覧APIのETagに使う、テーブルごとの変更カウンタ（トリガーで更新する）
+    c.execute('''CREATE TABLE IF NOT EXISTS table_versions
+                 (name TEXT PRIMARY KEY,
+                  version INTEGER NOT NULL)''')
+    # DBを作り直したときに古いETagと衝突しないよう、初期値は作成時刻にする
+    c.execute("INSERT OR IGNORE INTO table_versions (name, version) VALUES ('videos', ?)", (int(time.time() * 1000),))
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS videos_version_{event.lower()} AFTER {event} ON videos
+                      BEGIN
+                          UPDATE table_versions SET version = version + 1 WHERE name = 'videos';
+                      END''')
+
+    # アカウントごとの投稿内容のローテーション。並び順はseedから作り直せるので、現在位置と使用済みのものだけを保存する
+    c.execute("PRAGMA table_info(content_rotation)")
+    if 'rotation' in [column[1] for column in c.fetchall()]:
+        # 並び順そのものを保存していた形式のものは作り直す（ローテーションが最初からになるだけ）
+        c.execute("DROP TABLE content_rotation")
+    c.execute('''CREATE TABLE IF NOT EXISTS content_rotation
+                 (account_id INTEGER PRIMARY KEY,
+                  seed INTEGER NOT NULL,
+                  position INTEGER NOT NULL,
+                  taken TEXT NOT NULL,
+                  recent TEXT NOT NULL,
+                  updated_at INTEGER NOT NULL)''')
+
+    # アカウントごとの投稿を1件ずつ表すジョブ。複数のプロセスがリースを取って実行する
+    c.execute('''CREATE TABLE IF NOT EXISTS post_jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  batch_id INTEGER NOT NULL,
+                  account_id INTEGER NOT NULL,
+                  video_id INTEGER NOT NULL,
+                  shared_media INTEGER NOT NULL DEFAULT 0,
+                  state TEXT NOT NULL DEFAULT 'queued',
+                  run_after INTEGER NOT NULL,
+                  lease_owner TEXT,
+                  lease_expires_at INTEGER,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  tweet_id TEXT,
+                  last_error TEXT,
+                  created_at INTEGER NOT NULL,
+                  updated_at INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_post_jobs_state ON post_jobs (state, run_after, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_post_jobs_batch ON post_jobs (batch_id)")
+    # アカウントごとの投稿間隔の判定に使う、最後に実行を始めた時刻
+    c.execute("PRAGMA table_info(post_jobs)")
+    post_job_columns = [column[1] for column in c.fetchall()]
+    if 'started_at' not in post_job_columns:
+        c.execute("ALTER TABLE post_jobs ADD COLUMN started_at INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_post_jobs_account ON post_jobs (account_id, started_at)")
+
+    # 自動投稿の設定と次回の実行時刻（すべてのワーカープロセスで共有する1行）
+    c.execute('''CREATE TABLE IF NOT EXISTS posting_schedule
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                  active INTEGER NOT NULL DEFAULT 0,
+                  interval_secs INTEGER NOT NULL DEFAULT 0,
+                  shared_media INTEGER NOT NULL DEFAULT 0,
+                  next_run_at INTEGER,
+                  updated_at INTEGER NOT NULL)''')
+    c.execute("INSERT OR IGNORE INTO posting_schedule (id, updated_at) VALUES (1, ?)", (int(time.time()),))
+
     c.execute('''CREATE TABLE IF NOT EXISTS activity_log
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   timestamp DATETIME NOT NULL,
                   account TEXT NOT NULL,
                   action TEXT NOT NULL,
                   result TEXT NOT NULL)''')
+
+    # 並べ替えと範囲検索に使うUNIX時刻のカラム。既存の行は文字列の時刻（ローカル時刻）から変換する
+    c.execute("PRAGMA table_info(activity_log)")
+    activity_columns = [column[1] for column in c.fetchall()]
+    if 'created_at' not in activity_columns:
+        c.execute("ALTER TABLE activity_log ADD COLUMN created_at INTEGER")
+        c.execute("UPDATE activity_log SET created_at = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE created_at IS NULL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_log_created_at ON activity_log (created_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_log_account ON activity_log (account, created_at, id)")
+
+    # 保存期間を過ぎたログを日別・アカウント別に集計した結果
+    c.execute('''CREATE TABLE IF NOT EXISTS activity_daily_stats
+                 (day TEXT NOT NULL,
+                  account TEXT NOT NULL,
+                  action TEXT NOT NULL,
+                  success_count INTEGER NOT NULL DEFAULT 0,
+                  failure_count INTEGER NOT NULL DEFAULT 0,
+                  other_count INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (day, account, action))''')
     
     conn.commit()
     conn.close()
@@ -104,8 +412,607 @@ def init_db():
 # アプリケーション起動時にデータベースを初期化
 init_db()
 
-def process_video(video_path, start_time=None, end_time=None, max_duration=120):
-    app.logger.info(f"動画処理を開始: {video_path}, 開始時間: {start_time}, 終了時間: {end_time}")
+# 処理時間の計測（秒）に使うヒストグラムの区切り
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+class MetricsRegistry:
+    # 外部ライブラリに依存しない最小限のカウンタとヒストグラム。Prometheusのテキスト形式で出力する
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self.descriptions = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, metric_type, text):
+        self.descriptions[name] = (metric_type, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def add_collector(self, collector):
+        # 出力時に呼ばれ、(名前, ラベルのdict, 値)のリストを返す関数を登録する（キューの長さなど）
+        self.collectors.append(collector)
+
+    def _format_labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{self._escape(v)}"' for k, v in pairs) + '}'
+
+    def _escape(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']} for key, h in self.histograms.items()}
+        samples = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    samples[(name, tuple(sorted((k, str(v)) for k, v in labels.items())))] = value
+            except Exception as e:
+                app.logger.warning(f"メトリクスの収集中にエラーが発生しました: {str(e)}")
+
+        lines = []
+        described = set()
+        def header(name, default_type):
+            if name not in described:
+                described.add(name)
+                metric_type, text = self.descriptions.get(name, (default_type, name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+        for (name, labels), value in sorted(list(counters.items()) + list(samples.items())):
+            header(name, 'gauge')
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def _quantile(self, buckets, count, q):
+        # バケットの上限で近似する（最後のバケットを超えた分は最後の上限とみなす）
+        rank = q * count
+        for bound, cumulative in zip(self.buckets, buckets):
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def summary(self, name='xpost_stage_seconds', group_by='stage'):
+        # ダッシュボード向けに、指定したラベルごとの件数・平均・p50・p99をまとめる
+        merged = {}
+        with self.lock:
+            for (metric_name, labels), histogram in self.histograms.items():
+                if metric_name != name:
+                    continue
+                group = dict(labels).get(group_by, '')
+                entry = merged.setdefault(group, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                entry['buckets'] = [a + b for a, b in zip(entry['buckets'], histogram['buckets'])]
+                entry['sum'] += histogram['sum']
+                entry['count'] += histogram['count']
+            counters = {}
+            for (metric_name, labels), value in self.counters.items():
+                counters[metric_name] = counters.get(metric_name, 0) + value
+        return {
+            'stages': {group: {
+                'count': entry['count'],
+                'avg': round(entry['sum'] / entry['count'], 3) if entry['count'] else 0,
+                'p50': self._quantile(entry['buckets'], entry['count'], 0.5),
+                'p99': self._quantile(entry['buckets'], entry['count'], 0.99)
+            } for group, entry in merged.items()},
+            'counters': counters
+        }
+
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+metrics.describe('xpost_stage_seconds', 'histogram', '投稿処理の段階ごとの所要時間（秒）')
+metrics.describe('xpost_upload_bytes_total', 'counter', 'APPENDで送信に成功したバイト数')
+metrics.describe('xpost_retries_total', 'counter', '段階ごとのリトライ回数')
+metrics.describe('xpost_posts_total', 'counter', 'アカウントごとの投稿結果の件数')
+metrics.describe('xpost_transcode_jobs_total', 'counter', '動画変換ジョブの結果ごとの件数')
+metrics.describe('xpost_replies_total', 'counter', 'リプライ送信の結果ごとの件数')
+metrics.describe('xpost_status_polls_total', 'counter', 'STATUSの問い合わせ回数')
+
+# 処理済み動画キャッシュの設定
+PROCESSED_CACHE_FOLDER = 'processed_cache'
+PROCESSED_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024  # 10GB
+VIDEO_ENCODE_SETTINGS = {'codec': 'libx264', 'audio_codec': 'aac'}
+VIDEO_REMUX_SETTINGS = {'mode': 'remux', 'movflags': '+faststart'}
+VIDEO_PASSTHROUGH_SETTINGS = {'mode': 'passthrough'}
+
+# 再エンコードせずに投稿できるかの判定に使う設定
+FFMPEG_BINARY = get_setting("FFMPEG_BINARY")
+FFPROBE_BINARY = shutil.which('ffprobe')
+KEYFRAME_TOLERANCE = 0.05  # 秒
+TWITTER_VIDEO_LIMITS = {
+    'max_bytes': 512 * 1024 * 1024,
+    'max_width': 1920,
+    'max_height': 1200,
+    'max_fps': 60
+}
+
+class ProcessedVideoCache:
+    # キャッシュキー（SHA-256）をファイル名とするエントリだけを管理対象にする
+    ENTRY_PATTERN = re.compile(r'^[0-9a-f]{64}\.mp4$')
+    # アップロードフォルダ内の、内容のハッシュを名前にしたファイル
+    CONTENT_ADDRESSED_PATTERN = re.compile(r'^([0-9a-f]{64})\.[a-z0-9]+$')
+    # 中断されたワーカーが残した書き出し途中のファイルはこの時間で削除する
+    TEMP_FILE_MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pinned = {}
+        self.source_hashes = {}
+        self.auto_evict = True
+        self.lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+            app.logger.info(f"動画キャッシュフォルダを作成しました: {cache_dir}")
+
+    def file_hash(self, path):
+        # 取り込み時に内容のハッシュを名前にしたファイルは読み直さない
+        match = self.CONTENT_ADDRESSED_PATTERN.match(os.path.basename(path))
+        if match and os.path.dirname(os.path.abspath(path)) == os.path.abspath(UPLOAD_FOLDER):
+            return match.group(1)
+        # 同じファイルを何度もハッシュしないよう、サイズと更新時刻でメモ化する
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if memo_key in self.source_hashes:
+                return self.source_hashes[memo_key]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        with self.lock:
+            self.source_hashes[memo_key] = digest
+        return digest
+
+    def make_key(self, video_path, start_time, end_time, max_duration, settings):
+        # process_videoと同じく、開始・終了の両方が指定された場合のみ切り取り範囲として扱う
+        if start_time is None or end_time is None:
+            start_time, end_time = None, None
+        payload = json.dumps({
+            'source': self.file_hash(video_path),
+            'start_time': start_time,
+            'end_time': end_time,
+            'max_duration': max_duration,
+            'settings': settings
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+
+    def is_cached_path(self, path):
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.cache_dir)
+
+    def get(self, key):
+        path = self.path_for(key)
+        with self.lock:
+            if os.path.exists(path):
+                os.utime(path, None)  # LRUのためにアクセス時刻を更新
+                self.hits += 1
+                self.pinned[path] = self.pinned.get(path, 0) + 1
+                return path
+            self.misses += 1
+            return None
+
+    def put(self, key, temp_path):
+        path = self.path_for(key)
+        os.replace(temp_path, path)
+        self.pin(path)
+        if self.auto_evict:
+            self.evict()
+        return path
+
+    def adopt(self, key, source_path):
+        # 元のファイルをそのまま使う場合もキャッシュにハードリンク（できなければコピー）して固定する。
+        # アップロード中に投稿の更新・削除で元のファイルが消されても、リンク先は残る
+        path = self.get(key)
+        if path:
+            return path
+        with tempfile.NamedTemporaryFile(delete=False, prefix="tmp_", suffix=".mp4", dir=self.cache_dir) as temp_file:
+            temp_path = temp_file.name
+        try:
+            os.remove(temp_path)
+            try:
+                os.link(source_path, temp_path)
+            except OSError:
+                shutil.copyfile(source_path, temp_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.put(key, temp_path)
+
+    def remove_temp_files(self, prefix):
+        # 中断された変換の書きかけのファイルを消す
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def pin(self, path):
+        with self.lock:
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+
+    def release(self, path):
+        # 使用中のエントリは退避対象から外しておき、使い終わったら解除する
+        with self.lock:
+            count = self.pinned.get(path, 0) - 1
+            if count > 0:
+                self.pinned[path] = count
+            else:
+                self.pinned.pop(path, None)
+
+    def referenced_paths(self):
+        # 取り込み時に変換を済ませた投稿が参照しているファイル。行が更新・削除されるまで使用中として扱う
+        conn = get_read_db()
+        try:
+            rows = conn.execute("SELECT processed_path FROM videos WHERE processed_path IS NOT NULL").fetchall()
+        finally:
+            conn.close()
+        return {os.path.abspath(row[0]) for row in rows}
+
+    def evict(self):
+        referenced = self.referenced_paths()
+        with self.lock:
+            entries = []
+            total_bytes = 0
+            now = time.time()
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.startswith('tmp_') and now - stat.st_mtime > self.TEMP_FILE_MAX_AGE:
+                    os.remove(path)
+                    continue
+                if not self.ENTRY_PATTERN.match(name):
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+
+            for mtime, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                if path in self.pinned or os.path.abspath(path) in referenced:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+                self.evictions += 1
+                app.logger.info(f"動画キャッシュから削除しました: {path}")
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+processed_video_cache = ProcessedVideoCache(PROCESSED_CACHE_FOLDER, PROCESSED_CACHE_MAX_BYTES)
+
+# MP4/MOVのボックス構造から読み取るメタデータの設定
+MP4_NESTED_BOXES = {'moov', 'trak', 'mdia', 'minf', 'stbl'}
+MP4_CODEC_NAMES = {'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'mp4v': 'mpeg4',
+                   'mp4a': 'aac', 'ac-3': 'ac3', 'Opus': 'opus', '.mp3': 'mp3'}
+H264_YUV420P_PROFILES = {66, 77, 88, 100}  # Baseline / Main / Extended / High（8bit 4:2:0）
+
+class ContainerProbeError(Exception):
+    pass
+
+def iter_mp4_boxes(f, start, end):
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise ContainerProbeError(f"不正なボックスです: {box_type!r}, オフセット {offset}")
+        yield box_type.decode('latin-1'), offset + header_size, offset + size
+        offset += size
+
+def read_mp4_track(f, start, end, track, with_keyframes):
+    for box_type, body_start, body_end in iter_mp4_boxes(f, start, end):
+        if box_type in MP4_NESTED_BOXES:
+            read_mp4_track(f, body_start, body_end, track, with_keyframes)
+            continue
+        if box_type not in ('tkhd', 'mdhd', 'hdlr', 'stsd', 'stts', 'stss'):
+            continue
+        if box_type == 'stss' and not with_keyframes:
+            continue
+        f.seek(body_start)
+        data = f.read(body_end - body_start)
+        if box_type == 'tkhd':
+            # 幅と高さは末尾の16.16固定小数点
+            width, height = struct.unpack('>II', data[-8:])
+            track['width'], track['height'] = width >> 16, height >> 16
+        elif box_type == 'mdhd':
+            if data[0] == 1:
+                timescale, duration = struct.unpack('>IQ', data[20:32])
+            else:
+                timescale, duration = struct.unpack('>II', data[12:20])
+            track['timescale'], track['duration'] = timescale, duration
+        elif box_type == 'hdlr':
+            track['handler'] = data[8:12].decode('latin-1')
+        elif box_type == 'stsd':
+            # 最初のサンプルエントリの形式（avc1, mp4aなど）だけを見る
+            track['format'] = data[12:16].decode('latin-1')
+            avcc = data.find(b'avcC')
+            if avcc != -1 and avcc + 6 <= len(data):
+                track['avc_profile'] = data[avcc + 5]
+        elif box_type == 'stts':
+            entry_count = struct.unpack('>I', data[4:8])[0]
+            entries = struct.unpack(f'>{entry_count * 2}I', data[8:8 + entry_count * 8])
+            track['stts'] = list(zip(entries[0::2], entries[1::2]))
+        elif box_type == 'stss':
+            entry_count = struct.unpack('>I', data[4:8])[0]
+            track['sync_samples'] = struct.unpack(f'>{entry_count}I', data[8:8 + entry_count * 4])
+
+def mp4_sample_times(stts, timescale, sample_numbers):
+    # サンプル番号（1始まり、昇順）を秒に変換する
+    times = []
+    targets = iter(sample_numbers)
+    target = next(targets, None)
+    sample, elapsed = 1, 0
+    for count, delta in stts:
+        while target is not None and target < sample + count:
+            times.append((elapsed + (target - sample) * delta) / timescale)
+            target = next(targets, None)
+        sample += count
+        elapsed += count * delta
+    return times
+
+def probe_container(video_path, with_keyframes=False):
+    # MP4/MOVのmoovボックスだけを読み、フレームをデコードせずにメタデータを得る
+    file_size = os.path.getsize(video_path)
+    with open(video_path, 'rb') as f:
+        try:
+            top_level = {box_type: (body_start, body_end) for box_type, body_start, body_end in iter_mp4_boxes(f, 0, file_size)}
+        except struct.error as e:
+            raise ContainerProbeError(f"ボックスを読み取れません: {str(e)}")
+        if 'ftyp' not in top_level or 'moov' not in top_level:
+            raise ContainerProbeError(f"MP4/MOV形式ではありません: {video_path}")
+        f.seek(top_level['ftyp'][0])
+        brand = f.read(4).decode('latin-1')
+
+        duration = None
+        tracks = []
+        try:
+            moov_start, moov_end = top_level['moov']
+            for box_type, body_start, body_end in iter_mp4_boxes(f, moov_start, moov_end):
+                if box_type == 'mvhd':
+                    f.seek(body_start)
+                    data = f.read(min(body_end - body_start, 32))
+                    if data[0] == 1:
+                        timescale, movie_duration = struct.unpack('>IQ', data[20:32])
+                    else:
+                        timescale, movie_duration = struct.unpack('>II', data[12:20])
+                    duration = movie_duration / timescale if timescale else None
+                elif box_type == 'trak':
+                    track = {}
+                    read_mp4_track(f, body_start, body_end, track, with_keyframes)
+                    tracks.append(track)
+        except (struct.error, IndexError) as e:
+            raise ContainerProbeError(f"moovボックスを読み取れません: {str(e)}")
+
+    video = next((t for t in tracks if t.get('handler') == 'vide'), None)
+    if video is None or not duration:
+        raise ContainerProbeError(f"映像トラックが見つかりません: {video_path}")
+    audio_codecs = [MP4_CODEC_NAMES.get(t.get('format'), t.get('format')) for t in tracks if t.get('handler') == 'soun']
+
+    fps = 0
+    sample_count = sum(count for count, delta in video.get('stts', []))
+    if video.get('timescale') and video.get('duration'):
+        fps = sample_count / (video['duration'] / video['timescale'])
+
+    probe = {
+        'format_name': 'mov,mp4,m4a,3gp,3g2,mj2',
+        'brand': brand,
+        'duration': duration,
+        'size': file_size,
+        'bitrate': int(file_size * 8 / duration),
+        'video_codec': MP4_CODEC_NAMES.get(video.get('format'), video.get('format')),
+        'pix_fmt': 'yuv420p' if video.get('avc_profile') in H264_YUV420P_PROFILES else None,
+        'width': video.get('width', 0),
+        'height': video.get('height', 0),
+        'fps': fps,
+        'audio_codecs': audio_codecs
+    }
+    if with_keyframes:
+        # stssがない場合は全サンプルがキーフレーム
+        sync_samples = video.get('sync_samples') or range(1, sample_count + 1)
+        probe['keyframes'] = mp4_sample_times(video.get('stts', []), video.get('timescale') or 1, sync_samples)
+    return probe
+
+def probe_video(video_path):
+    # ffprobeでコンテナとストリームの情報だけを読み取る（デコードはしない）
+    if not FFPROBE_BINARY:
+        # ffprobeがない環境ではMP4/MOVのボックスを直接読む
+        try:
+            return probe_container(video_path)
+        except (ContainerProbeError, OSError) as e:
+            app.logger.warning(f"動画のプローブに失敗しました: {video_path}, {str(e)}")
+            return None
+    cmd = [FFPROBE_BINARY, '-v', 'error',
+           '-show_entries', 'format=format_name,duration,size:stream=codec_type,codec_name,pix_fmt,width,height,avg_frame_rate',
+           '-of', 'json', video_path]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30, check=True)
+        info = json.loads(result.stdout)
+    except (subprocess.SubprocessError, OSError, ValueError) as e:
+        app.logger.warning(f"動画のプローブに失敗しました: {video_path}, {str(e)}")
+        return None
+
+    video_streams = [st for st in info.get('streams', []) if st.get('codec_type') == 'video']
+    audio_streams = [st for st in info.get('streams', []) if st.get('codec_type') == 'audio']
+    if not video_streams:
+        return None
+    video = video_streams[0]
+    fps = 0
+    if video.get('avg_frame_rate') and '/' in video['avg_frame_rate']:
+        num, den = video['avg_frame_rate'].split('/')
+        fps = float(num) / float(den) if float(den) else 0
+    return {
+        'format_name': info['format'].get('format_name', ''),
+        'duration': float(info['format'].get('duration', 0)),
+        'size': int(info['format'].get('size', os.path.getsize(video_path))),
+        'video_codec': video.get('codec_name'),
+        'pix_fmt': video.get('pix_fmt'),
+        'width': video.get('width', 0),
+        'height': video.get('height', 0),
+        'fps': fps,
+        'audio_codecs': [st.get('codec_name') for st in audio_streams]
+    }
+
+# 取り込み時にvideosテーブルへ保存するメタデータ
+VIDEO_METADATA_COLUMNS = ['duration', 'video_codec', 'audio_codec', 'width', 'height', 'bitrate', 'file_size']
+
+def probe_video_metadata(video_path):
+    # MP4/MOVはボックスを直接読み、それ以外はffprobeがあればそちらで読む
+    try:
+        probe = probe_container(video_path)
+    except (ContainerProbeError, OSError):
+        probe = probe_video(video_path) if FFPROBE_BINARY else None
+    if probe is None:
+        return None
+    return {
+        'duration': probe['duration'],
+        'video_codec': probe['video_codec'],
+        'audio_codec': probe['audio_codecs'][0] if probe['audio_codecs'] else None,
+        'width': probe['width'],
+        'height': probe['height'],
+        'bitrate': probe.get('bitrate') or (int(probe['size'] * 8 / probe['duration']) if probe['duration'] else None),
+        'file_size': probe['size']
+    }
+
+def validate_video_metadata(filename, metadata):
+    # 読めるはずの形式でメタデータが取れない動画は壊れているので、登録時に弾く。問題がなければNoneを返す
+    if metadata is None and (FFPROBE_BINARY or filename.rsplit('.', 1)[1].lower() in CONTAINER_PROBE_EXTENSIONS):
+        return '動画ファイルを読み取れません。ファイルが壊れていないか確認してください'
+    return None
+
+def validate_trim_window(start_time, end_time, duration):
+    # 投稿時に失敗する切り取り範囲を登録時に弾く。問題がなければNoneを返す
+    if (start_time is not None and start_time < 0) or (end_time is not None and end_time < 0):
+        return '開始時間と終了時間は0以上で指定してください'
+    if start_time is not None and end_time is not None and end_time <= start_time:
+        return '終了時間は開始時間より後にしてください'
+    if duration is not None and start_time is not None and start_time >= duration:
+        return f'開始時間が動画の長さ（{duration:.1f}秒）を超えています'
+    return None
+
+def probe_keyframes(video_path):
+    if not FFPROBE_BINARY:
+        try:
+            return probe_container(video_path, with_keyframes=True)['keyframes']
+        except ContainerProbeError as e:
+            raise OSError(str(e))
+    # パケットのフラグからキーフレームの時刻を取得する
+    cmd = [FFPROBE_BINARY, '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60, check=True)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        fields = line.split(',')
+        if len(fields) >= 2 and 'K' in fields[1] and fields[0] not in ('', 'N/A'):
+            keyframes.append(float(fields[0]))
+    return sorted(keyframes)
+
+def is_twitter_compatible(probe):
+    limits = TWITTER_VIDEO_LIMITS
+    return (probe['video_codec'] == 'h264'
+            and probe['pix_fmt'] == 'yuv420p'
+            and all(codec == 'aac' for codec in probe['audio_codecs'])
+            and len(probe['audio_codecs']) <= 1
+            and 'mp4' in probe['format_name']
+            and max(probe['width'], probe['height']) <= limits['max_width']
+            and min(probe['width'], probe['height']) <= limits['max_height']
+            and probe['fps'] <= limits['max_fps'])
+
+def plan_video_processing(video_path, start_time, end_time, max_duration):
+    # 最速で有効な処理方法（passthrough / remux / transcode）と切り取り範囲を決める
+    probe = probe_video(video_path)
+    if probe is None or not is_twitter_compatible(probe):
+        return 'transcode', None
+
+    duration = probe['duration']
+    clip_start, clip_end = 0, duration
+    if start_time is not None and end_time is not None:
+        clip_start, clip_end = start_time, min(end_time, duration)
+    if clip_end <= clip_start:
+        return 'transcode', None
+    clip_end = min(clip_end, clip_start + max_duration)
+
+    is_full_clip = clip_start <= KEYFRAME_TOLERANCE and clip_end >= duration - KEYFRAME_TOLERANCE
+    if (is_full_clip and video_path.lower().endswith('.mp4')
+            and probe['size'] <= TWITTER_VIDEO_LIMITS['max_bytes']):
+        return 'passthrough', (0, duration)
+
+    if clip_start > KEYFRAME_TOLERANCE:
+        try:
+            keyframes = probe_keyframes(video_path)
+        except (subprocess.SubprocessError, OSError) as e:
+            app.logger.warning(f"キーフレームの取得に失敗しました: {video_path}, {str(e)}")
+            return 'transcode', None
+        if not any(abs(keyframe - clip_start) <= KEYFRAME_TOLERANCE for keyframe in keyframes):
+            return 'transcode', None
+
+    estimated_bytes = probe['size'] * (clip_end - clip_start) / duration if duration else probe['size']
+    if estimated_bytes > TWITTER_VIDEO_LIMITS['max_bytes']:
+        return 'transcode', None
+    return 'remux', (clip_start, clip_end)
+
+def remux_video(video_path, output_path, clip_start, clip_end):
+    # デコードせずにストリームコピーで切り出す（開始位置はキーフレーム上にある前提）
+    cmd = [FFMPEG_BINARY, '-v', 'error', '-y',
+           '-ss', f"{clip_start:.3f}", '-i', video_path, '-t', f"{clip_end - clip_start:.3f}",
+           '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy',
+           '-movflags', VIDEO_REMUX_SETTINGS['movflags'], output_path]
+    subprocess.run(cmd, capture_output=True, timeout=300, check=True)
+
+def transcode_video(video_path, output_path, start_time, end_time, max_duration):
     clip = VideoFileClip(video_path)
     
     original_duration = clip.duration
@@ -125,248 +1032,2082 @@ def process_video(video_path, start_time=None, end_time=None, max_duration=120):
         app.logger.info(f"動画が{max_duration}秒を超えています。追加の切り取りを行います。")
         cut_clip = cut_clip.subclip(0, max_duration)
         app.logger.info(f"最終的な動画の長さ: {max_duration}秒")
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_file:
-        temp_path = temp_file.name
-    
-    cut_clip.write_videofile(temp_path, codec="libx264", audio_codec="aac")
-    app.logger.info(f"処理済み動画を保存しました: {temp_path}")
-    
-    clip.close()
-    cut_clip.close()
-    
-    return temp_path
 
-def insert_video_data(filename, caption, reply_content, start_time, end_time):
-    conn = sqlite3.connect('videos.db')
+    try:
+        cut_clip.write_videofile(output_path, **VIDEO_ENCODE_SETTINGS)
+    finally:
+        clip.close()
+        cut_clip.close()
+
+def plan_processed_video(video_path, start_time, end_time, max_duration, fast_path=True):
+    # 変換せずに済む場合は(処理済みのパス, 処理方法)を、変換が必要な場合は(None, 試す処理の一覧)を返す。
+    # キャッシュの確認と判定は軽いので、ワーカープロセスに渡す前に呼び出し元で行う
+    methods = ['transcode']
+    window = None
+    if fast_path:
+        method, window = plan_video_processing(video_path, start_time, end_time, max_duration)
+        if method == 'passthrough':
+            app.logger.info(f"再エンコード不要のため元の動画をそのまま使用します: {video_path}")
+            cache_key = processed_video_cache.make_key(video_path, start_time, end_time, max_duration, VIDEO_PASSTHROUGH_SETTINGS)
+            return (processed_video_cache.adopt(cache_key, video_path), method), None
+        if method == 'remux':
+            methods = ['remux', 'transcode']
+
+    steps = []
+    for method in methods:
+        settings = VIDEO_REMUX_SETTINGS if method == 'remux' else VIDEO_ENCODE_SETTINGS
+        cache_key = processed_video_cache.make_key(video_path, start_time, end_time, max_duration, settings)
+        cached_path = processed_video_cache.get(cache_key)
+        if cached_path:
+            app.logger.info(f"キャッシュ済みの処理済み動画を使用します: {cached_path}, 処理方法: {method} ({processed_video_cache.stats()})")
+            return (cached_path, method), None
+        steps.append((method, window, cache_key))
+    return None, steps
+
+def run_video_processing(video_path, start_time, end_time, max_duration, steps, temp_prefix="tmp_"):
+    # plan_processed_videoが返した処理を順に試し、最初に成功したものをキャッシュに登録する
+    app.logger.info(f"動画処理を開始: {video_path}, 開始時間: {start_time}, 終了時間: {end_time}")
+    for method, window, cache_key in steps:
+        # キャッシュと同じファイルシステム上に書き出し、完成後にリネームで登録する
+        with tempfile.NamedTemporaryFile(delete=False, prefix=temp_prefix, suffix=".mp4", dir=processed_video_cache.cache_dir) as temp_file:
+            temp_path = temp_file.name
+
+        try:
+            if method == 'remux':
+                remux_video(video_path, temp_path, *window)
+            else:
+                transcode_video(video_path, temp_path, start_time, end_time, max_duration)
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if method == steps[-1][0]:
+                raise
+            app.logger.warning(f"{method}に失敗したため再エンコードに切り替えます: {str(e)}")
+            continue
+
+        processed_path = processed_video_cache.put(cache_key, temp_path)
+        app.logger.info(f"処理済み動画をキャッシュに保存しました: {processed_path}, 処理方法: {method} ({processed_video_cache.stats()})")
+        return processed_path, method
+
+def process_video(video_path, start_time=None, end_time=None, max_duration=120, fast_path=True):
+    result, steps = plan_processed_video(video_path, start_time, end_time, max_duration, fast_path)
+    if result is not None:
+        return result
+    return run_video_processing(video_path, start_time, end_time, max_duration, steps)
+
+# 動画変換ワーカーの設定
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 1))
+TRANSCODE_TIMEOUT = int(os.environ.get('TRANSCODE_TIMEOUT', 900))  # 秒
+
+class TranscodeTimeoutError(Exception):
+    pass
+
+def _transcode_worker(conn):
+    # 子プロセスで実行され、親から受け取った変換を終了するまで順に処理する。
+    # キャッシュの退避はピン情報を持つ親プロセスに任せる
+    processed_video_cache.auto_evict = False
+    while True:
+        try:
+            video_path, start_time, end_time, max_duration, steps, temp_prefix = conn.recv()
+        except EOFError:
+            break
+        try:
+            conn.send(('ok', run_video_processing(video_path, start_time, end_time, max_duration, steps, temp_prefix)))
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {str(e)}"))
+    conn.close()
+
+class TranscodeJob:
+    def __init__(self, video_path, start_time, end_time, max_duration, timeout, group):
+        self.video_path = video_path
+        self.start_time = start_time
+        self.end_time = end_time
+        self.max_duration = max_duration
+        self.timeout = timeout
+        self.group = group
+        self.steps = None
+        # 途中で止めたワーカーの書きかけのファイルを見つけられるよう、一時ファイル名にジョブごとの接頭辞を付ける
+        self.temp_prefix = f"tmp_{uuid.uuid4().hex}_"
+        self.submitted_at = time.perf_counter()
+        self.future = Future()
+        self.process = None
+        self.cancelled = False
+
+    def result(self):
+        return self.future.result()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.future.cancel():
+            return True
+        # 実行中のジョブはワーカープロセスごと停止する（次のジョブの前に起動し直す）
+        process = self.process
+        if process is not None and process.is_alive():
+            process.terminate()
+            return True
+        return False
+
+class TranscodeWorker:
+    # 起動したまま変換を受け付ける子プロセス。停止した場合は次のジョブで起動し直す
+    def __init__(self, context):
+        self.context = context
+        self.process = None
+        self.conn = None
+
+    def ensure_started(self):
+        if self.process is not None and self.process.is_alive():
+            return
+        self.stop()
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=_transcode_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            # 起動に失敗したプロセスはjoinできないので、始まっているものだけを止める
+            if self.process.pid is not None:
+                if self.process.is_alive():
+                    self.process.terminate()
+                self.process.join()
+            self.process = None
+
+class TranscodeExecutor:
+    def __init__(self, max_workers, timeout):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.context = multiprocessing.get_context('spawn')
+        self.jobs = set()
+        self.threads = []
+        self.lock = threading.Lock()
+        app.logger.info(f"動画変換ワーカーを初期化しました: 最大{max_workers}プロセス, タイムアウト{timeout}秒")
+
+    def start(self):
+        # ワーカープロセスごとに1本の配送スレッドを持ち、キューからジョブを受け取って渡す
+        with self.lock:
+            if self.threads:
+                return
+            for index in range(self.max_workers):
+                thread = threading.Thread(target=self._dispatch, args=(TranscodeWorker(self.context),),
+                                          name=f"transcode-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, video_path, start_time=None, end_time=None, max_duration=120, timeout=None, group='posting'):
+        job = TranscodeJob(video_path, start_time, end_time, max_duration, timeout or self.timeout, group)
+        try:
+            result, job.steps = plan_processed_video(video_path, start_time, end_time, max_duration)
+        except Exception as e:
+            job.future.set_exception(e)
+            return job
+        if result is not None:
+            # キャッシュ済み・再エンコード不要の動画はワーカーに渡さない
+            metrics.inc('xpost_transcode_jobs_total', group=group, status='skipped')
+            job.future.set_result(result)
+            return job
+        with self.lock:
+            self.jobs.add(job)
+        self.start()
+        self.queue.put(job)
+        return job
+
+    def _dispatch(self, worker):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(worker, job)
+            except Exception as e:
+                # 1件の失敗で配送スレッドが止まり、ワーカーの枠が減らないようにする
+                app.logger.error(f"動画変換ジョブの処理中にエラーが発生しました: {job.video_path}, {str(e)}", exc_info=True)
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.jobs.discard(job)
+
+    def _run(self, worker, job):
+        if not job.future.set_running_or_notify_cancel():
+            app.logger.info(f"動画変換ジョブはキャンセルされました: {job.video_path}")
+            metrics.inc('xpost_transcode_jobs_total', group=job.group, status='cancelled')
+            return
+        started_at = time.perf_counter()
+        metrics.observe('xpost_stage_seconds', started_at - job.submitted_at, stage='transcode_queue', account_id='')
+        status = 'error'
+        try:
+            worker.ensure_started()
+            job.process = worker.process
+            worker.conn.send((job.video_path, job.start_time, job.end_time, job.max_duration, job.steps, job.temp_prefix))
+
+            if worker.conn.poll(job.timeout):
+                try:
+                    status, payload = worker.conn.recv()
+                except (EOFError, OSError):
+                    status, payload = 'error', 'ワーカープロセスが異常終了しました'
+            elif job.cancelled:
+                status, payload = 'cancelled', None
+            else:
+                status, payload = 'timeout', None
+
+            if status not in ('ok', 'error') or job.cancelled:
+                # 処理途中のワーカーは停止し、次のジョブで起動し直す
+                worker.stop()
+
+            if job.cancelled:
+                app.logger.info(f"動画変換ジョブを中止しました: {job.video_path}")
+                job.future.set_exception(CancelledError())
+            elif status == 'ok':
+                processed_path, method = payload
+                if processed_video_cache.is_cached_path(processed_path):
+                    processed_video_cache.pin(processed_path)
+                    processed_video_cache.evict()
+                job.future.set_result(payload)
+            elif status == 'timeout':
+                app.logger.error(f"動画変換が{job.timeout}秒以内に完了しませんでした: {job.video_path}")
+                job.future.set_exception(TranscodeTimeoutError(f"動画変換がタイムアウトしました: {job.video_path}"))
+            else:
+                job.future.set_exception(RuntimeError(payload))
+        except Exception as e:
+            # 待っている呼び出し元を先に解放してから、ワーカーを片付ける
+            try:
+                if not job.future.done():
+                    job.future.set_exception(CancelledError() if job.cancelled else e)
+            except InvalidStateError:
+                pass
+            try:
+                worker.stop()
+            except Exception as stop_error:
+                app.logger.error(f"動画変換ワーカーの停止中にエラーが発生しました: {str(stop_error)}")
+        finally:
+            job.process = None
+            if status != 'ok' or job.cancelled:
+                processed_video_cache.remove_temp_files(job.temp_prefix)
+            metrics.observe('xpost_stage_seconds', time.perf_counter() - started_at, stage='transcode', account_id='')
+            metrics.inc('xpost_transcode_jobs_total', group=job.group, status='cancelled' if job.cancelled else status)
+
+    def cancel_all(self, group=None):
+        with self.lock:
+            jobs = [job for job in self.jobs if group is None or job.group == group]
+        for job in jobs:
+            job.cancel()
+        if jobs:
+            app.logger.info(f"動画変換ジョブを{len(jobs)}件キャンセルしました")
+
+transcode_executor = TranscodeExecutor(TRANSCODE_WORKERS, TRANSCODE_TIMEOUT)
+
+# 投稿内容の選択に使う設定
+CONTENT_COOLDOWN_POSTS = int(os.environ.get('CONTENT_COOLDOWN_POSTS', 3))  # 同じアカウントで直近に使った投稿を避ける件数
+CONTENT_MAX_WEIGHT = 10
+CONTENT_SCAN_WINDOW = 64  # ローテーションの先読み件数
+CONTENT_INDEX_REFRESH_SECS = 300  # 他のプロセスでの追加・削除を取り込む間隔
+
+ROTATION_KEY_MASK = (1 << 64) - 1
+
+def normalize_weight(value):
+    try:
+        weight = int(value)
+    except (TypeError, ValueError):
+        return 1
+    return max(1, min(CONTENT_MAX_WEIGHT, weight))
+
+class ContentSelector:
+    # ORDER BY RANDOM()で毎回全件を並べ替えないよう、投稿IDの索引をメモリに持って選ぶ
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+        self.ready_ids = []
+        self.ready_positions = {}
+        self.weights = {}
+        self.rotations = {}
+        self.loaded_at = None
+        self.lock = threading.RLock()
+
+    def _add_member(self, ids, positions, post_id):
+        if post_id not in positions:
+            positions[post_id] = len(ids)
+            ids.append(post_id)
+
+    def _remove_member(self, ids, positions, post_id):
+        # 末尾の要素と入れ替えてから取り除くことで定数時間で削除する
+        index = positions.pop(post_id, None)
+        if index is None:
+            return
+        last = ids.pop()
+        if last != post_id:
+            ids[index] = last
+            positions[last] = index
+
+    def _ensure_loaded(self):
+        if self.loaded_at is not None and time.time() - self.loaded_at < CONTENT_INDEX_REFRESH_SECS:
+            return
+        conn = get_read_db()
+        c = conn.cursor()
+        try:
+            c.execute("SELECT id, weight, processing_status FROM videos")
+            rows = c.fetchall()
+        finally:
+            conn.close()
+        self.ids, self.positions = [], {}
+        self.ready_ids, self.ready_positions = [], {}
+        self.weights = {}
+        for post_id, weight, status in rows:
+            self._add_member(self.ids, self.positions, post_id)
+            if status == 'ready':
+                self._add_member(self.ready_ids, self.ready_positions, post_id)
+            self.weights[post_id] = normalize_weight(weight)
+        # ローテーションは次に使うときにDBから読み直して索引と突き合わせる
+        self.rotations = {}
+        self.loaded_at = time.time()
+        app.logger.info(f"投稿内容の索引を読み込みました: {len(self.ids)}件")
+
+    def add(self, post_id, weight=1):
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            self._add_member(self.ids, self.positions, post_id)
+            self.weights[post_id] = normalize_weight(weight)
+            for state in self.rotations.values():
+                self._insert_into_rotation(state, post_id)
+
+    def update(self, post_id, weight=None, ready=None):
+        with self.lock:
+            if self.loaded_at is None or post_id not in self.positions:
+                return
+            # 重みの変更は各アカウントの次の並べ直しから反映される
+            if weight is not None:
+                self.weights[post_id] = normalize_weight(weight)
+            if ready is True:
+                self._add_member(self.ready_ids, self.ready_positions, post_id)
+            elif ready is False:
+                self._remove_member(self.ready_ids, self.ready_positions, post_id)
+
+    def remove(self, post_id):
+        # ローテーション内の削除済みIDは選ぶときに読み飛ばす
+        with self.lock:
+            self._remove_member(self.ids, self.positions, post_id)
+            self._remove_member(self.ready_ids, self.ready_positions, post_id)
+            self.weights.pop(post_id, None)
+
+    def random_id(self):
+        with self.lock:
+            self._ensure_loaded()
+            # 事前変換が完了した投稿を優先し、なければ全体から選ぶ
+            pool = self.ready_ids or self.ids
+            return random.choice(pool) if pool else None
+
+    def next_for_account(self, account_id):
+        with self.lock:
+            self._ensure_loaded()
+            if not self.ids:
+                return None
+            state = self.rotations.get(account_id)
+            if state is None:
+                state = self._load_rotation(account_id)
+            post_id = self._scan(state, strict=True)
+            if post_id is None:
+                # 一巡した（または残りが直近に使った投稿だけ）なら新しい順序で並べ直す
+                self._reshuffle(state)
+                post_id = self._scan(state, strict=True)
+                if post_id is None:
+                    post_id = self._scan(state, strict=False)
+            state['recent'].append(post_id)
+            self._save_rotation(account_id, state)
+            return post_id
+
+    def forget_account(self, account_id):
+        with self.lock:
+            self.rotations.pop(account_id, None)
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("DELETE FROM content_rotation WHERE account_id = ?", (account_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _rotation_key(self, seed, post_id, copy):
+        # seedと投稿IDから決まる並び順のキー。投稿が増減しても他の投稿の順序は変わらない
+        x = (seed + post_id * 0x9E3779B97F4A7C15 + copy * 0xD6E8FEB86659FD93) & ROTATION_KEY_MASK
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & ROTATION_KEY_MASK
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & ROTATION_KEY_MASK
+        return (x ^ (x >> 31)) >> 1
+
+    def _build_rotation(self, state):
+        # 重みの数だけ並べた投稿をキーの順に並べる。保存していた位置（キー）より前は使用済みとして扱う
+        seed = state['seed']
+        rotation = [(self._rotation_key(seed, post_id, copy), post_id)
+                    for post_id in self.ids for copy in range(self.weights.get(post_id, 1))]
+        rotation.sort()
+        state['rotation'] = rotation
+        state['taken'] = {key for key in state['taken'] if key > state['cursor']}
+        state['position'] = bisect.bisect_right(rotation, (state['cursor'], float('inf')))
+        self._skip_taken(state)
+
+    def _reshuffle(self, state):
+        state['seed'] = random.getrandbits(63)
+        state['cursor'] = -1
+        state['taken'] = set()
+        self._build_rotation(state)
+
+    def _insert_into_rotation(self, state, post_id):
+        # キーの位置に差し込む。現在位置より前に入ったものは次の周から使われる
+        for copy in range(self.weights.get(post_id, 1)):
+            entry = (self._rotation_key(state['seed'], post_id, copy), post_id)
+            index = bisect.bisect_left(state['rotation'], entry)
+            state['rotation'].insert(index, entry)
+            if index < state['position']:
+                state['position'] += 1
+
+    def _skip_taken(self, state):
+        # 先読みで使用済みになったものに位置が追いついたら読み飛ばす
+        rotation = state['rotation']
+        while state['position'] < len(rotation) and rotation[state['position']][0] in state['taken']:
+            state['cursor'] = rotation[state['position']][0]
+            state['taken'].discard(state['cursor'])
+            state['position'] += 1
+
+    def _take(self, state, index):
+        key, post_id = state['rotation'][index]
+        if index == state['position']:
+            state['position'] += 1
+            state['cursor'] = key
+            self._skip_taken(state)
+        else:
+            # 現在位置より先のものは、位置が追いつくまで使用済みとして覚えておく
+            state['taken'].add(key)
+        return post_id
+
+    def _scan(self, state, strict):
+        rotation = state['rotation']
+        # 現在位置にある削除済みの投稿は読み捨てる（途中のものは位置が追いついたときに捨てる）
+        while state['position'] < len(rotation) and rotation[state['position']][1] not in self.positions:
+            state['cursor'] = rotation[state['position']][0]
+            state['position'] += 1
+            self._skip_taken(state)
+        cooldown = min(CONTENT_COOLDOWN_POSTS, len(self.ids) - 1) if strict else 0
+        recent = set(list(state['recent'])[-cooldown:]) if cooldown > 0 else set()
+        prefer_ready = strict and bool(self.ready_ids)
+        fallback = None
+        index = state['position']
+        while index < len(rotation) and index < state['position'] + CONTENT_SCAN_WINDOW:
+            key, post_id = rotation[index]
+            if key in state['taken'] or post_id not in self.positions or post_id in recent:
+                index += 1
+                continue
+            if not prefer_ready or post_id in self.ready_positions:
+                return self._take(state, index)
+            if fallback is None:
+                fallback = index
+            index += 1
+        if fallback is not None:
+            return self._take(state, fallback)
+        return None
+
+    def _load_rotation(self, account_id):
+        conn = get_read_db()
+        c = conn.cursor()
+        try:
+            c.execute("SELECT seed, position, taken, recent FROM content_rotation WHERE account_id = ?", (account_id,))
+            row = c.fetchone()
+        finally:
+            conn.close()
+        state = {'recent': deque(maxlen=max(CONTENT_COOLDOWN_POSTS, 1))}
+        if row:
+            state['seed'], state['cursor'] = row[0], row[1]
+            state['taken'] = set(json.loads(row[2]))
+            state['recent'].extend(json.loads(row[3]))
+            self._build_rotation(state)
+        else:
+            self._reshuffle(state)
+        self.rotations[account_id] = state
+        return state
+
+    def _save_rotation(self, account_id, state):
+        # 保存するのはseed・現在位置・先読みで使ったもの・直近の投稿だけなので、投稿数によらず一定の大きさになる
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("INSERT OR REPLACE INTO content_rotation (account_id, seed, position, taken, recent, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                      (account_id, state['seed'], state['cursor'], json.dumps(sorted(state['taken'])), json.dumps(list(state['recent'])), int(time.time())))
+            conn.commit()
+        finally:
+            conn.close()
+
+content_selector = ContentSelector()
+
+def insert_video_data(filename, caption, reply_content, start_time, end_time, weight=1, content_hash=None, original_filename=None, metadata=None):
+    metadata = metadata or {}
+    conn = get_db()
     c = conn.cursor()
     try:
-        c.execute("INSERT INTO videos (filename, caption, reply_content, start_time, end_time) VALUES (?, ?, ?, ?, ?)", 
-                  (filename, caption, reply_content, start_time, end_time))
+        c.execute(f"INSERT INTO videos (filename, caption, reply_content, start_time, end_time, weight, content_hash, original_filename, {', '.join(VIDEO_METADATA_COLUMNS)}) "
+                  f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, {', '.join('?' * len(VIDEO_METADATA_COLUMNS))})", 
+                  (filename, caption, reply_content, start_time, end_time, normalize_weight(weight), content_hash, original_filename)
+                  + tuple(metadata.get(column) for column in VIDEO_METADATA_COLUMNS))
         conn.commit()
+        content_selector.add(c.lastrowid, weight)
         app.logger.info(f"データを挿入しました: {filename}, 開始時間: {start_time}秒, 終了時間: {end_time}秒")
+        return c.lastrowid
     except sqlite3.Error as e:
         app.logger.error(f"データ挿入中にエラーが発生しました: {str(e)}")
+        return None
     finally:
         conn.close()
 
+def estimate_processing_cost(duration, width, height, start_time, end_time, max_duration=120):
+    # 変換にかかる作業量の目安（720p換算の動画秒数）。メタデータがない場合は最大長とみなす
+    if not duration:
+        return float(max_duration)
+    clip_duration = duration
+    if start_time is not None and end_time is not None:
+        clip_duration = max(0, min(end_time, duration) - start_time)
+    clip_duration = min(clip_duration, max_duration)
+    return clip_duration * (width or 1280) * (height or 720) / (1280 * 720)
+
+class IngestPipeline:
+    # 投稿の登録・更新時に切り取りと変換を先に済ませ、投稿時はアップロードだけにする。
+    # 作業量の見積もりが小さいものから処理し、短い動画が長い動画の後ろで待たされないようにする
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.pending_costs = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._worker, name=f"ingest-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.requeue_pending()
+        app.logger.info(f"取り込みパイプラインを開始しました: ワーカー数 {self.num_workers}")
+
+    def enqueue(self, post_id):
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("""
+                UPDATE videos
+                SET processing_status = 'pending', processed_path = NULL, processing_method = NULL,
+                    processing_error = NULL, processing_updated_at = ?
+                WHERE id = ?
+            """, (int(time.time()), post_id))
+            conn.commit()
+            c.execute("SELECT duration, width, height, start_time, end_time FROM videos WHERE id = ?", (post_id,))
+            row = c.fetchone()
+        finally:
+            conn.close()
+        content_selector.update(post_id, ready=False)
+        self._put(post_id, estimate_processing_cost(*row) if row else 0)
+        app.logger.info(f"動画の事前変換をキューに追加しました: 投稿ID {post_id}")
+
+    def requeue_pending(self):
+        # 未処理の行と、中断されたまま古くなった処理中の行を再投入する
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("""
+                UPDATE videos SET processing_status = 'pending'
+                WHERE processing_status IS NULL
+                   OR (processing_status = 'processing' AND processing_updated_at < ?)
+            """, (int(time.time()) - TRANSCODE_TIMEOUT,))
+            conn.commit()
+            c.execute("SELECT id, duration, width, height, start_time, end_time FROM videos WHERE processing_status = 'pending'")
+            rows = c.fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            self._put(row[0], estimate_processing_cost(*row[1:]))
+        if rows:
+            app.logger.info(f"未処理の動画を{len(rows)}件キューに再投入しました")
+
+    def _put(self, post_id, cost):
+        with self.lock:
+            self.pending_costs[post_id] = cost
+        self.queue.put((cost, next(self.sequence), post_id))
+
+    def backlog(self):
+        with self.lock:
+            return {'jobs': len(self.pending_costs), 'estimated_video_seconds': round(sum(self.pending_costs.values()), 1)}
+
+    def _worker(self):
+        while True:
+            cost, sequence, post_id = self.queue.get()
+            with self.lock:
+                self.pending_costs.pop(post_id, None)
+            try:
+                self._process(post_id)
+            except Exception as e:
+                app.logger.error(f"動画の事前変換中にエラーが発生しました: 投稿ID {post_id}, {str(e)}", exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    def _process(self, post_id):
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            # 他のワーカーやプロセスと重複しないよう、pendingの行だけを確保する
+            c.execute("UPDATE videos SET processing_status = 'processing', processing_updated_at = ? WHERE id = ? AND processing_status = 'pending'",
+                      (int(time.time()), post_id))
+            conn.commit()
+            if c.rowcount == 0:
+                return
+            c.execute("SELECT filename, start_time, end_time FROM videos WHERE id = ?", (post_id,))
+            filename, start_time, end_time = c.fetchone()
+        finally:
+            conn.close()
+
+        video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        app.logger.info(f"動画の事前変換を開始します: 投稿ID {post_id}, {video_path}")
+        try:
+            processed_path, method = transcode_executor.submit(video_path, start_time, end_time, group='ingest').result()
+        except Exception as e:
+            app.logger.error(f"動画の事前変換に失敗しました: 投稿ID {post_id}, {str(e)}")
+            self._finish(post_id, "processing_status = 'failed', processing_error = ?", (str(e),))
+            return
+
+        try:
+            # 変換中に投稿が更新された場合は結果を捨てる（新しいジョブが再投入されている）
+            if self._finish(post_id, "processing_status = 'ready', processed_path = ?, processing_method = ?", (processed_path, method)):
+                content_selector.update(post_id, ready=True)
+                app.logger.info(f"動画の事前変換が完了しました: 投稿ID {post_id}, {processed_path}, 処理方法: {method}")
+        finally:
+            processed_video_cache.release(processed_path)
+
+    def _finish(self, post_id, assignments, params):
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute(f"UPDATE videos SET {assignments}, processing_updated_at = ? WHERE id = ? AND processing_status = 'processing'",
+                      params + (int(time.time()), post_id))
+            conn.commit()
+            return c.rowcount > 0
+        finally:
+            conn.close()
+
+ingest_pipeline = IngestPipeline(TRANSCODE_WORKERS)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # Twitter API関連の設定
 MEDIA_ENDPOINT_URL = 'https://upload.twitter.com/1.1/media/upload.json'
 POST_TWEET_URL = 'https://api.twitter.com/2/tweets'
+USERS_ME_URL = 'https://api.twitter.com/2/users/me'
+MAX_ADDITIONAL_OWNERS = 100  # INITのadditional_ownersに指定できる上限
+UPLOAD_CHUNK_SIZE = 2 * 1024 * 1024  # 最初のチャンクサイズ（2MB）
+# 計測したスループットに合わせてチャンクサイズをこの範囲で調整する
+UPLOAD_CHUNK_MIN_SIZE = 1 * 1024 * 1024
+UPLOAD_CHUNK_MAX_SIZE = 5 * 1024 * 1024  # APPEND 1回あたりの上限
+UPLOAD_CHUNK_ALIGNMENT = 64 * 1024
+UPLOAD_TARGET_SEGMENT_SECONDS = 2.0
+UPLOAD_MAX_SEGMENTS = 1000  # segment_indexは0〜999
+UPLOAD_SESSION_DEFAULT_EXPIRY = 24 * 60 * 60  # INITがexpires_after_secsを返さない場合の有効期限
+UPLOAD_SESSION_RESUME_MARGIN = 10 * 60  # 期限切れが近いセッションは再開しない
+# メディア処理状態（STATUS）のポーリング設定
+MEDIA_STATUS_WORKERS = 4
+MEDIA_PROCESSING_TIMEOUT = 30 * 60  # 秒
+MEDIA_STATUS_ERROR_RETRY_SECS = 5
+ACCOUNT_MIN_SPACING_SECS = int(os.environ.get('ACCOUNT_MIN_SPACING_SECS', 60))  # 同じアカウントで投稿を始める最小間隔
+# リプライ予約の設定
+REPLY_DELAY_SECS = 10  # ツイートからリプライまでの待ち時間
+REPLY_MAX_ATTEMPTS = 5
+REPLY_RETRY_BASE_SECS = 30
+REPLY_SENDING_TIMEOUT = 5 * 60  # 送信中のまま残った予約をやり直すまでの時間
+UPLOAD_PARALLEL_SEGMENTS = int(os.environ.get('UPLOAD_PARALLEL_SEGMENTS', 4))  # 同時に送信するAPPENDの数
+# Keep-Aliveで使い回すHTTP接続プールの設定（同時APPEND数より小さくしない）
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = max(10, UPLOAD_PARALLEL_SEGMENTS)
+# レート制限の残り回数を使い切ったときに待つ上限（これを超える場合はそのまま送ってサーバーの応答に任せる）
+RATE_LIMIT_MAX_WAIT_SECS = 15 * 60
+
+class RateLimitBucket:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None  # ヘッダーを受け取るまでは不明（制限しない）
+        self.reset_at = 0
+
+class RateLimiter:
+    # アカウント・エンドポイントごとのトークンバケット。x-rate-limit-*ヘッダーで残り回数とリセット時刻を補正し、
+    # 使い切った場合はリセットまで送信を待たせる
+    def __init__(self):
+        self.buckets = {}
+        self.condition = threading.Condition()
+
+    def _take(self, key, started_at):
+        # 残り回数があれば1つ使って0を返し、なければ待つ秒数を返す（conditionを取得した状態で呼ぶ）
+        bucket = self.buckets.setdefault(key, RateLimitBucket())
+        now = time.time()
+        if bucket.remaining is not None and now >= bucket.reset_at:
+            # ウィンドウが切り替わったので上限まで補充する
+            bucket.remaining = bucket.limit
+        if bucket.remaining is None or bucket.remaining > 0:
+            if bucket.remaining is not None:
+                bucket.remaining -= 1
+            return 0
+        return max(0, min(bucket.reset_at, started_at + RATE_LIMIT_MAX_WAIT_SECS) - now)
+
+    def _log_wait(self, key, wait_secs):
+        app.logger.warning(f"レート制限の残り回数がないため{int(wait_secs)}秒待機します: {key[1]} {key[2]} (アカウントID {key[0]})")
+
+    def _record_wait(self, key, started_at):
+        metrics.inc('xpost_rate_limit_waits_total', account_id=key[0], endpoint=key[2])
+        metrics.observe('xpost_stage_seconds', time.time() - started_at, stage='rate_limit_wait', account_id=key[0])
+
+    def acquire(self, key):
+        started_at = time.time()
+        waited = False
+        with self.condition:
+            while True:
+                wait_secs = self._take(key, started_at)
+                if wait_secs <= 0:
+                    break
+                if not waited:
+                    waited = True
+                    self._log_wait(key, wait_secs)
+                self.condition.wait(wait_secs)
+        if waited:
+            self._record_wait(key, started_at)
+
+    async def acquire_async(self, key):
+        # イベントループ上の送信用。スレッドを止めずにリセットまで眠る
+        started_at = time.time()
+        waited = False
+        while True:
+            with self.condition:
+                wait_secs = self._take(key, started_at)
+            if wait_secs <= 0:
+                break
+            if not waited:
+                waited = True
+                self._log_wait(key, wait_secs)
+            await asyncio.sleep(wait_secs)
+        if waited:
+            self._record_wait(key, started_at)
+
+    def update(self, key, headers, status_code):
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        with self.condition:
+            bucket = self.buckets.setdefault(key, RateLimitBucket())
+            if remaining is not None and reset is not None:
+                try:
+                    bucket.remaining = int(remaining)
+                    bucket.reset_at = int(reset)
+                    bucket.limit = int(headers.get('x-rate-limit-limit') or max(bucket.limit or 0, bucket.remaining))
+                except ValueError:
+                    return
+            elif status_code == 429:
+                # ヘッダーがない429はRetry-After（なければ1分）まで使い切ったものとみなす
+                retry_after = headers.get('retry-after')
+                bucket.remaining = 0
+                bucket.reset_at = time.time() + (int(retry_after) if retry_after and retry_after.isdigit() else 60)
+            else:
+                return
+            self.condition.notify_all()
+
+    def snapshot(self):
+        with self.condition:
+            return [(key, bucket.remaining, bucket.reset_at) for key, bucket in self.buckets.items() if bucket.remaining is not None]
+
+rate_limiter = RateLimiter()
+
+class RateLimitedAdapter(HTTPAdapter):
+    # アカウントのセッションに差し込み、送信前に残り回数を確認してレスポンスのヘッダーで補充する
+    def __init__(self, account_id, **kwargs):
+        super().__init__(**kwargs)
+        self.account_id = account_id
+
+    def send(self, request, **kwargs):
+        key = (self.account_id, request.method, urllib.parse.urlsplit(request.url).path)
+        rate_limiter.acquire(key)
+        response = super().send(request, **kwargs)
+        rate_limiter.update(key, response.headers, response.status_code)
+        return response
+
+# 外部APIへのリクエストのリトライとサーキットブレーカーの設定
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY_SECS = 1
+RETRY_MAX_DELAY_SECS = 60
+RETRY_MAX_WAIT_SECS = 15 * 60  # Retry-Afterやリセットまでの時間がこれより長い場合は待たずに失敗する
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+ACCOUNT_FAILURE_STATUS_CODES = {401, 403}  # リクエストではなくアカウント側の問題を示すもの
+CIRCUIT_FAILURE_THRESHOLD = 5  # 連続してこの回数失敗したアカウントは送信を止める
+CIRCUIT_OPEN_SECS = 5 * 60
+
+class CircuitOpenError(RequestException):
+    pass
+
+class CircuitBreaker:
+    # アカウントごとに連続した失敗を数え、しきい値を超えたら一定時間そのアカウントのリクエストを止める。
+    # 時間が経ったら1件だけ試し、成功すれば再開する。失敗はリトライを含めたリクエスト1件ごとに数える
+    def __init__(self, threshold, open_secs):
+        self.threshold = threshold
+        self.open_secs = open_secs
+        self.failures = {}
+        self.open_until = {}
+        self.probing = set()
+        self.lock = threading.Lock()
+
+    def check(self, account_id):
+        # 送信してよければ、この呼び出しが試しの1件を受け持つかどうかを返す
+        if account_id is None:
+            return False
+        with self.lock:
+            open_until = self.open_until.get(account_id)
+            if open_until is None:
+                return False
+            if time.time() < open_until or account_id in self.probing:
+                raise CircuitOpenError(f"アカウントID {account_id}は失敗が続いたため一時的に送信を停止しています")
+            self.probing.add(account_id)
+            return True
+
+    def release_probe(self, account_id):
+        # 成功・失敗のどちらにも数えない結果（400など）や中断で試しの1件が終わった場合も、次の呼び出しが試せるようにする
+        with self.lock:
+            self.probing.discard(account_id)
+
+    def record_success(self, account_id):
+        if account_id is None:
+            return
+        with self.lock:
+            self.failures.pop(account_id, None)
+            self.probing.discard(account_id)
+            if self.open_until.pop(account_id, None) is not None:
+                app.logger.info(f"アカウントID {account_id}の送信を再開しました")
+
+    def record_failure(self, account_id):
+        if account_id is None:
+            return
+        with self.lock:
+            self.probing.discard(account_id)
+            failures = self.failures.get(account_id, 0) + 1
+            self.failures[account_id] = failures
+            if failures >= self.threshold:
+                self.open_until[account_id] = time.time() + self.open_secs
+                app.logger.error(f"アカウントID {account_id}で失敗が{failures}回続いたため{self.open_secs}秒間送信を停止します")
+                metrics.inc('xpost_circuit_open_total', account_id=account_id)
+
+    def open_accounts(self):
+        with self.lock:
+            return [account_id for account_id, open_until in self.open_until.items() if open_until > time.time()]
+
+circuit_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECS)
+
+class RetryPolicy:
+    # レスポンスを成功・リトライ可能・リトライ不可に分け、リトライ可能なものだけを
+    # Retry-After・レート制限のリセット時刻・ジッター付き指数バックオフの順で決めた時間だけ待って再送する
+    def __init__(self, max_attempts, base_delay, max_delay, breaker):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+
+    def classify(self, response=None, error=None, idempotent=True):
+        # (判定, 待ち時間の指定)を返す。判定は ok / retry / fatal
+        if error is not None:
+            # requestsのHTTPErrorはレスポンスを持っているのでステータスコードで判定する
+            response = getattr(error, 'response', None)
+            if response is None:
+                # 送信後のタイムアウトは相手に届いている可能性があるため、冪等でないリクエストは再送しない
+                if isinstance(error, requests.exceptions.ConnectionError) or (idempotent and isinstance(error, RequestException)):
+                    return 'retry', None
+                return 'fatal', None
+        if response.status_code < 400:
+            return 'ok', None
+        if response.status_code not in RETRYABLE_STATUS_CODES:
+            return 'fatal', None
+        # 5xxは処理済みの可能性があるため、冪等でないリクエストはRetry-Afterの付いた503（受け付けていない）だけを再送する
+        if not idempotent and response.status_code >= 500 and not (
+                response.status_code == 503 and response.headers.get('retry-after')):
+            return 'fatal', None
+        return 'retry', self._server_delay(response)
+
+    def _server_delay(self, response):
+        retry_after = response.headers.get('retry-after')
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        reset = response.headers.get('x-rate-limit-reset')
+        if response.status_code == 429 and reset and reset.isdigit():
+            return max(0, int(reset) - time.time()) + 1
+        return None
+
+    def backoff(self, attempt):
+        # フルジッター：上限を指数的に伸ばし、その範囲で一様に選ぶ
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def is_fatal(self, error):
+        # 呼び出し元で再試行しても無駄なエラーかどうか
+        return isinstance(error, CircuitOpenError) or self.classify(error=error)[0] == 'fatal'
+
+    def _next_delay(self, attempt, result, error, account_id, stage, idempotent):
+        # 1回分の結果を判定し、再送するまでの秒数を返す。再送しない場合はNone
+        response = result if getattr(result, 'status_code', None) is not None else None
+        if error is not None:
+            verdict, delay = self.classify(error=error, idempotent=idempotent)
+        elif response is not None:
+            verdict, delay = self.classify(response=response, idempotent=idempotent)
+        else:
+            verdict, delay = 'ok', None
+        status_code = getattr(response if error is None else getattr(error, 'response', None), 'status_code', None)
+
+        if verdict == 'ok':
+            self.breaker.record_success(account_id)
+            return None
+        if verdict == 'retry' and attempt < self.max_attempts:
+            delay = self.backoff(attempt) if delay is None else delay
+            if delay <= RETRY_MAX_WAIT_SECS:
+                reason = str(error) if error is not None else f"ステータスコード {status_code}"
+                app.logger.warning(f"{stage}: {reason} のため{delay:.1f}秒後にリトライします ({attempt}/{self.max_attempts})")
+                metrics.inc('xpost_retries_total', stage=stage, account_id=account_id or '')
+                return delay
+            app.logger.error(f"{stage}: 再送まで{int(delay)}秒かかるためリトライしません")
+        # このリクエストは失敗で終わる。リトライを使い切ったものとアカウント側の問題を示すものだけを数える
+        if verdict == 'retry' or status_code in ACCOUNT_FAILURE_STATUS_CODES:
+            self.breaker.record_failure(account_id)
+        return None
+
+    def call(self, send, account_id=None, stage='', idempotent=True):
+        # sendはrequestsのResponseを返すか、例外を送出する関数。
+        # 最後のレスポンスはそのまま返し、例外は最後のものを送出する
+        probe = self.breaker.check(account_id)
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                result = error = None
+                try:
+                    result = send()
+                except Exception as e:
+                    error = e
+                delay = self._next_delay(attempt, result, error, account_id, stage, idempotent)
+                if delay is None:
+                    if error is not None:
+                        raise error
+                    return result
+                time.sleep(delay)
+                # 試しの1件を受け持っている場合は、自分のリトライで止められないよう確認しない
+                if not probe:
+                    probe = self.breaker.check(account_id)
+        finally:
+            if probe:
+                self.breaker.release_probe(account_id)
+
+    async def call_async(self, send, account_id=None, stage='', idempotent=True):
+        # callのイベントループ版。sendはレスポンスを返すコルーチン関数
+        probe = self.breaker.check(account_id)
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                result = error = None
+                try:
+                    result = await send()
+                except Exception as e:
+                    error = e
+                delay = self._next_delay(attempt, result, error, account_id, stage, idempotent)
+                if delay is None:
+                    if error is not None:
+                        raise error
+                    return result
+                await asyncio.sleep(delay)
+                # 試しの1件を受け持っている場合は、自分のリトライで止められないよう確認しない
+                if not probe:
+                    probe = self.breaker.check(account_id)
+        finally:
+            if probe:
+                self.breaker.release_probe(account_id)
+
+retry_policy = RetryPolicy(RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY_SECS, RETRY_MAX_DELAY_SECS, circuit_breaker)
+
+class MediaStatusPoller:
+    # 処理中のmedia_idをまとめて管理し、check_after_secsが来たものだけSTATUSを問い合わせる
+    def __init__(self, max_workers):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='media-status')
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='media-status-poller', daemon=True)
+                self.thread.start()
+
+    def watch(self, video_tweet):
+        # 処理が完了したらTrue、失敗・タイムアウトならFalseになるFutureを返す
+        future = Future()
+        deadline = time.time() + MEDIA_PROCESSING_TIMEOUT
+        started_at = time.perf_counter()
+        future.add_done_callback(lambda f: metrics.observe('xpost_stage_seconds', time.perf_counter() - started_at,
+                                                           stage='media_processing', account_id=video_tweet.account_id or ''))
+        if not self._resolve(video_tweet, future):
+            self._schedule(video_tweet, future, deadline, video_tweet.processing_info['check_after_secs'])
+        return future
+
+    def pending_count(self):
+        with self.condition:
+            return len(self.heap)
+
+    def _resolve(self, video_tweet, future):
+        result = video_tweet.processing_result()
+        if result is None:
+            return False
+        future.set_result(result)
+        return True
+
+    def _schedule(self, video_tweet, future, deadline, delay):
+        due = time.time() + delay
+        if due > deadline:
+            app.logger.error(f'メディア処理が{MEDIA_PROCESSING_TIMEOUT}秒以内に完了しませんでした: Media ID {video_tweet.media_id}')
+            future.set_result(False)
+            return
+        app.logger.info(f'{delay} 秒後に再チェックします (Media ID: {video_tweet.media_id})')
+        self.start()
+        with self.condition:
+            heapq.heappush(self.heap, (due, next(self.counter), video_tweet, future, deadline))
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    timeout = self.heap[0][0] - time.time() if self.heap else None
+                    self.condition.wait(timeout)
+                due, _, video_tweet, future, deadline = heapq.heappop(self.heap)
+            self.executor.submit(self._poll, video_tweet, future, deadline)
+
+    def _poll(self, video_tweet, future, deadline):
+        try:
+            run_steps(video_tweet.fetch_status_steps())
+        except Exception as e:
+            app.logger.error(f"ステータスチェック中にエラーが発生しました: Media ID {video_tweet.media_id}, {str(e)}")
+            if retry_policy.is_fatal(e):
+                future.set_result(False)
+                return
+            metrics.inc('xpost_retries_total', stage='status_check', account_id=video_tweet.account_id or '')
+            self._schedule(video_tweet, future, deadline, MEDIA_STATUS_ERROR_RETRY_SECS)
+            return
+        if not self._resolve(video_tweet, future):
+            self._schedule(video_tweet, future, deadline, video_tweet.processing_info['check_after_secs'])
+
+media_status_poller = MediaStatusPoller(MEDIA_STATUS_WORKERS)
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+class UploadSessionStore:
+    # アップロードセッション（media_idと確認済みセグメント）をvideos.dbに保存する
+    def find(self, file_hash, account_id, additional_owners):
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            now = int(time.time())
+            c.execute("DELETE FROM upload_segments WHERE session_id IN (SELECT id FROM upload_sessions WHERE expires_at < ?)", (now,))
+            c.execute("DELETE FROM upload_sessions WHERE expires_at < ?", (now,))
+            conn.commit()
+            c.execute("""
+                SELECT id, media_id, total_bytes, chunk_size, finalized, expires_at FROM upload_sessions
+                WHERE file_hash = ? AND account_id = ? AND additional_owners = ?
+            """, (file_hash, account_id, additional_owners))
+            row = c.fetchone()
+            if row is None:
+                return None
+            c.execute("SELECT segment_index, byte_offset, length, confirmed FROM upload_segments WHERE session_id = ? ORDER BY segment_index",
+                      (row[0],))
+            segments = [(index, offset, length, bool(confirmed)) for index, offset, length, confirmed in c.fetchall()]
+        finally:
+            conn.close()
+        return {
+            'id': row[0], 'media_id': row[1], 'total_bytes': row[2], 'chunk_size': row[3],
+            'finalized': bool(row[4]), 'expires_at': row[5], 'segments': segments
+        }
+
+    def create(self, file_hash, account_id, additional_owners, media_id, total_bytes, chunk_size, expires_at):
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("DELETE FROM upload_segments WHERE session_id IN (SELECT id FROM upload_sessions WHERE file_hash = ? AND account_id = ? AND additional_owners = ?)",
+                      (file_hash, account_id, additional_owners))
+            c.execute("""
+                INSERT OR REPLACE INTO upload_sessions
+                (file_hash, account_id, additional_owners, media_id, total_bytes, chunk_size, expires_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (file_hash, account_id, additional_owners, str(media_id), total_bytes, chunk_size, expires_at, int(time.time())))
+            conn.commit()
+            return c.lastrowid
+        finally:
+            conn.close()
+
+    def plan_segment(self, session_id, segment_index, offset, length):
+        conn = get_db()
+        try:
+            conn.execute("INSERT OR REPLACE INTO upload_segments (session_id, segment_index, byte_offset, length, confirmed) VALUES (?, ?, ?, ?, 0)",
+                         (session_id, segment_index, offset, length))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def confirm_segment(self, session_id, segment_index, chunk_size):
+        conn = get_db()
+        try:
+            conn.execute("UPDATE upload_segments SET confirmed = 1 WHERE session_id = ? AND segment_index = ?", (session_id, segment_index))
+            conn.execute("UPDATE upload_sessions SET chunk_size = ?, updated_at = ? WHERE id = ?", (chunk_size, int(time.time()), session_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def mark_finalized(self, session_id):
+        conn = get_db()
+        try:
+            conn.execute("UPDATE upload_sessions SET finalized = 1, updated_at = ? WHERE id = ?", (int(time.time()), session_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, session_id):
+        conn = get_db()
+        try:
+            conn.execute("DELETE FROM upload_segments WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+upload_session_store = UploadSessionStore()
+
+class MultipartChunkBody:
+    # APPENDのmultipartボディ。チャンク本体はmemoryviewのままコピーせずに送る
+    def __init__(self, fields, chunk):
+        boundary = uuid.uuid4().hex
+        head = ''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                       for name, value in fields.items())
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="media"; filename="media"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n')
+        tail = f'\r\n--{boundary}--\r\n'
+        self.parts = [memoryview(head.encode()), chunk, memoryview(tail.encode())]
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.length = sum(len(part) for part in self.parts)
+        self.part_index = 0
+        self.part_offset = 0
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        while self.part_index < len(self.parts):
+            part = self.parts[self.part_index]
+            if self.part_offset < len(part):
+                end = len(part) if size is None or size < 0 else min(len(part), self.part_offset + size)
+                data = part[self.part_offset:end]
+                self.part_offset = end
+                return data
+            self.part_index += 1
+            self.part_offset = 0
+        return b''
+
+# 投稿の手順（アップロード・ツイート作成など）はステップをyieldするジェネレーターとして1か所にだけ書き、
+# run_steps（呼び出し元のスレッド）とAsyncPostingEngine.run_steps（イベントループ）のどちらでも同じ手順を実行する
+
+class HttpStep:
+    # 1回分のAPIリクエスト。スレッドではrequests、イベントループではaiohttpで送り、どちらもretry_policyを通す
+    def __init__(self, http, oauth, account_id, method, url, stage, params=None, form=None, json_body=None, multipart=None,
+                 idempotent=True, timeout=60):
+        self.http = http
+        self.oauth = oauth
+        self.account_id = account_id
+        self.method = method
+        self.url = url
+        self.stage = stage
+        self.params = params
+        self.form = form
+        self.json_body = json_body
+        self.multipart = multipart  # (フィールド, チャンク)。送り直すたびにMultipartChunkBodyを作る
+        self.idempotent = idempotent
+        self.timeout = timeout
+
+    def run(self):
+        def send():
+            data, headers = self.form, None
+            if self.multipart is not None:
+                body = MultipartChunkBody(*self.multipart)
+                data, headers = body, {'Content-Type': body.content_type}
+            return self.http.request(self.method, self.url, params=self.params, data=data, json=self.json_body, headers=headers,
+                                     auth=self.oauth, timeout=self.timeout)
+
+        return retry_policy.call(send, self.account_id, self.stage, self.idempotent)
+
+    async def run_async(self, engine):
+        return await engine.request(self)
+
+class CallStep:
+    # DB操作などのブロッキングする呼び出し。イベントループではスレッドプールで実行する
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def run(self):
+        return self.func(*self.args)
+
+    async def run_async(self, engine):
+        return await asyncio.to_thread(self.func, *self.args)
+
+class NotifyStep(CallStep):
+    # ダッシュボードやアクティビティログへの通知。イベントループでは完了を待たずに通知用のスレッドへ渡す
+    async def run_async(self, engine):
+        engine.notify(self.func, *self.args)
+
+class WaitStep:
+    # 動画変換やメディア処理の完了を表すconcurrent.futures.Futureを待って結果を返す
+    def __init__(self, future):
+        self.future = future
+
+    def run(self):
+        return self.future.result()
+
+    async def run_async(self, engine):
+        return await asyncio.wrap_future(self.future)
+
+class ParallelStep:
+    # 手順をlimit件まで同時に進め、戻り値の一覧を返す。abort_eventが立ったら新しい手順は始めない。
+    # 手順は送れる枠が空いてから1つずつ取り出す（APPENDのチャンクサイズを直前までの転送速度で決めるため）
+    def __init__(self, tasks, limit, abort_event):
+        self.tasks = tasks
+        self.limit = limit
+        self.abort_event = abort_event
+
+    def run(self):
+        results = []
+        with ThreadPoolExecutor(max_workers=self.limit) as executor:
+            in_flight = set()
+            while not self.abort_event.is_set():
+                if len(in_flight) >= self.limit:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    results.extend(future.result() for future in done)
+                    continue
+                steps = next(self.tasks, None)
+                if steps is None:
+                    break
+                in_flight.add(executor.submit(run_steps, steps))
+            done, _ = wait(in_flight)
+            results.extend(future.result() for future in done)
+        return results
+
+    async def run_async(self, engine):
+        results = []
+        in_flight = set()
+        try:
+            while not self.abort_event.is_set():
+                if len(in_flight) >= self.limit:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    results.extend(task.result() for task in done)
+                    continue
+                steps = next(self.tasks, None)
+                if steps is None:
+                    break
+                in_flight.add(asyncio.ensure_future(engine.run_steps(steps)))
+            if in_flight:
+                done, in_flight = await asyncio.wait(in_flight)
+                results.extend(task.result() for task in done)
+        finally:
+            # 途中で止められた場合も、送信中のチャンクを手放してから戻る
+            for task in in_flight:
+                task.cancel()
+            if in_flight:
+                await asyncio.wait(in_flight)
+        return results
+
+def run_steps(steps):
+    # 手順を呼び出し元のスレッドで実行し、戻り値を返す。ステップで起きた例外は手順の中に送り返す
+    send, value = steps.send, None
+    while True:
+        try:
+            step = send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, send = step.run(), steps.send
+        except Exception as e:
+            value, send = e, steps.throw
+
+def start_steps(steps, name, on_suspend=None, on_resume=None):
+    # 手順を新しいスレッドで実行する。WaitStepのFutureが未完了ならスレッドを終えてon_suspendを呼び、
+    # Futureが完了したら別のスレッドでon_resumeを呼んでから続きを進める（処理待ちの間はスレッドも枠も使わない）
+    def advance(send, value):
+        while True:
+            try:
+                step = send(value)
+            except StopIteration:
+                return
+            if isinstance(step, WaitStep) and not step.future.done():
+                if on_suspend:
+                    on_suspend()
+                step.future.add_done_callback(
+                    lambda future: threading.Thread(target=resume, args=(future,), name=name, daemon=True).start())
+                return
+            try:
+                value, send = step.run(), steps.send
+            except Exception as e:
+                value, send = e, steps.throw
+
+    def resume(future):
+        if on_resume:
+            on_resume()
+        try:
+            value, send = future.result(), steps.send
+        except Exception as e:
+            value, send = e, steps.throw
+        advance(send, value)
+
+    threading.Thread(target=advance, args=(steps.send, None), name=name, daemon=True).start()
 
 class VideoTweet:
-    def __init__(self, file_name, oauth):
+    # メディアのアップロード（INIT・APPEND・FINALIZE・STATUS）とツイート作成。*_stepsのメソッドは手順を返すので、
+    # run_stepsかAsyncPostingEngine.run_stepsで実行する
+    def __init__(self, file_name, oauth, additional_owners=None, parallel_segments=UPLOAD_PARALLEL_SEGMENTS, session=None, account_id=None):
         self.video_filename = file_name
         self.total_bytes = os.path.getsize(self.video_filename)
         self.media_id = None
         self.processing_info = None
         self.oauth = oauth
+        # セッションが渡された場合はKeep-Alive接続を使い回す
+        self.http = session or requests
+        self.additional_owners = additional_owners or []
+        self.parallel_segments = max(1, parallel_segments)
+        self.segment_status = {}
+        self.bytes_sent = 0
+        self.chunk_size = UPLOAD_CHUNK_SIZE
+        self.segment_throughput = None  # 1セグメントあたりのバイト/秒（指数移動平均）
+        self.progress_lock = threading.Lock()
+        # アカウントIDが分かる場合はアップロードセッションを保存して再開できるようにする
+        self.account_id = account_id
+        self.upload_session_id = None
+        self.resumed = False
+        self.resumed_segments = []
+        self.finalized = False
+        self.last_append_status = None
         self.upload_start_time = None
         app.logger.info(f"VideoTweetインスタンスを初期化: ファイル名={file_name}, サイズ={self.total_bytes}バイト")
 
-    def upload_init(self):
-        app.logger.info('INITリクエストを開始')
+    def request(self, method, stage, params=None, form=None, multipart=None, timeout=60):
+        return HttpStep(self.http, self.oauth, self.account_id, method, MEDIA_ENDPOINT_URL, stage,
+                        params=params, form=form, multipart=multipart, timeout=timeout)
+
+    def upload_init_steps(self):
+        with metrics.timer('xpost_stage_seconds', stage='upload_init', account_id=self.account_id or ''):
+            owners_key = ','.join(str(owner) for owner in self.additional_owners)
+            if self.account_id is not None:
+                file_hash = yield CallStep(processed_video_cache.file_hash, self.video_filename)
+                saved = yield CallStep(upload_session_store.find, file_hash, self.account_id, owners_key)
+                if self.resume_from(saved):
+                    return True
+
+            app.logger.info('INITリクエストを開始')
+            req = yield self.request('POST', 'upload_init', form=self.init_request_data(owners_key))
+            if req.status_code != 202:
+                app.logger.error(f"INITリクエストが失敗しました: {req.status_code}")
+                return False
+            response = req.json()
+            media_id = response['media_id']
+            self.media_id = media_id
+            self.upload_start_time = time.time()
+            app.logger.info(f'Media ID: {str(media_id)}')
+
+            if self.account_id is not None:
+                expires_at = int(time.time()) + response.get('expires_after_secs', UPLOAD_SESSION_DEFAULT_EXPIRY)
+                self.upload_session_id = yield CallStep(upload_session_store.create, file_hash, self.account_id, owners_key,
+                                                        media_id, self.total_bytes, self.chunk_size, expires_at)
+            return True
+
+    def resume_from(self, saved):
+        # 保存済みのセッションがまだ使える場合は、その状態に戻してTrueを返す
+        if not (saved and saved['total_bytes'] == self.total_bytes
+                and saved['expires_at'] - time.time() > UPLOAD_SESSION_RESUME_MARGIN):
+            return False
+        self.media_id = saved['media_id']
+        self.upload_session_id = saved['id']
+        self.chunk_size = saved['chunk_size']
+        self.resumed_segments = saved['segments']
+        self.finalized = saved['finalized']
+        self.resumed = True
+        self.upload_start_time = time.time()
+        confirmed_count = sum(1 for segment in self.resumed_segments if segment[3])
+        app.logger.info(f'保存済みのアップロードを再開します: Media ID {self.media_id}, 確認済みセグメント {confirmed_count}件')
+        return True
+
+    def init_request_data(self, owners_key):
         request_data = {
             'command': 'INIT',
             'media_type': 'video/mp4',
             'total_bytes': self.total_bytes,
             'media_category': 'tweet_video'
         }
-        req = requests.post(url=MEDIA_ENDPOINT_URL, data=request_data, auth=self.oauth)
-        media_id = req.json()['media_id']
-        self.media_id = media_id
-        self.upload_start_time = time.time()
-        app.logger.info(f'Media ID: {str(media_id)}')
-        return req
+        if self.additional_owners:
+            # 他のアカウントも同じmedia_idでツイートできるようにする
+            request_data['additional_owners'] = owners_key
+        return request_data
+
+    def discard_upload_session(self):
+        if self.upload_session_id is not None:
+            upload_session_store.delete(self.upload_session_id)
+        self.upload_session_id = None
+        self.resumed = False
+        self.resumed_segments = []
+        self.finalized = False
+
+    def chunk_result(self, req, chunk, segment_id):
+        if req.status_code in [200, 204]:  # 200と204の両方を成功として扱う
+            app.logger.info(f'APPEND: チャンク {segment_id + 1} アップロード成功')
+            metrics.inc('xpost_upload_bytes_total', len(chunk), account_id=self.account_id or '')
+            return segment_id
+        app.logger.error(f"APPENDリクエスト中にエラーが発生: ステータスコード {req.status_code}, レスポンス {req.text}")
+        return None
+
+    def upload_append_steps(self):
+        with metrics.timer('xpost_stage_seconds', stage='upload_append', account_id=self.account_id or ''):
+            app.logger.info(f'APPENDリクエストを開始 (同時送信数: {self.parallel_segments})')
+            if self.total_bytes == 0:
+                app.logger.error("アップロードするファイルが空です")
+                return False
+            self.segment_status = {}
+            self.bytes_sent = 0
+            abort_event = threading.Event()
+            confirmed = set()
+
+            # ファイルはメモリマップし、各セグメントはmemoryviewのスライスとして送る
+            with open(self.video_filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    tasks = (self.upload_segment_steps(view, segment, abort_event) for segment in self.plan_segments(confirmed))
+                    confirmed.update((yield ParallelStep(tasks, self.parallel_segments, abort_event)))
+                finally:
+                    view.release()
+
+            return self.check_segments(confirmed, abort_event)
+
+    def plan_segments(self, confirmed):
+        # 送るセグメントを(インデックス, 位置, 長さ, 新しく割り当てたか)の形で1つずつ返す。
+        # 再開時は確認済みのセグメントを飛ばし、未確認のものは同じインデックスと範囲で送り直す
+        retry_segments = []
+        offset = 0
+        segment_id = 0
+        for index, segment_offset, length, segment_confirmed in self.resumed_segments:
+            if segment_confirmed:
+                self.segment_status[index] = 'done'
+                self.bytes_sent += length
+                confirmed.add(index)
+            else:
+                self.segment_status[index] = 'pending'
+                retry_segments.append((index, segment_offset, length))
+            offset = max(offset, segment_offset + length)
+            segment_id = max(segment_id, index + 1)
+        for index, segment_offset, length in retry_segments:
+            yield index, segment_offset, length, False
+        while offset < self.total_bytes:
+            # セグメントはどの順番で届いてもよいが、インデックスはファイル内の位置の順に振る
+            # （サイズは直前までの転送速度で決めるため、送れる枠が空いてから取り出す）
+            length = self.next_chunk_size(self.total_bytes - offset, segment_id)
+            with self.progress_lock:
+                self.segment_status[segment_id] = 'pending'
+            yield segment_id, offset, length, True
+            offset += length
+            segment_id += 1
+
+    def check_segments(self, confirmed, abort_event):
+        # すべてのセグメントの成功が確認できた場合だけFINALIZEに進む
+        confirmed.discard(None)
+        if abort_event.is_set() or len(confirmed) != len(self.segment_status):
+            missing = sorted(set(self.segment_status) - confirmed)
+            app.logger.error(f"チャンク {[segment_id + 1 for segment_id in missing]} のアップロードに失敗しました。アップロードを中止します。")
+            return False
+
+        app.logger.info(f'アップロードチャンクが完了しました ({len(confirmed)}セグメント)')
+        return True
 
-    def upload_chunk(self, chunk, segment_id):
-        max_retries = 5
-        retry_delay = 10
+    def next_chunk_size(self, remaining_bytes, segment_id):
+        # 1セグメントが目標時間で送れるサイズにし、セグメント数の上限も超えないようにする
+        with self.progress_lock:
+            if self.segment_throughput:
+                target = int(self.segment_throughput * UPLOAD_TARGET_SEGMENT_SECONDS)
+                target -= target % UPLOAD_CHUNK_ALIGNMENT
+                self.chunk_size = min(max(target, UPLOAD_CHUNK_MIN_SIZE), UPLOAD_CHUNK_MAX_SIZE)
+            chunk_size = self.chunk_size
+        remaining_segments = max(1, UPLOAD_MAX_SEGMENTS - segment_id)
+        chunk_size = max(chunk_size, -(-remaining_bytes // remaining_segments))
+        return min(chunk_size, remaining_bytes)
 
-        for attempt in range(max_retries):
+    def upload_segment_steps(self, view, segment, abort_event):
+        # 1セグメント分のAPPEND。成功したらセグメントのインデックスを返す
+        segment_id, segment_offset, length, planned = segment
+        if abort_event.is_set():
+            return None
+        if planned and self.upload_session_id is not None:
+            yield CallStep(upload_session_store.plan_segment, self.upload_session_id, segment_id, segment_offset, length)
+        # スライスは送る直前に作り、送り終えたらすぐに手放す
+        chunk = view[segment_offset:segment_offset + length]
+        try:
+            with self.progress_lock:
+                self.segment_status[segment_id] = 'uploading'
+            app.logger.info(f'チャンク {segment_id + 1} のアップロードを開始 (サイズ: {length} バイト)')
+            started_at = time.time()
+            fields = {'command': 'APPEND', 'media_id': self.media_id, 'segment_index': segment_id}
             try:
-                request_data = {
-                    'command': 'APPEND',
-                    'media_id': self.media_id,
-                    'segment_index': segment_id
-                }
-                files = {
-                    'media': chunk
-                }
-                app.logger.debug(f'APPEND: チャンク {segment_id + 1} リクエスト送信')
-                req = requests.post(url=MEDIA_ENDPOINT_URL, data=request_data, files=files, auth=self.oauth, timeout=60)
+                with metrics.timer('xpost_stage_seconds', stage='upload_chunk', account_id=self.account_id or ''):
+                    req = yield self.request('POST', 'upload_chunk', multipart=(fields, chunk))
                 app.logger.debug(f'APPEND: チャンク {segment_id + 1} レスポンス受信: ステータスコード {req.status_code}')
-                
-                if req.status_code in [200, 204]:  # 200と204の両方を成功として扱う
-                    app.logger.info(f'APPEND: チャンク {segment_id + 1} アップロード成功')
-                    return segment_id
-                else:
-                    app.logger.error(f"APPENDリクエスト中にエラーが発生: ステータスコード {req.status_code}, レスポンス {req.text}")
-                    if attempt < max_retries - 1:
-                        app.logger.info(f"チャンク {segment_id + 1}: {retry_delay}秒後にリトライします...")
-                        time.sleep(retry_delay)
-                    else:
-                        app.logger.error(f"チャンク {segment_id + 1}: 最大リトライ回数に達しました。")
-                        return None
+                self.last_append_status = req.status_code
+                result = self.chunk_result(req, chunk, segment_id)
             except RequestException as e:
                 app.logger.error(f"チャンク {segment_id + 1} リクエスト中にエラーが発生しました: {str(e)}")
-                if attempt < max_retries - 1:
-                    app.logger.info(f"チャンク {segment_id + 1}: {retry_delay}秒後にリトライします...")
-                    time.sleep(retry_delay)
-                else:
-                    app.logger.error(f"チャンク {segment_id + 1}: 最大リトライ回数に達しました。")
-                    return None
-        return None
+                result = None
+            elapsed = time.time() - started_at
+        finally:
+            chunk.release()
 
-    def upload_append(self):
-        app.logger.info('APPENDリクエストを開始')
-        segment_id = 0
-        bytes_sent = 0
-        
-        with open(self.video_filename, 'rb') as file:
-            while bytes_sent < self.total_bytes:
-                chunk = file.read(2*1024*1024)  # 2MBチャンク
-                if not chunk:
-                    break
-                
-                app.logger.info(f'チャンク {segment_id + 1} のアップロードを開始 (サイズ: {len(chunk)} バイト)')
-                result = self.upload_chunk(chunk, segment_id)
-                
-                if result is not None:
-                    bytes_sent += len(chunk)
-                    app.logger.info(f'チャンク {segment_id + 1} のアップロードが成功 (合計: {bytes_sent} バイト)')
-                    
-                    if bytes_sent % (10 * 1024 * 1024) == 0 or bytes_sent == self.total_bytes:
-                        app.logger.info(f'{bytes_sent} / {self.total_bytes} バイトアップロード完了 ({bytes_sent/self.total_bytes*100:.2f}%)')
-                else:
-                    app.logger.error(f"チャンク {segment_id + 1} のアップロードに失敗しました。アップロードを中止します。")
-                    return False
-                
-                segment_id += 1
+        if not self.segment_finished(segment_id, length, elapsed, result):
+            abort_event.set()
+            return None
+        if self.upload_session_id is not None:
+            yield CallStep(upload_session_store.confirm_segment, self.upload_session_id, segment_id, self.chunk_size)
+        return segment_id
 
-        app.logger.info('アップロードチャンクが完了しました')
+    def segment_finished(self, segment_id, length, elapsed, result):
+        # 結果を進捗と転送速度に反映する。失敗した場合はFalseを返す
+        with self.progress_lock:
+            if result is None:
+                self.segment_status[segment_id] = 'failed'
+                return False
+            self.segment_status[segment_id] = 'done'
+            throughput = length / max(elapsed, 0.001)
+            if self.segment_throughput is None:
+                self.segment_throughput = throughput
+            else:
+                self.segment_throughput = 0.7 * self.segment_throughput + 0.3 * throughput
+            previous_bytes = self.bytes_sent
+            self.bytes_sent += length
+            bytes_sent = self.bytes_sent
+        app.logger.info(f'チャンク {segment_id + 1} のアップロードが成功 (合計: {bytes_sent} バイト, {throughput / 1024 / 1024:.2f}MB/秒)')
+        if bytes_sent // (10 * 1024 * 1024) != previous_bytes // (10 * 1024 * 1024) or bytes_sent == self.total_bytes:
+            app.logger.info(f'{bytes_sent} / {self.total_bytes} バイトアップロード完了 ({bytes_sent/self.total_bytes*100:.2f}%)')
         return True
-    
-    def upload_finalize(self):
+
+    def upload_progress(self):
+        with self.progress_lock:
+            done = sum(1 for status in self.segment_status.values() if status == 'done')
+            return {
+                'segments_done': done,
+                'segments_total': len(self.segment_status),
+                'bytes_sent': self.bytes_sent,
+                'total_bytes': self.total_bytes,
+                'chunk_size': self.chunk_size
+            }
+
+    def upload_finalize_steps(self):
+        # FINALIZEに成功したらTrueを返す
         app.logger.info('FINALIZEリクエストを開始')
         request_data = {
             'command': 'FINALIZE',
             'media_id': self.media_id
         }
-        req = requests.post(url=MEDIA_ENDPOINT_URL, data=request_data, auth=self.oauth)
+        with metrics.timer('xpost_stage_seconds', stage='upload_finalize', account_id=self.account_id or ''):
+            req = yield self.request('POST', 'upload_finalize', form=request_data)
+        if req.status_code not in [200, 201]:
+            app.logger.error(f"FINALIZEリクエストが失敗しました: ステータスコード {req.status_code}, レスポンス {req.text}")
+            return False
         app.logger.debug(f"FINALIZEレスポンス: {req.json()}")
+        if self.upload_session_id is not None:
+            yield CallStep(upload_session_store.mark_finalized, self.upload_session_id)
+            self.finalized = True
         self.processing_info = req.json().get('processing_info', None)
-        self.check_status()
+        return True
 
-    def check_status(self):
-        if self.processing_info is None:
-            return
-        state = self.processing_info['state']
-        app.logger.info(f'メディア処理状態: {state}')
-        if state == 'succeeded':
-            return
-        if state == 'failed':
-            app.logger.error('メディア処理に失敗しました')
-            return
-        check_after_secs = self.processing_info['check_after_secs']
-        app.logger.info(f'{check_after_secs} 秒後に再チェックします')
-        time.sleep(check_after_secs)
+    def upload_steps(self):
+        # アップロード後の処理完了を表すFutureを返す。アップロード自体に失敗した場合はNone
+        if not (yield from self.upload_init_steps()):
+            return None
+
+        if self.finalized:
+            # FINALIZE済みのセッションを再開した場合は処理状態の確認だけを行う
+            app.logger.info(f'FINALIZE済みのメディアの処理状態を確認します: Media ID {self.media_id}')
+            yield from self.fetch_status_steps()
+            return (yield CallStep(self.watch_processing))
+
+        if not (yield from self.upload_append_steps()):
+            status = self.last_append_status
+            if self.resumed and status is not None and 400 <= status < 500 and status != 429:
+                # 再開したmedia_idがサーバー側で無効になっている場合は最初からやり直す
+                app.logger.warning(f"再開したアップロードが拒否されたため最初からやり直します: ステータスコード {status}")
+                yield CallStep(self.discard_upload_session)
+                return (yield from self.upload_steps())
+            app.logger.error("APPENDリクエストが失敗しました")
+            return None
+
+        if not (yield from self.upload_finalize_steps()):
+            return completed_future(False)
+        return (yield CallStep(self.watch_processing))
+
+    def watch_processing(self):
+        # 処理待ちはポーリングサービスに任せ、呼び出し元はすぐに次の作業に移れるようにする
+        processing = media_status_poller.watch(self)
+        processing.add_done_callback(lambda future: self.discard_upload_session())
+        return processing
+
+    def fetch_status_steps(self):
         app.logger.info('ステータスチェック')
         request_params = {
             'command': 'STATUS',
             'media_id': self.media_id
         }
-        req = requests.get(url=MEDIA_ENDPOINT_URL, params=request_params, auth=self.oauth)
+        metrics.inc('xpost_status_polls_total', account_id=self.account_id or '')
+        with metrics.timer('xpost_stage_seconds', stage='status_check', account_id=self.account_id or ''):
+            req = yield self.request('GET', 'status_check', params=request_params, timeout=30)
+        if req.status_code != 200:
+            raise requests.HTTPError(f"STATUSリクエストが失敗しました: ステータスコード {req.status_code}, レスポンス {req.text}", response=req)
         self.processing_info = req.json().get('processing_info', None)
-        self.check_status()
 
-    def tweet(self, client, caption):
+    def processing_result(self):
+        # 直近のprocessing_infoから、完了ならTrue、失敗ならFalse、処理中ならNoneを返す
+        if self.processing_info is None:
+            return True
+        state = self.processing_info['state']
+        app.logger.info(f'メディア処理状態: {state} (Media ID: {self.media_id})')
+        if state == 'succeeded':
+            return True
+        if state == 'failed':
+            app.logger.error(f'メディア処理に失敗しました: Media ID {self.media_id}, {self.processing_info.get("error")}')
+            return False
+        return None
+
+    def tweet_steps(self, account_client, caption):
+        # account_clientのアカウントでこのメディアを付けてツイートし、ツイートIDを返す（失敗した場合はNone）
         app.logger.info('ツイートを投稿します')
         try:
-            response = client.create_tweet(text=caption, media_ids=[self.media_id])
-            if response.data:
-                tweet_id = response.data['id']
-                app.logger.info(f"メディア付きツイートの投稿に成功しました! ツイートID: {tweet_id}")
-                return tweet_id
-            else:
-                app.logger.error("メディア付きツイートの投稿に失敗しました")
-                return None
+            with metrics.timer('xpost_stage_seconds', stage='create_tweet', account_id=account_client.account_id):
+                tweet_id = yield from create_tweet_steps(account_client, caption, 'create_tweet', media_ids=[self.media_id])
+            app.logger.info(f"メディア付きツイートの投稿に成功しました! ツイートID: {tweet_id}")
+            return tweet_id
         except Exception as e:
             app.logger.error(f"ツイート投稿中にエラーが発生しました: {str(e)}")
             return None
 
-def post_tweet_main_riply(video_filename, caption, reply_content, account, start_time, end_time):
-    app.logger.info(f"ツイート投稿プロセスを開始: ファイル名={video_filename}, 開始時間={start_time}, 終了時間={end_time}")
-    
-    oauth = OAuth1(
+def create_oauth(account):
+    return OAuth1(
         account['consumer_key'],
         client_secret=account['consumer_secret'],
         resource_owner_key=account['access_token'],
         resource_owner_secret=account['access_token_secret']
     )
 
+def create_tweet_steps(account_client, text, stage, media_ids=None, in_reply_to_tweet_id=None):
+    # POST /2/tweetsでツイートを作成し、ツイートIDを返す
+    body = {'text': text}
+    if media_ids:
+        body['media'] = {'media_ids': [str(media_id) for media_id in media_ids]}
+    if in_reply_to_tweet_id:
+        body['reply'] = {'in_reply_to_tweet_id': str(in_reply_to_tweet_id)}
+    response = yield HttpStep(account_client.session, account_client.oauth, account_client.account_id, 'POST', POST_TWEET_URL, stage,
+                              json_body=body, idempotent=False)
+    if response.status_code != 201:
+        raise requests.HTTPError(f"ステータスコード {response.status_code}, レスポンス {response.text}", response=response)
+    return response.json()['data']['id']
+
+class AccountClient:
+    # アカウントごとにOAuth署名とHTTPセッションを保持して使い回す
+    def __init__(self, account):
+        self.account_id = account['id']
+        self.username = account.get('username')
+        self.credentials = (account['consumer_key'], account['consumer_secret'],
+                            account['access_token'], account['access_token_secret'])
+        self.oauth = create_oauth(account)
+        self.session = requests.Session()
+        adapter = RateLimitedAdapter(self.account_id, pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        self.session.close()
+
+class AccountClientRegistry:
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get(self, account):
+        credentials = (account['consumer_key'], account['consumer_secret'],
+                       account['access_token'], account['access_token_secret'])
+        with self.lock:
+            account_client = self.clients.get(account['id'])
+            # 他のワーカープロセスで認証情報が更新された場合も作り直す
+            if account_client is None or account_client.credentials != credentials:
+                if account_client is not None:
+                    account_client.close()
+                account_client = AccountClient(account)
+                self.clients[account['id']] = account_client
+                app.logger.info(f"{account.get('username')}のAPIクライアントを作成しました")
+            return account_client
+
+    def invalidate(self, account_id):
+        with self.lock:
+            account_client = self.clients.pop(account_id, None)
+        if account_client is not None:
+            account_client.close()
+            app.logger.info(f"アカウントID {account_id}のAPIクライアントを破棄しました")
+
+account_client_registry = AccountClientRegistry()
+
+def submit_processed_video(video_path, start_time, end_time, processed_path=None, group='posting'):
+    # (変換済み動画のパス, 処理方法)を結果に持つFutureを返す
+    if processed_path and os.path.exists(processed_path):
+        # 取り込み時に変換済みのファイルをそのままアップロードする
+        if processed_video_cache.is_cached_path(processed_path):
+            processed_video_cache.pin(processed_path)
+        return completed_future((processed_path, 'pretranscoded'))
+    # 動画変換はWebプロセスとは別のワーカープロセスで実行する
+    return transcode_executor.submit(video_path, start_time, end_time, group=group).future
+
+def prepare_processed_video(video_path, start_time, end_time, processed_path=None, group='posting'):
+    processed_video_path, processing_method = submit_processed_video(video_path, start_time, end_time, processed_path, group).result()
+    app.logger.info(f"動画処理が完了しました: {processed_video_path}, 処理方法: {processing_method}")
+    return processed_video_path, processing_method
+
+# 非同期投稿エンジンの設定
+ASYNC_POSTING = os.environ.get('ASYNC_POSTING', '0') == '1'  # 1にすると投稿ジョブとリプライをスレッドではなくイベントループで進める
+ASYNC_HTTP_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_CONNECTIONS', 512))  # イベントループ全体で同時に開く接続数の上限
+ASYNC_BLOCKING_WORKERS = int(os.environ.get('ASYNC_BLOCKING_WORKERS', 16))  # DB操作などをイベントループの外で実行するスレッド数
+
+class AsyncResponse:
+    # 読み終えたaiohttpのレスポンス。RetryPolicyやRateLimiterからはrequestsのResponseと同じように扱う
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+class MultipartChunkPayload(aiohttp.payload.Payload):
+    # MultipartChunkBodyをaiohttpで送るためのPayload。パーツをそのまま書き込み、チャンクはコピーしない
+    def __init__(self, body):
+        super().__init__(body, content_type=body.content_type)
+        self._size = body.length
+
+    async def write(self, writer):
+        for part in self._value.parts:
+            await writer.write(part)
+
+    def decode(self, encoding='utf-8', errors='strict'):
+        return b''.join(self._value.parts).decode(encoding, errors)
+
+def oauth_authorization(oauth, method, url, params=None, form=None):
+    # aiohttpで送るリクエストのAuthorizationヘッダーを作る。クエリとフォームの値は署名に含め、multipartやJSONの本文は含めない
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(params)}"
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if form else {}
+    uri, signed_headers, body = oauth.client.sign(url, http_method=method, body=urllib.parse.urlencode(form) if form else None,
+                                                  headers=headers)
+    # requests_oauthlibのクライアントはヘッダーをバイト列で返す
+    return signed_headers[b'Authorization'].decode()
+
+class AsyncPostingEngine:
+    # 専用スレッドのイベントループで投稿の手順を進める。待ち時間がほとんどのAPI呼び出しを、アカウントごとにスレッドを立てずに同時に扱う。
+    # 他のスレッド（投稿ジョブのワーカーやリプライの送信）からはsubmit(run_steps(手順))で渡し、concurrent.futures.Futureで結果を受け取る
+    def __init__(self, connections, blocking_workers):
+        self.connections = connections
+        self.blocking_workers = blocking_workers
+        self.loop = None
+        self.session = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        # ダッシュボードへの通知でイベントループを止めないよう、順序を保ったまま別スレッドから送る
+        self.notifier = ThreadPoolExecutor(max_workers=1, thread_name_prefix='async-notify')
+
+    def start(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            # CallStepで逃がすDB操作などはこのスレッドプールで実行する
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=self.blocking_workers, thread_name_prefix='async-blocking'))
+            ready = threading.Event()
+            threading.Thread(target=self._run, args=(loop, ready), name='async-posting', daemon=True).start()
+            ready.wait()
+            self.loop = loop
+        app.logger.info(f"非同期投稿エンジンを開始しました: 同時接続数 {self.connections}")
+
+    def _run(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        self.session = loop.run_until_complete(self._open_session())
+        ready.set()
+        loop.run_forever()
+
+    async def _open_session(self):
+        # 全アカウントで1つの接続プールを共有する（OAuth署名はリクエストごとに付ける）
+        connector = aiohttp.TCPConnector(limit=self.connections, limit_per_host=0, ttl_dns_cache=300)
+        return aiohttp.ClientSession(connector=connector)
+
+    def submit(self, coro):
+        self.start()
+        with self.lock:
+            self.pending += 1
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def pending_count(self):
+        with self.lock:
+            return self.pending
+
+    def notify(self, func, *args):
+        self.notifier.submit(func, *args)
+
+    async def run_steps(self, steps):
+        # run_stepsのイベントループ版。途中でキャンセルされた場合も手順を閉じて後始末を済ませる
+        send, value = steps.send, None
+        try:
+            while True:
+                try:
+                    step = send(value)
+                except StopIteration as stop:
+                    return stop.value
+                try:
+                    value, send = await step.run_async(self), steps.send
+                except Exception as e:
+                    value, send = e, steps.throw
+        finally:
+            steps.close()
+
+    async def request(self, step):
+        # HttpStepをOAuth1で署名して送る。レート制限・リトライ・サーキットブレーカーはrequestsの経路と共通のものを使う
+        key = (step.account_id, step.method, urllib.parse.urlsplit(step.url).path)
+        params = {name: str(value) for name, value in step.params.items()} if step.params else None
+        form = {name: str(value) for name, value in step.form.items()} if step.form else None
+
+        async def send():
+            await rate_limiter.acquire_async(key)
+            headers = {'Authorization': oauth_authorization(step.oauth, step.method, step.url, params, form)}
+            data = None
+            if form is not None:
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                data = urllib.parse.urlencode(form)
+            elif step.multipart is not None:
+                data = MultipartChunkPayload(MultipartChunkBody(*step.multipart))
+            try:
+                async with self.session.request(step.method, step.url, params=params, data=data, json=step.json_body, headers=headers,
+                                                timeout=aiohttp.ClientTimeout(total=step.timeout)) as resp:
+                    response = AsyncResponse(resp.status, resp.headers, await resp.read())
+            # requestsと同じ例外に置き換え、送信前の接続エラーと送信後のタイムアウトを区別できるようにする
+            except aiohttp.ClientConnectorError as e:
+                raise requests.exceptions.ConnectionError(str(e))
+            except asyncio.TimeoutError:
+                raise requests.exceptions.Timeout(f"{step.method} {step.url} がタイムアウトしました")
+            except aiohttp.ClientError as e:
+                raise RequestException(str(e))
+            rate_limiter.update(key, response.headers, response.status_code)
+            return response
+
+        return await retry_policy.call_async(send, step.account_id, step.stage, step.idempotent)
+
+async_posting_engine = AsyncPostingEngine(ASYNC_HTTP_CONNECTIONS, ASYNC_BLOCKING_WORKERS)
+
+class ReplyScheduler:
+    # リプライをDBに予約し、期限が来たものを別スレッドで送信する（失敗しても投稿処理には影響しない）
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self):
+        conn = get_db()
+        try:
+            # 送信中のまま停止した予約を戻す
+            conn.execute("UPDATE pending_replies SET status = 'pending' WHERE status = 'sending' AND updated_at < ?",
+                         (int(time.time()) - REPLY_SENDING_TIMEOUT,))
+            conn.commit()
+        finally:
+            conn.close()
+        self.thread = threading.Thread(target=self._run, name='reply-scheduler', daemon=True)
+        self.thread.start()
+        app.logger.info("リプライ予約の送信を開始しました")
+
+    def schedule(self, account_id, parent_tweet_id, text, delay=REPLY_DELAY_SECS):
+        now = int(time.time())
+        conn = get_db()
+        try:
+            conn.execute("INSERT INTO pending_replies (parent_tweet_id, account_id, text, due_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                         (str(parent_tweet_id), account_id, text, now + delay, now))
+            conn.commit()
+        finally:
+            conn.close()
+        self.wakeup.set()
+        app.logger.info(f"リプライを予約しました: 親ツイートID {parent_tweet_id}, {delay}秒後")
+
+    def _run(self):
+        while True:
+            try:
+                next_due = self._send_due_replies()
+            except Exception as e:
+                app.logger.error(f"リプライ予約の処理中にエラーが発生しました: {str(e)}", exc_info=True)
+                next_due = time.time() + REPLY_RETRY_BASE_SECS
+            timeout = max(0, next_due - time.time()) if next_due is not None else None
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def _send_due_replies(self):
+        while True:
+            now = int(time.time())
+            conn = get_db()
+            c = conn.cursor()
+            try:
+                c.execute("SELECT id, parent_tweet_id, account_id, text, attempts FROM pending_replies WHERE status = 'pending' AND due_at <= ? ORDER BY due_at LIMIT 1",
+                          (now,))
+                row = c.fetchone()
+                if row is None:
+                    c.execute("SELECT MIN(due_at) FROM pending_replies WHERE status = 'pending'")
+                    return c.fetchone()[0]
+                # 他のプロセスと二重に送らないよう、pendingの予約だけを確保する
+                c.execute("UPDATE pending_replies SET status = 'sending', updated_at = ? WHERE id = ? AND status = 'pending'",
+                          (now, row[0]))
+                conn.commit()
+                claimed = c.rowcount > 0
+            finally:
+                conn.close()
+            if claimed and ASYNC_POSTING:
+                # 送信はイベントループに任せ、待たずに次の予約を確保する
+                async_posting_engine.submit(async_posting_engine.run_steps(self._send_steps(*row)))
+            elif claimed:
+                run_steps(self._send_steps(*row))
+
+    def _load_account(self, account_id):
+        conn = get_read_db()
+        c = conn.cursor()
+        c.execute("SELECT * FROM twitter_accounts WHERE id = ?", (account_id,))
+        account = c.fetchone()
+        conn.close()
+        return account
+
+    def _send_steps(self, reply_id, parent_tweet_id, account_id, text, attempts):
+        account = yield CallStep(self._load_account, account_id)
+
+        error = None
+        if account is None:
+            error = "アカウントが見つかりません"
+            attempts = REPLY_MAX_ATTEMPTS
+        else:
+            try:
+                account_client = account_client_registry.get(account_to_dict(account))
+                with metrics.timer('xpost_stage_seconds', stage='reply_send', account_id=account_id):
+                    sent_id = yield from create_tweet_steps(account_client, text, 'reply_send', in_reply_to_tweet_id=parent_tweet_id)
+                app.logger.info(f"リプライの投稿に成功しました! リプライID: {sent_id}")
+            except Exception as e:
+                error = str(e)
+            attempts += 1
+        yield CallStep(self._record, reply_id, parent_tweet_id, account, account_id, error, attempts)
+
+    def _record(self, reply_id, parent_tweet_id, account, account_id, error, attempts):
+        if error is None:
+            metrics.inc('xpost_replies_total', result='sent', account_id=account_id)
+        elif attempts < REPLY_MAX_ATTEMPTS:
+            metrics.inc('xpost_retries_total', stage='reply_send', account_id=account_id)
+        else:
+            metrics.inc('xpost_replies_total', result='failed', account_id=account_id)
+
+        conn = get_db()
+        try:
+            if error is None:
+                conn.execute("UPDATE pending_replies SET status = 'sent', attempts = ?, updated_at = ? WHERE id = ?",
+                             (attempts, int(time.time()), reply_id))
+            elif attempts < REPLY_MAX_ATTEMPTS:
+                retry_after = REPLY_RETRY_BASE_SECS * 2 ** (attempts - 1)
+                app.logger.error(f"リプライ投稿中にエラーが発生しました: {error} ({retry_after}秒後にリトライします)")
+                conn.execute("UPDATE pending_replies SET status = 'pending', attempts = ?, last_error = ?, due_at = ?, updated_at = ? WHERE id = ?",
+                             (attempts, error, int(time.time()) + retry_after, int(time.time()), reply_id))
+            else:
+                app.logger.error(f"リプライの投稿を断念しました: 親ツイートID {parent_tweet_id}, {error}")
+                conn.execute("UPDATE pending_replies SET status = 'failed', attempts = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                             (attempts, error, int(time.time()), reply_id))
+            conn.commit()
+        finally:
+            conn.close()
+        if error is not None and attempts >= REPLY_MAX_ATTEMPTS:
+            log_activity(account[1] if account else "System", "リプライ投稿", f"失敗: {error}")
+
+reply_scheduler = ReplyScheduler()
+
+def post_tweet_main_riply_steps(video_filename, caption, reply_content, account, start_time, end_time, processed_path=None, job=None):
+    # 動画の変換・アップロード・処理待ち・ツイートを行い、成否を返す手順。
+    # jobを渡した場合は段階ごとにキャンセルされていないかを確認し、投稿したツイートIDを記録する
+    app.logger.info(f"ツイート投稿プロセスを開始: ファイル名={video_filename}, 開始時間={start_time}, 終了時間={end_time}")
+
+    account_client = account_client_registry.get(account)
+
     video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_filename)
-    
+
+    yield NotifyStep(set_account_progress, account['username'], 'preparing')
     try:
-        processed_video_path = process_video(video_path, start_time, end_time)
-        app.logger.info(f"動画処理が完了しました: {processed_video_path}")
+        with metrics.timer('xpost_stage_seconds', stage='prepare_video', account_id=account['id']):
+            processing_video = yield CallStep(submit_processed_video, video_path, start_time, end_time, processed_path,
+                                              job.transcode_group if job else 'posting')
+            processed_video_path, processing_method = yield WaitStep(processing_video)
+        app.logger.info(f"動画処理が完了しました: {processed_video_path}, 処理方法: {processing_method}")
+    except Exception as e:
+        app.logger.error(f"動画処理中にエラーが発生しました: {str(e)}")
+        return False
+
+    if job is not None and (yield CallStep(job.cancelled)):
+        app.logger.info(f"投稿ジョブがキャンセルされたためアップロードしません: ジョブID {job.job_id}")
+        processed_video_cache.release(processed_video_path)
+        return False
+
+    yield NotifyStep(set_account_progress, account['username'], 'uploading')
+    try:
+        video_tweet = VideoTweet(processed_video_path, account_client.oauth, session=account_client.session,
+                                 account_id=account_client.account_id)
+
+        processing = yield from video_tweet.upload_steps()
+        if processing is None:
+            return False
+        yield NotifyStep(set_account_progress, account['username'], 'processing')
+
     except Exception as e:
-        app.logger.error(f"動画処理中にエラーが発生しました: {str(e)}")
+        app.logger.error(f"ツイート投稿プロセス中にエラーが発生しました: {str(e)}")
         return False
 
-    video_tweet = VideoTweet(processed_video_path, oauth)
+    finally:
+        # 処理済み動画はキャッシュに残し、使用中の印だけを外す
+        processed_video_cache.release(processed_video_path)
 
     try:
-        init_response = video_tweet.upload_init()
-        if init_response.status_code != 202:
-            app.logger.error(f"INITリクエストが失敗しました: {init_response.status_code}")
+        if not (yield WaitStep(processing)):
+            app.logger.error("メディア処理に失敗したためツイートを投稿しません")
             return False
-
-        if not video_tweet.upload_append():
-            app.logger.error("APPENDリクエストが失敗しました")
+        if job is not None and (yield CallStep(job.cancelled)):
+            app.logger.info(f"投稿ジョブがキャンセルされたためツイートしません: ジョブID {job.job_id}")
             return False
-
-        video_tweet.upload_finalize()
-
-        client = tweepy.Client(
-            consumer_key=account['consumer_key'],
-            consumer_secret=account['consumer_secret'],
-            access_token=account['access_token'],
-            access_token_secret=account['access_token_secret']
-        )
-
-        tweet_id = video_tweet.tweet(client, caption)
-        if tweet_id:
-            app.logger.info("ツイートが正常に投稿されました")
-            # リプライの投稿
-            if reply_content:
-                try:
-                    time.sleep(10)  # 10秒待機
-                    reply_response = client.create_tweet(text=reply_content, in_reply_to_tweet_id=tweet_id)
-
-                    if reply_response.data:
-                        app.logger.info(f"リプライの投稿に成功しました! リプライID: {reply_response.data['id']}")
-                    else:
-                        app.logger.error("リプライの投稿に失敗しました")
-                except Exception as e:
-                    app.logger.error(f"リプライ投稿中にエラーが発生しました: {str(e)}")
-            return True
-        else:
+        yield NotifyStep(set_account_progress, account['username'], 'tweeting')
+        tweet_id = yield from video_tweet.tweet_steps(account_client, caption)
+        if not tweet_id:
             app.logger.error("ツイートの投稿に失敗しました")
             return False
-
+        app.logger.info("ツイートが正常に投稿されました")
+        if job is not None:
+            yield CallStep(job.record_tweet, tweet_id)
+        # リプライは予約して後で送る
+        if reply_content:
+            yield CallStep(reply_scheduler.schedule, account_client.account_id, tweet_id, reply_content)
+        return True
     except Exception as e:
         app.logger.error(f"ツイート投稿プロセス中にエラーが発生しました: {str(e)}")
         return False
-    
-    finally:
-        # 処理された動画の一時ファイルを削除
-        if os.path.exists(processed_video_path):
-            os.remove(processed_video_path)
-            app.logger.info(f"一時ファイルを削除しました: {processed_video_path}")
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -386,27 +3127,128 @@ def index():
             flash('ファイルが選択されていません')
             return redirect(request.url)
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            app.logger.info(f"ファイルをアップロードしました: {filepath}")
+            upload = StagedUpload(file)
+            # 開始・終了とも0（未指定）の場合は切り取らない
+            if start_time == 0 and end_time == 0:
+                start_time, end_time = None, None
+            metadata = probe_video_metadata(upload.temp_path)
+            error = validate_video_metadata(upload.filename, metadata) or validate_trim_window(
+                start_time, end_time, metadata['duration'] if metadata else None)
+            if error:
+                upload.discard()
+                app.logger.warning(f"登録できない動画です: {error}")
+                flash(error)
+                return redirect(request.url)
             
             # データベースに保存
-            insert_video_data(filename, caption, reply_content, start_time, end_time)
+            post_id = insert_video_data(upload.filename, caption, reply_content, start_time, end_time,
+                                        content_hash=upload.content_hash, original_filename=upload.original_filename,
+                                        metadata=metadata)
+            if not post_id:
+                upload.discard()
+                flash('動画の保存に失敗しました')
+                return redirect(request.url)
+            try:
+                upload.commit()
+            except OSError as e:
+                # ファイルを置けなかった場合は追加した行も取り消す
+                app.logger.error(f"動画ファイルの保存に失敗しました: {str(e)}")
+                upload.discard()
+                remove_video_row(post_id)
+                flash('動画の保存に失敗しました')
+                return redirect(request.url)
+            ingest_pipeline.enqueue(post_id)
             
             flash('動画、キャプション、リプライ内容が保存されました')
             return redirect(url_for('index'))
     return render_template('index.html')
 
+# 投稿一覧APIの設定
+VIDEO_LIST_FIELDS = ['id', 'filename', 'original_filename', 'content_hash', 'caption', 'reply_content', 'start_time', 'end_time',
+                     'processing_status', 'weight'] + VIDEO_METADATA_COLUMNS
+LISTING_MAX_LIMIT = 1000
+LISTING_STREAM_BATCH = 500  # ページ指定なしで全件を返すときに1回のクエリで読む件数
+
+def blank_if_none(value):
+    return value if value is not None else ''
+
+def get_table_version(name):
+    conn = get_read_db()
+    c = conn.cursor()
+    try:
+        c.execute("SELECT version FROM table_versions WHERE name = ?", (name,))
+        row = c.fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else 0
+
+def iter_video_rows(fields, after=None, limit=None):
+    # idのキーセットで少しずつ読み、全件を一度にメモリへ載せない
+    columns = ', '.join(['id'] + fields)
+    last_id = after if after is not None else -1
+    remaining = limit
+    while remaining is None or remaining > 0:
+        batch = LISTING_STREAM_BATCH if remaining is None else min(LISTING_STREAM_BATCH, remaining)
+        conn = get_read_db()
+        c = conn.cursor()
+        try:
+            c.execute(f"SELECT {columns} FROM videos WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch))
+            rows = c.fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            yield row
+        if len(rows) < batch:
+            return
+        last_id = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+
+def video_listing_response(default_fields, formatters, label):
+    # 一覧はそのまま配列で返し、次ページのカーソルはX-Next-Cursorヘッダーで返す
+    etag = hashlib.sha1(f"videos:{get_table_version('videos')}:{request.full_path}".encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    fields = default_fields
+    if request.args.get('fields'):
+        fields = [f for f in request.args.get('fields').split(',') if f in VIDEO_LIST_FIELDS]
+        if not fields:
+            return jsonify({'error': '不正なフィールド指定です'}), 400
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', type=int)
+
+    def to_item(row):
+        return {field: formatters.get(field, lambda value: value)(value) for field, value in zip(fields, row[1:])}
+
+    if limit is not None:
+        limit = max(1, min(limit, LISTING_MAX_LIMIT))
+        rows = list(iter_video_rows(fields, after, limit))
+        response = jsonify([to_item(row) for row in rows])
+        if len(rows) == limit:
+            response.headers['X-Next-Cursor'] = str(rows[-1][0])
+        app.logger.info(f"{label}を取得しました: {len(rows)}件")
+    else:
+        # ページ指定がない場合は従来どおり全件を返すが、組み立てながら送り出す
+        def generate():
+            count = 0
+            yield '['
+            for row in iter_video_rows(fields, after):
+                yield (',' if count else '') + json.dumps(to_item(row))
+                count += 1
+            yield ']'
+            app.logger.info(f"{label}を取得しました: {count}件")
+        response = app.response_class(generate(), mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    # キャッシュを使う前に毎回ETagで確認させる
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/videos', methods=['GET'])
 def get_videos():
-    conn = sqlite3.connect('videos.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM videos")
-    videos = c.fetchall()
-    conn.close()
-    app.logger.info(f"動画リストを取得しました: {len(videos)}件")
-    return jsonify([{'id': v[0], 'filename': v[1], 'caption': v[2], 'reply_content': v[3], 'start_time': v[4], 'end_time': v[5]} for v in videos])
+    return video_listing_response(['id', 'filename', 'caption', 'reply_content', 'start_time', 'end_time'], {}, "動画リスト")
 
 @socketio.on('connect')
 def handle_connect():
@@ -417,43 +3259,337 @@ def handle_connect():
 def handle_disconnect():
     app.logger.info(f"クライアントが切断しました: {request.sid}")
 
-# グローバル変数で自動投稿の状態を管理
-auto_posting_thread = None
-auto_posting_interval = 0
-next_post_time = None
+# 自動投稿の設定はposting_scheduleテーブルに置き、ここではこのプロセスの表示用の状態だけを持つ
 current_status = "待機中"
 
+# ダッシュボードの状態の配信設定
+STATUS_RECENT_ACTIVITIES = 10
+STATUS_DELTA_HISTORY = 1000  # 再接続したクライアントが差分で追いつける件数
+
+class StatusModel:
+    # ダッシュボードの状態をメモリに持ち、変更のたびに連番付きの差分を全クライアントへ配信する。
+    # クライアントは連番が飛んだときや再接続したときだけ、不足分の差分か全体を取り直す
+    def __init__(self):
+        self.seq = 0
+        self.current_status = current_status
+        self.auto_posting = {'active': False, 'interval': 0, 'next_post_time': None}
+        self.recent_activities = None
+        self.accounts = {}
+        self.history = deque(maxlen=STATUS_DELTA_HISTORY)
+        self.lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        # 最近のアクティビティは起動後に一度だけDBから読み、以降はログの追加に合わせて更新する
+        if self.recent_activities is None:
+            self.recent_activities = deque(get_recent_activities(STATUS_RECENT_ACTIVITIES), maxlen=STATUS_RECENT_ACTIVITIES)
+
+    def apply(self, **changes):
+        with self.lock:
+            self._ensure_loaded()
+            if 'current_status' in changes:
+                self.current_status = changes['current_status']
+            if 'auto_posting' in changes:
+                self.auto_posting = changes['auto_posting']
+            if 'activity' in changes:
+                self.recent_activities.appendleft(changes['activity'])
+            if 'account_progress' in changes:
+                self.accounts[changes['account_progress']['account']] = changes['account_progress']
+            self.seq += 1
+            delta = dict(changes, seq=self.seq)
+            self.history.append(delta)
+            # 配信の順序が連番と食い違わないよう、ロックを持ったまま送る
+            socketio.emit('status_delta', delta)
+
+    def snapshot(self):
+        with self.lock:
+            self._ensure_loaded()
+            return {
+                'seq': self.seq,
+                'current_status': self.current_status,
+                'auto_posting_active': self.auto_posting['active'],
+                'auto_posting_interval': self.auto_posting['interval'],
+                'next_post_time': self.auto_posting['next_post_time'],
+                'recent_activities': list(self.recent_activities),
+                'accounts': list(self.accounts.values()),
+                'video_cache': processed_video_cache.stats(),
+                'ingest_backlog': ingest_pipeline.backlog(),
+                'metrics': metrics.summary()
+            }
+
+    def deltas_since(self, seq):
+        # 履歴から追いつけない場合はNoneを返す（全体を送り直す）
+        with self.lock:
+            if seq > self.seq or (seq < self.seq and (not self.history or self.history[0]['seq'] > seq + 1)):
+                return None
+            return [delta for delta in self.history if delta['seq'] > seq]
+
+status_model = StatusModel()
+
 def update_status(new_status):
     global current_status
     current_status = new_status
-    socketio.emit('status_update', {'status': current_status})
+    status_model.apply(current_status=new_status)
     app.logger.info(f"ステータスを更新しました: {new_status}")
 
+def publish_auto_posting_status(schedule=None):
+    schedule = schedule or get_posting_schedule()
+    status_model.apply(auto_posting={
+        'active': schedule['active'],
+        'interval': schedule['interval'] // 60,  # 秒を分に変換
+        'next_post_time': datetime.fromtimestamp(schedule['next_run_at']).isoformat() if schedule['next_run_at'] else None
+    })
+
+def set_account_progress(username, stage):
+    # stage: preparing / uploading / processing / tweeting / succeeded / failed
+    status_model.apply(account_progress={'account': username, 'stage': stage, 'updated_at': datetime.now().isoformat()})
+
+# アクティビティログの書き込み設定
+ACTIVITY_LOG_BATCH_SIZE = 100
+ACTIVITY_LOG_FLUSH_SECS = 1.0
+ACTIVITY_LOG_QUEUE_SIZE = 10000
+ACTIVITY_LOG_PUT_TIMEOUT = 5  # キューが一杯のときに呼び出し元を待たせる上限（秒）
+ACTIVITY_LOG_SYNC = os.environ.get('ACTIVITY_LOG_SYNC', '0') == '1'  # 1にすると書き込みスレッドを使わずその場で書き込む（テスト用）
+
+class ActivityLogWriter:
+    # イベントごとにコミットせず、キューに溜めて1トランザクションでまとめて書き込む
+    def __init__(self, batch_size, flush_secs, max_queue, synchronous=False):
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.synchronous = synchronous
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        # フォークされたプロセスでは書き込みスレッドを作り直す
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self.thread = threading.Thread(target=self._run, name="activity-log-writer", daemon=True)
+            self.pid = os.getpid()
+            self.thread.start()
+
+    def write(self, account, action, result):
+        now = time.time()
+        row = (datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S"), int(now), account, action, result)
+        if self.synchronous:
+            self._insert([row])
+            return
+        self._ensure_started()
+        try:
+            # 書き込みが追いつかないときは呼び出し元を待たせて取りこぼさないようにする
+            self.queue.put(row, timeout=ACTIVITY_LOG_PUT_TIMEOUT)
+        except queue.Full:
+            app.logger.warning("アクティビティログのキューが一杯のため直接書き込みます")
+            self._insert([row])
+
+    def flush(self, timeout=None):
+        # キューに溜まっている分を書き終えるまで待つ
+        if self.synchronous or self.thread is None or self.pid != os.getpid():
+            return True
+        marker = Future()
+        try:
+            self.queue.put(marker, timeout=timeout)
+            marker.result(timeout=timeout)
+            return True
+        except (queue.Full, FutureTimeoutError):
+            return False
+
+    def close(self):
+        if not self.flush(timeout=10):
+            app.logger.warning("終了時にアクティビティログを書き切れませんでした")
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            batch = []
+            markers = []
+            deadline = time.monotonic() + self.flush_secs
+            while True:
+                if isinstance(item, Future):
+                    markers.append(item)
+                    break
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._insert(batch)
+            for marker in markers:
+                marker.set_result(True)
+
+    def _insert(self, rows):
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.executemany("INSERT INTO activity_log (timestamp, created_at, account, action, result) VALUES (?, ?, ?, ?, ?)", rows)
+            conn.commit()
+            for timestamp, created_at, account, action, result in rows:
+                app.logger.info(f"アクティビティログを追加しました: {account} - {action} - {result}")
+        except sqlite3.Error as e:
+            app.logger.error(f"アクティビティログの追加中にエラーが発生しました: {len(rows)}件, {str(e)}")
+        finally:
+            conn.close()
+
+activity_log_writer = ActivityLogWriter(ACTIVITY_LOG_BATCH_SIZE, ACTIVITY_LOG_FLUSH_SECS, ACTIVITY_LOG_QUEUE_SIZE,
+                                        synchronous=ACTIVITY_LOG_SYNC)
+
+def collect_queue_metrics():
+    # キューの長さやキャッシュの統計は出力のたびに各コンポーネントから読み取る
+    cache_stats = processed_video_cache.stats()
+    return [
+        ('xpost_video_cache_hits_total', {}, cache_stats['hits']),
+        ('xpost_video_cache_misses_total', {}, cache_stats['misses']),
+        ('xpost_video_cache_evictions_total', {}, cache_stats['evictions']),
+        ('xpost_queue_depth', {'queue': 'ingest'}, ingest_pipeline.backlog()['jobs']),
+        ('xpost_queue_depth', {'queue': 'transcode'}, len(transcode_executor.jobs)),
+        ('xpost_queue_depth', {'queue': 'media_status'}, media_status_poller.pending_count()),
+        ('xpost_queue_depth', {'queue': 'activity_log'}, activity_log_writer.queue.qsize()),
+        ('xpost_queue_depth', {'queue': 'async_posting'}, async_posting_engine.pending_count())
+    ] + [('xpost_rate_limit_remaining', {'account_id': key[0], 'endpoint': f"{key[1]} {key[2]}"}, remaining)
+         for key, remaining, reset_at in rate_limiter.snapshot()] + \
+        [('xpost_circuit_open', {'account_id': account_id}, 1) for account_id in circuit_breaker.open_accounts()]
+
+metrics.describe('xpost_queue_depth', 'gauge', '各キューに溜まっている件数')
+metrics.describe('xpost_rate_limit_remaining', 'gauge', 'アカウント・エンドポイントごとのレート制限の残り回数')
+metrics.describe('xpost_rate_limit_waits_total', 'counter', 'レート制限のリセットを待った回数')
+metrics.describe('xpost_circuit_open_total', 'counter', '失敗が続いてアカウントの送信を止めた回数')
+metrics.describe('xpost_circuit_open', 'gauge', '送信を止めているアカウント（1=停止中）')
+metrics.describe('xpost_video_cache_hits_total', 'counter', '処理済み動画キャッシュのヒット数')
+metrics.describe('xpost_video_cache_misses_total', 'counter', '処理済み動画キャッシュのミス数')
+metrics.describe('xpost_video_cache_evictions_total', 'counter', '処理済み動画キャッシュから削除した件数')
+metrics.add_collector(collect_queue_metrics)
+
 def log_activity(account, action, result):
-    conn = sqlite3.connect('videos.db')
+    # 書き込みを待たずにダッシュボードへ反映する
+    status_model.apply(activity={'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'account': account, 'action': action, 'result': result})
+    activity_log_writer.write(account, action, result)
+
+# アクティビティログの保存期間と集計の設定
+ACTIVITY_LOG_RETENTION_DAYS = int(os.environ.get('ACTIVITY_LOG_RETENTION_DAYS', 30))
+ACTIVITY_LOG_RETENTION_INTERVAL = 60 * 60  # 秒
+ACTIVITY_LOG_RETENTION_BATCH = 10000
+ACTIVITY_PAGE_MAX_LIMIT = 200
+
+def encode_activity_cursor(created_at, activity_id):
+    return f"{created_at}:{activity_id}"
+
+def decode_activity_cursor(cursor):
+    try:
+        created_at, activity_id = cursor.split(':', 1)
+        return int(created_at), int(activity_id)
+    except (AttributeError, ValueError):
+        raise ValueError(f"不正なカーソルです: {cursor}")
+
+def query_activities(limit=10, cursor=None, account=None, action=None):
+    # (created_at, id)の降順によるキーセットページング。OFFSETを使わないので深いページでも速い
+    conditions = []
+    params = []
+    if cursor:
+        created_at, activity_id = decode_activity_cursor(cursor)
+        conditions.append("(created_at, id) < (?, ?)")
+        params.extend([created_at, activity_id])
+    if account:
+        conditions.append("account = ?")
+        params.append(account)
+    if action:
+        conditions.append("action = ?")
+        params.append(action)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = get_read_db()
     c = conn.cursor()
     try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        c.execute("INSERT INTO activity_log (timestamp, account, action, result) VALUES (?, ?, ?, ?)",
-                  (timestamp, account, action, result))
-        conn.commit()
-        app.logger.info(f"アクティビティログを追加しました: {account} - {action} - {result}")
-    except sqlite3.Error as e:
-        app.logger.error(f"アクティビティログの追加中にエラーが発生しました: {str(e)}")
+        c.execute(f"SELECT id, timestamp, account, action, result, created_at FROM activity_log {where} ORDER BY created_at DESC, id DESC LIMIT ?",
+                  params + [limit])
+        activities = c.fetchall()
     finally:
         conn.close()
+    next_cursor = encode_activity_cursor(activities[-1][5], activities[-1][0]) if len(activities) == limit else None
+    return [{'id': a[0], 'timestamp': a[1], 'account': a[2], 'action': a[3], 'result': a[4], 'created_at': a[5]} for a in activities], next_cursor
 
 def get_recent_activities(limit=10):
-    conn = sqlite3.connect('videos.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM activity_log ORDER BY timestamp DESC LIMIT ?", (limit,))
-    activities = c.fetchall()
-    conn.close()
+    activities, next_cursor = query_activities(limit)
     app.logger.info(f"最近のアクティビティを取得しました: {len(activities)}件")
-    return [{'timestamp': a[1], 'account': a[2], 'action': a[3], 'result': a[4]} for a in activities]
+    return [{'timestamp': a['timestamp'], 'account': a['account'], 'action': a['action'], 'result': a['result']} for a in activities]
+
+def rollup_activity_log(retention_days):
+    # 保存期間を過ぎたログを日別の成功・失敗件数にまとめてから削除する。
+    # 書き込みロックを長く持たないよう、一定件数ごとにトランザクションを分ける
+    cutoff = int(time.time()) - retention_days * 24 * 60 * 60
+    total = 0
+    while True:
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("SELECT created_at, id FROM activity_log WHERE created_at < ? ORDER BY created_at, id LIMIT 1 OFFSET ?",
+                      (cutoff, ACTIVITY_LOG_RETENTION_BATCH - 1))
+            boundary = c.fetchone()
+            if boundary is None:
+                # 残りが1バッチに満たない場合は期限内の直前までをまとめて処理する
+                c.execute("SELECT created_at, id FROM activity_log WHERE created_at < ? ORDER BY created_at DESC, id DESC LIMIT 1", (cutoff,))
+                boundary = c.fetchone()
+                if boundary is None:
+                    break
+            c.execute("""
+                INSERT INTO activity_daily_stats (day, account, action, success_count, failure_count, other_count)
+                SELECT date(created_at, 'unixepoch', 'localtime'), account, action,
+                       SUM(result LIKE '成功%'), SUM(result LIKE '失敗%'),
+                       SUM(result NOT LIKE '成功%' AND result NOT LIKE '失敗%')
+                FROM activity_log
+                WHERE (created_at, id) <= (?, ?)
+                GROUP BY 1, 2, 3
+                ON CONFLICT (day, account, action) DO UPDATE SET
+                    success_count = success_count + excluded.success_count,
+                    failure_count = failure_count + excluded.failure_count,
+                    other_count = other_count + excluded.other_count
+            """, boundary)
+            c.execute("DELETE FROM activity_log WHERE (created_at, id) <= (?, ?)", boundary)
+            deleted = c.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        total += deleted
+        if deleted < ACTIVITY_LOG_RETENTION_BATCH:
+            break
+    if total:
+        app.logger.info(f"古いアクティビティログを集計して削除しました: {total}件")
+    return total
+
+def get_activity_daily_stats(account=None, days=30):
+    since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    conn = get_read_db()
+    c = conn.cursor()
+    try:
+        if account:
+            c.execute("SELECT day, account, action, success_count, failure_count, other_count FROM activity_daily_stats WHERE day >= ? AND account = ? ORDER BY day DESC",
+                      (since, account))
+        else:
+            c.execute("SELECT day, account, action, success_count, failure_count, other_count FROM activity_daily_stats WHERE day >= ? ORDER BY day DESC",
+                      (since,))
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    return [{'day': r[0], 'account': r[1], 'action': r[2], 'success': r[3], 'failure': r[4], 'other': r[5]} for r in rows]
+
+def run_activity_log_retention():
+    while True:
+        try:
+            # 書き込み待ちのログを先に反映してから集計する
+            activity_log_writer.flush(timeout=30)
+            rollup_activity_log(ACTIVITY_LOG_RETENTION_DAYS)
+        except Exception as e:
+            app.logger.error(f"アクティビティログの集計中にエラーが発生しました: {str(e)}", exc_info=True)
+        time.sleep(ACTIVITY_LOG_RETENTION_INTERVAL)
 
 def get_active_accounts():
-    conn = sqlite3.connect('videos.db')
+    conn = get_read_db()
     c = conn.cursor()
     c.execute("SELECT * FROM twitter_accounts WHERE post_flag = 1")
     active_accounts = c.fetchall()
@@ -461,65 +3597,656 @@ def get_active_accounts():
     app.logger.info(f"アクティブなアカウントを取得しました: {len(active_accounts)}件")
     return active_accounts
 
-def get_random_post_content():
-    conn = sqlite3.connect('videos.db')
+def get_random_post_content(account_id=None):
+    conn = get_read_db()
     c = conn.cursor()
-    c.execute("SELECT filename, caption, reply_content, start_time, end_time FROM videos ORDER BY RANDOM() LIMIT 1")
-    result = c.fetchone()
-    conn.close()
+    result = None
+    try:
+        # 索引が他のプロセスでの削除に追いついていない場合は選び直す
+        for _ in range(5):
+            if account_id is not None:
+                post_id = content_selector.next_for_account(account_id)
+            else:
+                post_id = content_selector.random_id()
+            if post_id is None:
+                break
+            c.execute("SELECT id, filename, caption, reply_content, start_time, end_time, processed_path FROM videos WHERE id = ?", (post_id,))
+            result = c.fetchone()
+            if result is not None:
+                break
+            content_selector.remove(post_id)
+    finally:
+        conn.close()
     if result is None:
         app.logger.error("保存された動画がありません")
         raise Exception("保存された動画がありません")
-    app.logger.info(f"ランダムに投稿内容を選択しました: {result[0]}")
+    app.logger.info(f"ランダムに投稿内容を選択しました: {result[1]}")
     return result
 
-def initialize_tweepy(account):
-    username, consumer_key, consumer_secret, access_token, access_token_secret = account[1:6]
-    auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-    auth.set_access_token(access_token, access_token_secret)
-    api = tweepy.API(auth)
-    client = tweepy.Client(
-        consumer_key=consumer_key, consumer_secret=consumer_secret,
-        access_token=access_token, access_token_secret=access_token_secret
-    )
-    app.logger.info(f"{username}のTweepy APIを初期化しました")
-    return api, client
+def get_post_content(post_id):
+    conn = get_read_db()
+    try:
+        result = conn.execute("SELECT id, filename, caption, reply_content, start_time, end_time, processed_path FROM videos WHERE id = ?",
+                              (post_id,)).fetchone()
+    finally:
+        conn.close()
+    if result is None:
+        raise Exception(f"投稿内容が見つかりません: ID {post_id}")
+    return result
+
+def select_post_content(account_id=None, post_id=None):
+    # post_idを指定した場合は、キューに積んだ時点で選んだ投稿内容を使う
+    if post_id is not None:
+        post_id, filename, caption, reply_content, start_time, end_time, processed_path = get_post_content(post_id)
+    else:
+        post_id, filename, caption, reply_content, start_time, end_time, processed_path = get_random_post_content(account_id)
+    video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    
+    if not os.path.exists(video_path):
+        raise FileNotFoundError(f"動画ファイルが見つかりません: {video_path}")
+
+    if processed_path and not os.path.exists(processed_path):
+        # 変換済みファイルがキャッシュから削除されていた場合は作り直す
+        app.logger.warning(f"変換済みファイルが見つからないため再変換します: {processed_path}")
+        ingest_pipeline.enqueue(post_id)
+        processed_path = None
+
+    return post_id, filename, caption, reply_content, start_time, end_time, processed_path
+
+def account_to_dict(account):
+    return {
+        'id': account[0],
+        'username': account[1],
+        'consumer_key': account[2],
+        'consumer_secret': account[3],
+        'access_token': account[4],
+        'access_token_secret': account[5]
+    }
+
+def account_user_id_steps(account):
+    # ユーザーIDは一度取得したらDBに保存して使い回す
+    if len(account) > 7 and account[7]:
+        return account[7]
+    try:
+        account_client = account_client_registry.get(account_to_dict(account))
+        req = yield HttpStep(account_client.session, account_client.oauth, account[0], 'GET', USERS_ME_URL, 'users_me', timeout=30)
+        if req.status_code != 200:
+            app.logger.error(f"{account[1]}のユーザーID取得に失敗しました: ステータスコード {req.status_code}, レスポンス {req.text}")
+            return None
+        user_id = req.json()['data']['id']
+    except (RequestException, ValueError, KeyError) as e:
+        app.logger.error(f"{account[1]}のユーザーID取得中にエラーが発生しました: {str(e)}")
+        return None
 
-def post_tweet_for_account(account):
+    yield CallStep(save_account_user_id, account[0], user_id)
+    app.logger.info(f"{account[1]}のユーザーIDを取得しました: {user_id}")
+    return user_id
+
+def save_account_user_id(account_id, user_id):
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.execute("UPDATE twitter_accounts SET user_id = ? WHERE id = ?", (user_id, account_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def post_tweet_for_account_steps(account, post_id=None, job=None):
+    # 1アカウント分の投稿を行い、成否を返す手順
     username = account[1]
     app.logger.info(f"{username}の投稿処理を開始します")
-    try:
-        filename, caption, reply_content, start_time, end_time = get_random_post_content()
-        video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        if not os.path.exists(video_path):
-            raise FileNotFoundError(f"動画ファイルが見つかりません: {video_path}")
+    started_at = time.perf_counter()
 
-        api, client = initialize_tweepy(account)
+    def observe_total(success):
+        metrics.observe('xpost_stage_seconds', time.perf_counter() - started_at, stage='post_total', account_id=account[0])
+        metrics.inc('xpost_posts_total', account_id=account[0], result='success' if success else 'failure')
 
-        account_dict = {
-            'consumer_key': account[2],
-            'consumer_secret': account[3],
-            'access_token': account[4],
-            'access_token_secret': account[5]
-        }
+    try:
+        post_id, filename, caption, reply_content, start_time, end_time, processed_path = yield CallStep(
+            select_post_content, account[0], post_id)
 
-        success = post_tweet_main_riply(filename, caption, reply_content, account_dict, start_time, end_time)
-        
-        if success:
-            log_activity(username, "ツイート投稿", "成功")
-            return True
-        else:
-            log_activity(username, "ツイート投稿", "失敗")
-            return False
+        account_dict = account_to_dict(account)
+
+        success = yield from post_tweet_main_riply_steps(filename, caption, reply_content, account_dict, start_time, end_time,
+                                                         processed_path, job)
 
     except Exception as e:
         app.logger.error(f"{username}の投稿処理中にエラーが発生しました: {str(e)}", exc_info=True)
-        log_activity(username, "ツイート投稿", f"失敗: {str(e)}")
+        yield NotifyStep(log_activity, username, "ツイート投稿", f"失敗: {str(e)}")
+        yield NotifyStep(set_account_progress, username, 'failed')
+        observe_total(False)
         return False
 
-def post_tweet():
-    global current_status, next_post_time
+    observe_total(success)
+    if success:
+        yield NotifyStep(log_activity, username, "ツイート投稿", "成功")
+    elif job is not None and (yield CallStep(job.cancelled)):
+        yield NotifyStep(log_activity, username, "ツイート投稿", "キャンセル")
+    else:
+        yield NotifyStep(log_activity, username, "ツイート投稿", "失敗")
+    yield NotifyStep(set_account_progress, username, 'succeeded' if success else 'failed')
+    return success
+
+def post_tweet_shared_media_steps(active_accounts, post_id=None, jobs=None):
+    # 1つの動画を1回だけアップロードし、additional_ownersで全アカウントに共有して投稿する。
+    # アカウントIDごとの成否を返す手順。jobsにはアカウントIDごとの投稿ジョブを渡す
+    app.logger.info(f"メディア共有モードで一括投稿します: {len(active_accounts)}アカウント")
+    jobs = jobs or {}
+    results = {}
+
+    def cancelled(account):
+        job = jobs.get(account[0])
+        return job is not None and (yield CallStep(job.cancelled))
+
+    shareable_accounts = []
+    for account in active_accounts:
+        user_id = yield from account_user_id_steps(account)
+        if user_id:
+            shareable_accounts.append((account, user_id))
+        else:
+            # ユーザーIDが分からないアカウントは個別にアップロードして投稿する
+            app.logger.warning(f"{account[1]}はメディアを共有できないため個別に投稿します")
+            results[account[0]] = yield from post_tweet_for_account_steps(account, post_id, jobs.get(account[0]))
+
+    if not shareable_accounts:
+        return results
+
+    try:
+        post_id, filename, caption, reply_content, start_time, end_time, processed_path = yield CallStep(
+            select_post_content, None, post_id)
+        video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        first_job = jobs.get(shareable_accounts[0][0][0])
+        processing_video = yield CallStep(submit_processed_video, video_path, start_time, end_time, processed_path,
+                                          first_job.transcode_group if first_job else 'posting')
+        processed_video_path, processing_method = yield WaitStep(processing_video)
+        app.logger.info(f"動画処理が完了しました: {processed_video_path}, 処理方法: {processing_method}")
+    except Exception as e:
+        app.logger.error(f"共有する動画の準備中にエラーが発生しました: {str(e)}", exc_info=True)
+        for account, user_id in shareable_accounts:
+            yield NotifyStep(log_activity, account[1], "ツイート投稿", f"失敗: {str(e)}")
+            yield NotifyStep(set_account_progress, account[1], 'failed')
+            results[account[0]] = False
+        return results
+
+    try:
+        group_size = MAX_ADDITIONAL_OWNERS + 1
+        for i in range(0, len(shareable_accounts), group_size):
+            group = []
+            for account, user_id in shareable_accounts[i:i + group_size]:
+                if (yield from cancelled(account)):
+                    yield NotifyStep(log_activity, account[1], "ツイート投稿", "キャンセル")
+                    results[account[0]] = False
+                else:
+                    group.append((account, user_id))
+            if not group:
+                continue
+            owner_client = account_client_registry.get(account_to_dict(group[0][0]))
+            video_tweet = VideoTweet(processed_video_path, owner_client.oauth,
+                                     additional_owners=[user_id for account, user_id in group[1:]],
+                                     session=owner_client.session, account_id=owner_client.account_id)
+            for account, user_id in group:
+                yield NotifyStep(set_account_progress, account[1], 'uploading')
+            try:
+                processing = yield from video_tweet.upload_steps()
+                uploaded = processing is not None and (yield WaitStep(processing))
+            except Exception as e:
+                app.logger.error(f"共有メディアのアップロード中にエラーが発生しました: {str(e)}")
+                uploaded = False
+            if not uploaded:
+                for account, user_id in group:
+                    yield NotifyStep(log_activity, account[1], "ツイート投稿", "失敗: 共有メディアのアップロードに失敗しました")
+                    yield NotifyStep(set_account_progress, account[1], 'failed')
+                    results[account[0]] = False
+                continue
+
+            app.logger.info(f"共有メディアをアップロードしました: Media ID {video_tweet.media_id}, {len(group)}アカウント")
+            for account, user_id in group:
+                username = account[1]
+                if (yield from cancelled(account)):
+                    yield NotifyStep(log_activity, username, "ツイート投稿", "キャンセル")
+                    results[account[0]] = False
+                    continue
+                account_client = account_client_registry.get(account_to_dict(account))
+                tweet_id = yield from video_tweet.tweet_steps(account_client, caption)
+                if tweet_id:
+                    if account[0] in jobs:
+                        yield CallStep(jobs[account[0]].record_tweet, tweet_id)
+                    if reply_content:
+                        yield CallStep(reply_scheduler.schedule, account[0], tweet_id, reply_content)
+                    yield NotifyStep(log_activity, username, "ツイート投稿", "成功")
+                    yield NotifyStep(set_account_progress, username, 'succeeded')
+                    results[account[0]] = True
+                else:
+                    yield NotifyStep(log_activity, username, "ツイート投稿", "失敗")
+                    yield NotifyStep(set_account_progress, username, 'failed')
+                    results[account[0]] = False
+    finally:
+        processed_video_cache.release(processed_video_path)
+
+    return results
+
+
+# 投稿ジョブのキューの設定
+POST_JOB_LEASE_SECS = 2 * 60  # この間にリースを延長しなかったプロセスは停止したとみなす
+POST_JOB_HEARTBEAT_SECS = 15
+POST_JOB_POLL_SECS = 5
+POST_JOB_MAX_ATTEMPTS = 3  # リース切れで取り直す回数の上限
+POST_JOB_CONCURRENCY = int(os.environ.get('POST_JOB_CONCURRENCY', 4))  # 1プロセスで同時に進める投稿ジョブ数（動画変換やメディア処理を待っているジョブは数えない）
+POST_JOB_ASYNC_CONCURRENCY = int(os.environ.get('POST_JOB_ASYNC_CONCURRENCY', 32))  # ASYNC_POSTING=1の場合の1プロセスの同時実行数
+POST_GLOBAL_CONCURRENCY = int(os.environ.get('POST_GLOBAL_CONCURRENCY', 8))  # 全プロセス合計で同時に実行する投稿ジョブ数（非同期エンジンでも上限は同じ）
+POST_JOB_RETENTION_SECS = 7 * 24 * 60 * 60  # 終了したジョブを残しておく期間
+POST_JOB_PURGE_INTERVAL = 60 * 60
+POST_JOB_UNFINISHED_STATES = ('queued', 'running')
+
+def get_posting_schedule():
+    conn = get_read_db()
+    try:
+        row = conn.execute("SELECT active, interval_secs, shared_media, next_run_at FROM posting_schedule WHERE id = 1").fetchone()
+    finally:
+        conn.close()
+    return {'active': bool(row[0]), 'interval': row[1], 'shared_media': bool(row[2]), 'next_run_at': row[3]}
+
+def update_posting_schedule(**changes):
+    conn = get_db()
+    try:
+        assignments = ', '.join(f"{column} = ?" for column in changes)
+        conn.execute(f"UPDATE posting_schedule SET {assignments}, updated_at = ? WHERE id = 1",
+                     tuple(changes.values()) + (int(time.time()),))
+        conn.commit()
+    finally:
+        conn.close()
+
+class PostJobHandle:
+    # 実行中のジョブを投稿処理に渡し、キャンセルの確認とツイートIDの記録に使う
+    def __init__(self, job_id, account_id, owner):
+        self.job_id = job_id
+        self.account_id = account_id
+        self.owner = owner
+        self.transcode_group = f"post-job-{job_id}"
+
+    def cancelled(self):
+        return not post_job_queue.is_held(self.job_id, self.owner)
+
+    def record_tweet(self, tweet_id):
+        post_job_queue.record_tweet(self.job_id, self.owner, tweet_id)
+
+class PostJobQueue:
+    # post_jobsテーブルを使った投稿ジョブのキュー。ジョブはリースを取ったプロセスだけが実行し、
+    # リースが切れたジョブ（プロセスが停止した場合など）は他のプロセスが取り直す
+    def __init__(self):
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def enqueue_batch(self, accounts, shared_media, schedule_due=None):
+        # 投稿内容は積む時点で選ぶ（通常はアカウントごとのローテーション、共有モードは全員同じ動画）
+        now = int(time.time())
+        if shared_media:
+            post_ids = [get_random_post_content()[0]] * len(accounts)
+        else:
+            post_ids = [get_random_post_content(account[0])[0] for account in accounts]
+
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            if schedule_due is not None:
+                # 自動投稿は、予定時刻を最初に取り消したプロセスだけが積む
+                c.execute("UPDATE posting_schedule SET next_run_at = NULL, updated_at = ? WHERE id = 1 AND active = 1 AND next_run_at = ?",
+                          (now, schedule_due))
+                if c.rowcount == 0:
+                    conn.rollback()
+                    return None
+            c.execute("SELECT COALESCE(MAX(batch_id), 0) + 1 FROM post_jobs")
+            batch_id = c.fetchone()[0]
+            for account, post_id in zip(accounts, post_ids):
+                # アカウントは互いに独立しているので、すべてすぐに実行できるようにする（間隔は取り出すときに守る）
+                c.execute("INSERT INTO post_jobs (batch_id, account_id, video_id, shared_media, run_after, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (batch_id, account[0], post_id, int(shared_media), now, now, now))
+            conn.commit()
+        finally:
+            conn.close()
+        app.logger.info(f"投稿ジョブを追加しました: バッチ {batch_id}, {len(accounts)}件")
+        return batch_id
+
+    def claim(self, owner):
+        # 実行できるジョブを1件（共有モードは同じバッチの残りを全体の上限の空きの分まで）取り、リースを設定して返す。
+        # 全体の同時実行数の上限と、アカウントごとの投稿間隔を満たすジョブだけを取る
+        now = int(time.time())
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT COUNT(*) FROM post_jobs WHERE state = 'running' AND lease_expires_at >= ?", (now,))
+            available = POST_GLOBAL_CONCURRENCY - c.fetchone()[0]
+            if available <= 0:
+                conn.commit()
+                return []
+            claimable = """((state = 'queued' AND run_after <= ?) OR (state = 'running' AND lease_expires_at < ?))
+                           AND NOT EXISTS (SELECT 1 FROM post_jobs AS other
+                                           WHERE other.account_id = post_jobs.account_id AND other.id != post_jobs.id
+                                             AND ((other.state = 'running' AND other.lease_expires_at >= ?) OR other.started_at > ?))"""
+            params = (now, now, now, now - ACCOUNT_MIN_SPACING_SECS)
+            c.execute(f"SELECT id, batch_id, shared_media FROM post_jobs WHERE {claimable} ORDER BY run_after, id LIMIT 1", params)
+            row = c.fetchone()
+            if row is None:
+                conn.commit()
+                return []
+            if row[2]:
+                # 共有モードでもアカウントごとに1件と数える。取り切れなかった分は次の取得で別のグループとして投稿する
+                c.execute(f"SELECT id FROM post_jobs WHERE batch_id = ? AND shared_media = 1 AND {claimable} ORDER BY id LIMIT ?",
+                          (row[1],) + params + (available,))
+                job_ids = [job_id for job_id, in c.fetchall()]
+            else:
+                job_ids = [row[0]]
+            placeholders = ', '.join('?' * len(job_ids))
+            c.execute(f"UPDATE post_jobs SET state = 'running', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1, started_at = ?, updated_at = ? WHERE id IN ({placeholders})",
+                      (owner, now + POST_JOB_LEASE_SECS, now, now) + tuple(job_ids))
+            c.execute(f"SELECT id, batch_id, account_id, video_id, shared_media, attempts, tweet_id FROM post_jobs WHERE id IN ({placeholders}) ORDER BY id",
+                      tuple(job_ids))
+            jobs = c.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        return jobs
+
+    def renew(self, owner):
+        # 実行中のジョブのリースを延長し、まだ保持しているジョブのIDを返す
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("UPDATE post_jobs SET lease_expires_at = ? WHERE lease_owner = ? AND state = 'running'",
+                      (int(time.time()) + POST_JOB_LEASE_SECS, owner))
+            conn.commit()
+            c.execute("SELECT id FROM post_jobs WHERE lease_owner = ? AND state = 'running'", (owner,))
+            return {job_id for job_id, in c.fetchall()}
+        finally:
+            conn.close()
+
+    def is_held(self, job_id, owner):
+        conn = get_read_db()
+        try:
+            row = conn.execute("SELECT state, lease_owner FROM post_jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return row is not None and row[0] == 'running' and row[1] == owner
+
+    def record_tweet(self, job_id, owner, tweet_id):
+        # 結果を書く前にプロセスが止まっても、取り直したプロセスが二重に投稿しないよう先に残す
+        conn = get_db()
+        try:
+            conn.execute("UPDATE post_jobs SET tweet_id = ?, updated_at = ? WHERE id = ? AND lease_owner = ?",
+                         (str(tweet_id), int(time.time()), job_id, owner))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def finish(self, job_id, owner, state, error=None):
+        # リースを失ったジョブ（キャンセルや他のプロセスによる取り直し）の結果は書き込まない
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("UPDATE post_jobs SET state = ?, last_error = ?, lease_owner = NULL, lease_expires_at = NULL, updated_at = ? WHERE id = ? AND state = 'running' AND lease_owner = ?",
+                      (state, error, int(time.time()), job_id, owner))
+            conn.commit()
+            finished = c.rowcount > 0
+        finally:
+            conn.close()
+        self.notify()
+        return finished
+
+    def cancel_all(self):
+        # 待機中と実行中のジョブを取り消す。実行中のプロセスは次の確認でキャンセルに気付く
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("UPDATE post_jobs SET state = 'cancelled', last_error = ?, lease_expires_at = NULL, updated_at = ? WHERE state IN ('queued', 'running')",
+                      ("停止されました", int(time.time())))
+            conn.commit()
+            cancelled = c.rowcount
+        finally:
+            conn.close()
+        self.notify()
+        return cancelled
+
+    def unfinished_count(self, batch_id=None):
+        conn = get_read_db()
+        try:
+            if batch_id is None:
+                row = conn.execute("SELECT COUNT(*) FROM post_jobs WHERE state IN ('queued', 'running')").fetchone()
+            else:
+                row = conn.execute("SELECT COUNT(*) FROM post_jobs WHERE batch_id = ? AND state IN ('queued', 'running')", (batch_id,)).fetchone()
+        finally:
+            conn.close()
+        return row[0]
+
+    def batch_counts(self, batch_id):
+        conn = get_read_db()
+        try:
+            return dict(conn.execute("SELECT state, COUNT(*) FROM post_jobs WHERE batch_id = ? GROUP BY state", (batch_id,)).fetchall())
+        finally:
+            conn.close()
+
+    def wait_for_batch(self, batch_id):
+        # 他のプロセスが実行したジョブの完了にも気付けるよう、通知がなくても定期的に確認する
+        while True:
+            counts = self.batch_counts(batch_id)
+            if not any(counts.get(state) for state in POST_JOB_UNFINISHED_STATES):
+                return counts
+            with self.condition:
+                self.condition.wait(1)
+
+    def purge(self, retention_secs):
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute("DELETE FROM post_jobs WHERE state NOT IN ('queued', 'running') AND updated_at < ?",
+                      (int(time.time()) - retention_secs,))
+            conn.commit()
+            return c.rowcount
+        finally:
+            conn.close()
+
+post_job_queue = PostJobQueue()
+
+class PostJobWorker:
+    # 各プロセスで動き、自動投稿の予定時刻になったらジョブを積み、実行できるジョブを取って投稿する
+    def __init__(self, concurrency):
+        self.owner = None
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.held = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.published_schedule = None
+        self.last_purge = 0
+
+    def start(self):
+        # リースの所有者はホスト・プロセスごとに区別する
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        threading.Thread(target=self._run, name='post-job-worker', daemon=True).start()
+        threading.Thread(target=self._heartbeat, name='post-job-heartbeat', daemon=True).start()
+        app.logger.info(f"投稿ジョブのワーカーを開始しました: {self.owner}")
+
+    def _run(self):
+        while True:
+            try:
+                self._tick_schedule()
+                self._claim_available()
+                if time.time() - self.last_purge > POST_JOB_PURGE_INTERVAL:
+                    self.last_purge = time.time()
+                    post_job_queue.purge(POST_JOB_RETENTION_SECS)
+            except Exception as e:
+                app.logger.error(f"投稿ジョブの処理中にエラーが発生しました: {str(e)}", exc_info=True)
+            self.wakeup.wait(POST_JOB_POLL_SECS)
+            self.wakeup.clear()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(POST_JOB_HEARTBEAT_SECS)
+            try:
+                with self.lock:
+                    if not self.held:
+                        continue
+                held = post_job_queue.renew(self.owner)
+                self._drop_lost(held)
+            except Exception as e:
+                app.logger.error(f"投稿ジョブのリース延長中にエラーが発生しました: {str(e)}")
+
+    def _drop_lost(self, held):
+        # キャンセルされたジョブの動画変換は、このプロセスで実行しているものを止める
+        with self.lock:
+            lost = [handle for job_id, handle in self.held.items() if job_id not in held]
+        for handle in lost:
+            transcode_executor.cancel_all(handle.transcode_group)
+
+    def cancel_local(self):
+        self._drop_lost(set())
+
+    def _tick_schedule(self):
+        schedule = get_posting_schedule()
+        self._publish(schedule)
+        if not schedule['active'] or post_job_queue.unfinished_count():
+            return
+        now = int(time.time())
+        if schedule['next_run_at'] is None:
+            # 前回のバッチが終わったので、そこから間隔を空けて次回を予定する
+            update_posting_schedule(next_run_at=now + schedule['interval'])
+            update_status("待機中")
+            socketio.emit('status', {'message': '一括ツイートが完了しました'})
+            self._publish(get_posting_schedule())
+            return
+        if schedule['next_run_at'] > now:
+            return
+        active_accounts = get_active_accounts()
+        try:
+            if not active_accounts:
+                raise Exception("アクティブなTwitterアカウントがありません")
+            batch_id = post_job_queue.enqueue_batch(active_accounts, schedule['shared_media'], schedule_due=schedule['next_run_at'])
+        except Exception as e:
+            app.logger.error(f"自動投稿のジョブを追加できませんでした: {str(e)}")
+            update_posting_schedule(next_run_at=now + schedule['interval'])
+            return
+        if batch_id is not None:
+            update_status("一括ツイート処理中")
+            self._publish(get_posting_schedule())
+
+    def _publish(self, schedule):
+        # 他のプロセスで変更された自動投稿の状態もダッシュボードに反映する
+        if schedule != self.published_schedule:
+            self.published_schedule = schedule
+            publish_auto_posting_status(schedule)
+
+    def _claim_available(self):
+        while self.slots.acquire(blocking=False):
+            jobs = post_job_queue.claim(self.owner)
+            if not jobs:
+                self.slots.release()
+                return
+            handles = [PostJobHandle(job[0], job[2], self.owner) for job in jobs]
+            with self.lock:
+                for handle in handles:
+                    self.held[handle.job_id] = handle
+            steps = self._execute_steps(jobs, handles)
+            if ASYNC_POSTING:
+                # ジョブごとにスレッドを立てず、イベントループで進める
+                async_posting_engine.submit(async_posting_engine.run_steps(steps))
+            else:
+                # 動画変換やメディア処理を待つ間は枠を返し、完了したら枠を取り直して続きを進める
+                start_steps(steps, 'post-job', on_suspend=self.slots.release, on_resume=self.slots.acquire)
+
+    def _runnable(self, jobs, handles):
+        # 実行済み・実行できないジョブを終わらせ、残りを(ジョブ, ハンドル, アカウント)の形で返す
+        runnable = []
+        for job, handle in zip(jobs, handles):
+            job_id, batch_id, account_id, video_id, shared_media, attempts, tweet_id = job
+            if tweet_id:
+                # 前のプロセスが投稿を済ませた後に止まった場合は投稿し直さない
+                self._finish(handle, 'succeeded')
+            elif attempts > POST_JOB_MAX_ATTEMPTS:
+                self._finish(handle, 'failed', "実行中のプロセスが繰り返し停止しました")
+            else:
+                runnable.append((job, handle))
+        if not runnable:
+            return []
+
+        accounts = {}
+        conn = get_read_db()
+        try:
+            for job, handle in runnable:
+                account = conn.execute("SELECT * FROM twitter_accounts WHERE id = ?", (handle.account_id,)).fetchone()
+                if account is None or not account[6]:
+                    self._finish(handle, 'cancelled', "アカウントが削除されたか投稿対象から外されました")
+                else:
+                    accounts[handle.account_id] = account
+        finally:
+            conn.close()
+        return [(job, handle, accounts[handle.account_id]) for job, handle in runnable if handle.account_id in accounts]
+
+    def _execute_steps(self, jobs, handles):
+        try:
+            runnable = yield CallStep(self._runnable, jobs, handles)
+            if not runnable:
+                return
+
+            if runnable[0][0][4]:
+                results = yield from post_tweet_shared_media_steps([account for job, handle, account in runnable], runnable[0][0][3],
+                                                                   {handle.account_id: handle for job, handle, account in runnable})
+                for job, handle, account in runnable:
+                    yield CallStep(self._finish, handle, 'succeeded' if results.get(handle.account_id) else 'failed')
+            else:
+                job, handle, account = runnable[0]
+                success = yield from post_tweet_for_account_steps(account, job[3], handle)
+                yield CallStep(self._finish, handle, 'succeeded' if success else 'failed')
+        except Exception as e:
+            app.logger.error(f"投稿ジョブの実行中にエラーが発生しました: {str(e)}", exc_info=True)
+            for handle in handles:
+                yield CallStep(self._finish, handle, 'failed', str(e))
+        finally:
+            self.slots.release()
+            self.wakeup.set()
+
+    def _finish(self, handle, state, error=None):
+        with self.lock:
+            if self.held.pop(handle.job_id, None) is None:
+                return
+        post_job_queue.finish(handle.job_id, self.owner, state, error)
+
+post_job_worker = PostJobWorker(POST_JOB_ASYNC_CONCURRENCY if ASYNC_POSTING else POST_JOB_CONCURRENCY)
+
+background_services_started = False
+background_services_lock = threading.Lock()
+
+def start_background_services():
+    # バックグラウンドのスレッドはインポート時ではなく、サーバーとして動くプロセスでだけ起動する
+    # （spawnされた動画変換ワーカーなど、appを読み込むだけのプロセスでは起動しない）
+    global background_services_started
+    with background_services_lock:
+        if background_services_started:
+            return
+        background_services_started = True
+    ingest_pipeline.start()
+    reply_scheduler.start()
+    threading.Thread(target=run_activity_log_retention, name="activity-log-retention", daemon=True).start()
+    post_job_worker.start()
+    app.logger.info("バックグラウンド処理を開始しました")
+
+class BackgroundServicesMiddleware:
+    # gunicornなど__main__を通らないサーバーでは最初のリクエストで起動する。
+    # Socket.IOのミドルウェアより外側に置き、Socket.IOだけの通信でも起動する
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if not background_services_started:
+            start_background_services()
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = BackgroundServicesMiddleware(app.wsgi_app)
+
+def post_tweet(shared_media=False):
+    # ジョブとしてキューに積み、どのプロセスが実行したかにかかわらずバッチ全体の完了を待つ
     app.logger.info("一括ツイート投稿処理を開始します")
     update_status("一括ツイート処理中")
     
@@ -529,30 +4256,24 @@ def post_tweet():
         update_status("エラー: アクティブなアカウントがありません")
         return False
 
-    success_count = 0
-    for account in active_accounts:
-        if post_tweet_for_account(account):
-            success_count += 1
-        time.sleep(60)  # アカウント間に1分の待機時間を設ける
+    try:
+        batch_id = post_job_queue.enqueue_batch(active_accounts, shared_media)
+    except Exception as e:
+        app.logger.error(f"投稿ジョブを追加できませんでした: {str(e)}")
+        update_status(f"エラー: {str(e)}")
+        return False
+    post_job_worker.wakeup.set()
+    counts = post_job_queue.wait_for_batch(batch_id)
+    success_count = counts.get('succeeded', 0)
 
     app.logger.info(f"一括ツイート投稿処理が完了しました。成功: {success_count}/{len(active_accounts)}")
     
     update_status("待機中")
-    if auto_posting_thread:
-        next_post_time = datetime.now() + timedelta(seconds=auto_posting_interval)
-    
     return True
 
-def auto_post_tweet():
-    global auto_posting_thread, next_post_time
-    while auto_posting_thread:
-        post_tweet()
-        socketio.emit('status', {'message': '一括ツイートが完了しました'})
-        time.sleep(auto_posting_interval)
-
 @socketio.on('post_tweet')
-def handle_post_tweet():
-    success = post_tweet()
+def handle_post_tweet(data=None):
+    success = post_tweet(shared_media=bool((data or {}).get('shared_media', False)))
     if success:
         emit('status', {'message': '一括ツイートが完了しました'})
     else:
@@ -560,50 +4281,72 @@ def handle_post_tweet():
 
 @socketio.on('start_auto_posting')
 def start_auto_posting(data):
-    global auto_posting_thread, auto_posting_interval, next_post_time
     interval = data.get('interval', 0)
     if interval <= 0:
         emit('status', {'message': '無効な間隔です。正の整数を指定してください。'})
         return
     
-    auto_posting_interval = interval * 60  # 分を秒に変換
-    
-    if auto_posting_thread is None:
-        auto_posting_thread = threading.Thread(target=auto_post_tweet)
-        auto_posting_thread.start()
-        next_post_time = datetime.now() + timedelta(seconds=auto_posting_interval)
-        app.logger.info(f"自動投稿を開始しました。間隔: {interval}分")
-        emit('status', {'message': f'自動投稿を開始しました。間隔: {interval}分'})
-        log_activity("System", "自動投稿開始", f"間隔: {interval}分")
-        update_status("自動投稿中")
-    else:
+    if get_posting_schedule()['active']:
         emit('status', {'message': '自動投稿は既に実行中です。'})
+        return
+
+    # 開始直後に1回目を投稿し、以降はバッチの完了から間隔を空けて投稿する
+    update_posting_schedule(active=1, interval_secs=interval * 60, shared_media=int(bool(data.get('shared_media', False))),
+                            next_run_at=int(time.time()))
+    post_job_worker.wakeup.set()
+    publish_auto_posting_status()
+    app.logger.info(f"自動投稿を開始しました。間隔: {interval}分")
+    emit('status', {'message': f'自動投稿を開始しました。間隔: {interval}分'})
+    log_activity("System", "自動投稿開始", f"間隔: {interval}分")
+    update_status("自動投稿中")
 
 @socketio.on('stop_auto_posting')
 def stop_auto_posting():
-    global auto_posting_thread, next_post_time
-    if auto_posting_thread:
-        auto_posting_thread = None
-        next_post_time = None
-        app.logger.info("自動投稿を停止しました。")
+    active = get_posting_schedule()['active']
+    if active or post_job_queue.unfinished_count():
+        update_posting_schedule(active=0, next_run_at=None)
+        cancelled = post_job_queue.cancel_all()
+        post_job_worker.cancel_local()
+        publish_auto_posting_status()
+        app.logger.info(f"自動投稿を停止しました。キャンセルしたジョブ: {cancelled}件")
         emit('status', {'message': '自動投稿を停止しました。'})
-        log_activity("System", "自動投稿停止", "ユーザーにより停止されました")
+        log_activity("System", "自動投稿停止", f"ユーザーにより停止されました（キャンセルしたジョブ: {cancelled}件）")
         update_status("待機中")
     else:
         emit('status', {'message': '自動投稿は実行されていません。'})
 
 @socketio.on('get_app_status')
-def get_app_status():
-    global current_status, auto_posting_interval, next_post_time
-    status = {
-        'current_status': current_status,
-        'auto_posting_active': auto_posting_thread is not None,
-        'auto_posting_interval': auto_posting_interval // 60,  # 秒を分に変換
-        'next_post_time': next_post_time.isoformat() if next_post_time else None,
-        'recent_activities': get_recent_activities()
-    }
+def get_app_status(data=None):
+    # 再接続したクライアントには、受け取り済みの連番以降の差分だけを送る
+    since = (data or {}).get('since')
+    if since is not None:
+        deltas = status_model.deltas_since(int(since))
+        if deltas is not None:
+            emit('status_deltas', {'deltas': deltas})
+            app.logger.info(f"アプリケーションの状態の差分を送信しました: {len(deltas)}件")
+            return
+    status = status_model.snapshot()
     emit('app_status', status)
-    app.logger.info(f"アプリケーションの状態を送信しました: {status}")
+    app.logger.info(f"アプリケーションの状態を送信しました: 連番 {status['seq']}")
+
+@app.route('/api/activities', methods=['GET'])
+def get_activities():
+    limit = max(1, min(request.args.get('limit', 50, type=int), ACTIVITY_PAGE_MAX_LIMIT))
+    try:
+        activities, next_cursor = query_activities(limit, request.args.get('cursor'),
+                                                   request.args.get('account'), request.args.get('action'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'activities': activities, 'next_cursor': next_cursor})
+
+@app.route('/api/activities/daily', methods=['GET'])
+def get_activities_daily():
+    days = max(1, request.args.get('days', 30, type=int))
+    return jsonify(get_activity_daily_stats(request.args.get('account'), days))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/manage_posts')
 def manage_posts():
@@ -611,19 +4354,13 @@ def manage_posts():
 
 @app.route('/api/posts', methods=['GET'])
 def get_posts():
-    conn = sqlite3.connect('videos.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM videos")
-    posts = c.fetchall()
-    conn.close()
-    return jsonify([{
-        'id': p[0], 
-        'filename': p[1], 
-        'caption': p[2], 
-        'reply_content': p[3], 
-        'start_time': p[4] if p[4] is not None else '', 
-        'end_time': p[5] if p[5] is not None else ''
-    } for p in posts])
+    return video_listing_response(VIDEO_LIST_FIELDS, {
+        'original_filename': blank_if_none,
+        'content_hash': blank_if_none,
+        'start_time': blank_if_none,
+        'end_time': blank_if_none,
+        'processing_status': blank_if_none
+    }, "投稿一覧")
 
 @app.route('/api/posts', methods=['POST'])
 def add_post():
@@ -634,42 +4371,71 @@ def add_post():
     reply_content = request.form.get('reply_content', '')
     start_time = request.form.get('start_time', '')
     end_time = request.form.get('end_time', '')
+    weight = normalize_weight(request.form.get('weight', 1))
     if file.filename == '':
         return jsonify({'error': 'ファイルが選択されていません'}), 400
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        upload = StagedUpload(file)
+        filename = upload.filename
         start_time = int(start_time) if start_time else None
         end_time = int(end_time) if end_time else None
-        insert_video_data(filename, caption, reply_content, start_time, end_time)
-        log_activity("System", "投稿追加", f"ファイル名: {filename}, 開始時間: {start_time}, 終了時間: {end_time}")
-        app.logger.info(f"新しい投稿を追加しました: {filename}, 開始時間: {start_time}, 終了時間: {end_time}")
-        return jsonify({'message': '投稿が追加されました', 'filename': filename}), 201
+        metadata = probe_video_metadata(upload.temp_path)
+        error = validate_video_metadata(upload.filename, metadata) or validate_trim_window(
+            start_time, end_time, metadata['duration'] if metadata else None)
+        if error:
+            upload.discard()
+            return jsonify({'error': error}), 400
+        post_id = insert_video_data(upload.filename, caption, reply_content, start_time, end_time, weight,
+                                    upload.content_hash, upload.original_filename, metadata)
+        if not post_id:
+            upload.discard()
+            return jsonify({'error': '動画の保存に失敗しました'}), 500
+        try:
+            upload.commit()
+        except OSError as e:
+            # ファイルを置けなかった場合は追加した行も取り消す
+            app.logger.error(f"動画ファイルの保存に失敗しました: {str(e)}")
+            upload.discard()
+            remove_video_row(post_id)
+            return jsonify({'error': '動画の保存に失敗しました'}), 500
+        ingest_pipeline.enqueue(post_id)
+        log_activity("System", "投稿追加", f"ファイル名: {upload.original_filename}, 開始時間: {start_time}, 終了時間: {end_time}")
+        app.logger.info(f"新しい投稿を追加しました: {filename} ({upload.original_filename}), 開始時間: {start_time}, 終了時間: {end_time}")
+        return jsonify({'message': '投稿が追加されました', 'filename': filename, 'original_filename': upload.original_filename,
+                        'content_hash': upload.content_hash}), 201
     return jsonify({'error': '許可されていないファイル形式です'}), 400
 
 @app.route('/api/posts/<int:post_id>', methods=['GET'])
 def get_post(post_id):
-    conn = sqlite3.connect('videos.db')
+    conn = get_read_db()
     c = conn.cursor()
+    # 後から追加した列の位置に依存しないよう、列名で読む（プールした接続は共有するのでカーソルにだけ設定する）
+    c.row_factory = sqlite3.Row
     c.execute("SELECT * FROM videos WHERE id = ?", (post_id,))
     post = c.fetchone()
     conn.close()
     if post:
         return jsonify({
-            'id': post[0], 
-            'filename': post[1], 
-            'caption': post[2], 
-            'reply_content': post[3], 
-            'start_time': post[4] if post[4] is not None else '', 
-            'end_time': post[5] if post[5] is not None else ''
+            'id': post['id'], 
+            'filename': post['filename'], 
+            'original_filename': post['original_filename'] or '',
+            'content_hash': post['content_hash'] or '',
+            'caption': post['caption'], 
+            'reply_content': post['reply_content'], 
+            'start_time': post['start_time'] if post['start_time'] is not None else '', 
+            'end_time': post['end_time'] if post['end_time'] is not None else '',
+            'processing_status': post['processing_status'] or '',
+            'processing_error': post['processing_error'] or '',
+            'weight': post['weight'],
+            **{column: post[column] for column in VIDEO_METADATA_COLUMNS}
         })
     return jsonify({'error': '投稿が見つかりません'}), 404
 
 @app.route('/api/posts/<int:post_id>', methods=['PUT'])
 def update_post(post_id):
-    conn = sqlite3.connect('videos.db')
+    conn = get_db()
     c = conn.cursor()
+    c.row_factory = sqlite3.Row
     
     c.execute("SELECT * FROM videos WHERE id = ?", (post_id,))
     existing_post = c.fetchone()
@@ -677,33 +4443,82 @@ def update_post(post_id):
         conn.close()
         return jsonify({'error': '投稿が見つかりません'}), 404
 
-    caption = request.form.get('caption', existing_post[2])
-    reply_content = request.form.get('reply_content', existing_post[3])
+    caption = request.form.get('caption', existing_post['caption'])
+    reply_content = request.form.get('reply_content', existing_post['reply_content'])
     start_time = request.form.get('start_time', '')
     end_time = request.form.get('end_time', '')
+    weight = normalize_weight(request.form.get('weight', existing_post['weight']))
     
+    filename = existing_post['filename']
+    content_hash = existing_post['content_hash']
+    original_filename = existing_post['original_filename']
+    upload = None
     if 'file' in request.files:
         file = request.files['file']
         if file.filename != '' and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            old_filepath = os.path.join(app.config['UPLOAD_FOLDER'], existing_post[1])
-            if os.path.exists(old_filepath):
-                os.remove(old_filepath)
-            new_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(new_filepath)
-            app.logger.info(f"新しい動画ファイルをアップロードしました: {new_filepath}")
-        else:
-            filename = existing_post[1]
-    else:
-        filename = existing_post[1]
+            upload = StagedUpload(file)
+            filename = upload.filename
+            content_hash = upload.content_hash
+            original_filename = upload.original_filename
 
     start_time = int(start_time) if start_time else None
     end_time = int(end_time) if end_time else None
 
-    c.execute("UPDATE videos SET filename = ?, caption = ?, reply_content = ?, start_time = ?, end_time = ? WHERE id = ?",
-              (filename, caption, reply_content, start_time, end_time, post_id))
+    # 差し替えられたファイルと、メタデータが未保存の既存ファイルだけを読み取る
+    metadata = None
+    error = None
+    if upload:
+        metadata = probe_video_metadata(upload.temp_path)
+        error = validate_video_metadata(upload.filename, metadata)
+    elif existing_post['duration'] is None:
+        metadata = probe_video_metadata(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    duration = metadata['duration'] if metadata else existing_post['duration']
+    error = error or validate_trim_window(start_time, end_time, duration)
+    if error:
+        if upload:
+            upload.discard()
+        conn.close()
+        return jsonify({'error': error}), 400
+
+    c.execute("UPDATE videos SET filename = ?, caption = ?, reply_content = ?, start_time = ?, end_time = ?, weight = ?, content_hash = ?, original_filename = ? WHERE id = ?",
+              (filename, caption, reply_content, start_time, end_time, weight, content_hash, original_filename, post_id))
+    if metadata:
+        c.execute(f"UPDATE videos SET {', '.join(f'{column} = ?' for column in VIDEO_METADATA_COLUMNS)} WHERE id = ?",
+                  tuple(metadata.get(column) for column in VIDEO_METADATA_COLUMNS) + (post_id,))
     conn.commit()
     conn.close()
+
+    if upload:
+        try:
+            upload.commit()
+        except OSError as e:
+            # ファイルを置けなかった場合は行を更新前の内容に戻す
+            app.logger.error(f"動画ファイルの保存に失敗しました: {str(e)}")
+            upload.discard()
+            conn = get_db()
+            c = conn.cursor()
+            try:
+                c.execute("UPDATE videos SET filename = ?, caption = ?, reply_content = ?, start_time = ?, end_time = ?, weight = ?, content_hash = ?, original_filename = ? WHERE id = ?",
+                          tuple(existing_post[column] for column in ('filename', 'caption', 'reply_content', 'start_time', 'end_time', 'weight',
+                                                                     'content_hash', 'original_filename')) + (post_id,))
+                if metadata:
+                    c.execute(f"UPDATE videos SET {', '.join(f'{column} = ?' for column in VIDEO_METADATA_COLUMNS)} WHERE id = ?",
+                              tuple(existing_post[column] for column in VIDEO_METADATA_COLUMNS) + (post_id,))
+                conn.commit()
+            finally:
+                conn.close()
+            return jsonify({'error': '動画の保存に失敗しました'}), 500
+        app.logger.info(f"新しい動画ファイルをアップロードしました: {upload.path}")
+    content_selector.update(post_id, weight=weight)
+
+    # 同じ内容のファイルがアップロードされた場合は差し替えとして扱わない
+    file_replaced = filename != existing_post['filename']
+    if file_replaced:
+        release_upload(existing_post['filename'])
+
+    # 動画ファイルや切り取り範囲が変わった場合は変換をやり直す
+    if file_replaced or start_time != existing_post['start_time'] or end_time != existing_post['end_time']:
+        ingest_pipeline.enqueue(post_id)
     
     log_activity("System", "投稿更新", f"投稿ID: {post_id}, 開始時間: {start_time}, 終了時間: {end_time}")
     app.logger.info(f"投稿を更新しました: ID {post_id}, 開始時間: {start_time}, 終了時間: {end_time}")
@@ -711,7 +4526,7 @@ def update_post(post_id):
 
 @app.route('/api/posts/<int:post_id>', methods=['DELETE'])
 def delete_post(post_id):
-    conn = sqlite3.connect('videos.db')
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("SELECT filename FROM videos WHERE id = ?", (post_id,))
@@ -723,11 +4538,8 @@ def delete_post(post_id):
     c.execute("DELETE FROM videos WHERE id = ?", (post_id,))
     conn.commit()
     conn.close()
-
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], post[0])
-    if os.path.exists(filepath):
-        os.remove(filepath)
-        app.logger.info(f"動画ファイルを削除しました: {filepath}")
+    content_selector.remove(post_id)
+    release_upload(post[0])
 
     log_activity("System", "投稿削除", f"投稿ID: {post_id}")
     app.logger.info(f"投稿を削除しました: ID {post_id}")
@@ -739,7 +4551,7 @@ def manage_accounts():
 
 @app.route('/api/accounts', methods=['GET'])
 def get_accounts():
-    conn = sqlite3.connect('videos.db')
+    conn = get_read_db()
     c = conn.cursor()
     c.execute("SELECT id, username, post_flag FROM twitter_accounts")
     accounts = c.fetchall()
@@ -756,7 +4568,7 @@ def add_account():
     access_token_secret = data.get('access_token_secret')
     post_flag = data.get('post_flag', 0)
 
-    conn = sqlite3.connect('videos.db')
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute("""
@@ -777,7 +4589,7 @@ def add_account():
 
 @app.route('/api/accounts/<int:account_id>', methods=['GET'])
 def get_account(account_id):
-    conn = sqlite3.connect('videos.db')
+    conn = get_read_db()
     c = conn.cursor()
     c.execute("SELECT id, username, post_flag FROM twitter_accounts WHERE id = ?", (account_id,))
     account = c.fetchone()
@@ -796,16 +4608,17 @@ def update_account(account_id):
     access_token_secret = data.get('access_token_secret')
     post_flag = data.get('post_flag')
 
-    conn = sqlite3.connect('videos.db')
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute("""
             UPDATE twitter_accounts 
             SET username = ?, consumer_key = ?, consumer_secret = ?, 
-                access_token = ?, access_token_secret = ?, post_flag = ?
+                access_token = ?, access_token_secret = ?, post_flag = ?, user_id = NULL
             WHERE id = ?
         """, (username, consumer_key, consumer_secret, access_token, access_token_secret, post_flag, account_id))
         conn.commit()
+        account_client_registry.invalidate(account_id)
         app.logger.info(f"Twitterアカウントを更新しました: {username}")
         log_activity("System", "アカウント更新", f"アカウントID: {account_id}")
         return jsonify({'message': 'アカウントが更新されました', 'id': account_id})
@@ -817,13 +4630,15 @@ def update_account(account_id):
 
 @app.route('/api/accounts/<int:account_id>', methods=['DELETE'])
 def delete_account(account_id):
-    conn = sqlite3.connect('videos.db')
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute("DELETE FROM twitter_accounts WHERE id = ?", (account_id,))
         conn.commit()
+        account_client_registry.invalidate(account_id)
         if c.rowcount == 0:
             return jsonify({'error': 'アカウントが見つかりません'}), 404
+        content_selector.forget_account(account_id)
         app.logger.info(f"Twitterアカウントを削除しました: ID {account_id}")
         log_activity("System", "アカウント削除", f"アカウントID: {account_id}")
         return jsonify({'message': 'アカウントが削除されました', 'id': account_id})
@@ -835,4 +4650,7 @@ def delete_account(account_id):
 
 if __name__ == '__main__':
     app.logger.info("アプリケーションを起動します")
+    # デバッグ用のリローダーでは、監視用の親プロセスではなくサーバーを動かす子プロセスで起動する
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     socketio.run(app, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
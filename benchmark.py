@@ -0,0 +1,488 @@
+import argparse
+import atexit
+import http.server
+import json
+import math
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+# 本番のAPIに接続せずに投稿処理のスループットを計測するためのベンチマーク。
+# INIT/APPEND/FINALIZE/STATUSとツイート作成を実装したローカルのダミーサーバーに対して
+# post_tweetとVideoTweetを実行し、段階ごとの所要時間や送受信量を出力する。
+#
+#   python benchmark.py --accounts 5 --videos 3 --latency-ms 50 --bandwidth-mbps 20
+#   python benchmark.py --output result.json
+#   python benchmark.py --baseline result.json  # 前回の結果より遅くなっていれば終了コード1
+
+BODY_READ_SIZE = 64 * 1024
+RATE_LIMIT_WINDOW_SECS = 1
+REGRESSION_MIN_SLACK_SECS = 0.05  # ごく短い段階の揺らぎで誤検知しないための余裕
+
+class FakeTwitterAPI:
+    # メディアアップロードとツイート作成を模したHTTPサーバー。遅延・帯域・エラー率を指定できる
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, rate_limit_rate=0.0, processing_secs=0.0, seed=None,
+                 rate_limit=None, rate_limit_window=15 * 60):
+        self.latency = latency
+        self.bandwidth = bandwidth  # 接続ごとのバイト/秒（Noneなら無制限）
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.processing_secs = processing_secs
+        # アクセストークン・エンドポイントごとのウィンドウ内の上限（x-rate-limit-*ヘッダーを返す）
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.windows = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_media_id = 1000
+        self.finalized_at = {}
+        self.tweets = []
+        self.requests = {}
+        self.injected = {'error': 0, 'rate_limited': 0}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.server = None
+
+    def start(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                api.handle(self, 'GET')
+
+            def do_POST(self):
+                api.handle(self, 'POST')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'injected': dict(self.injected),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'tweets': len(self.tweets)
+            }
+
+    def media_tweet_count(self):
+        with self.lock:
+            return sum(1 for tweet in self.tweets if 'media' in tweet)
+
+    def _read_body(self, handler):
+        # 帯域制限がある場合は受信した量に応じて待つ
+        remaining = int(handler.headers.get('Content-Length', 0))
+        chunks = []
+        while remaining > 0:
+            chunk = handler.rfile.read(min(BODY_READ_SIZE, remaining))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+        return b''.join(chunks)
+
+    def _send(self, handler, code, obj=None, headers=None):
+        body = json.dumps(obj).encode() if obj is not None else b''
+        headers = dict(getattr(handler, 'rate_limit_headers', {}), **(headers or {}))
+        handler.send_response(code)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+        # ステータス行とヘッダーはおおよその長さで数える
+        with self.lock:
+            self.bytes_out += len(body) + 128 + sum(len(name) + len(str(value)) + 4 for name, value in headers.items())
+
+    def _token(self, handler):
+        match = re.search(r'oauth_token="([^"]*)"', handler.headers.get('Authorization', ''))
+        return match.group(1) if match else ''
+
+    def _count_rate_limit(self, handler, method):
+        # 上限を超えたらFalseを返す。ヘッダーは以降のレスポンスにすべて付ける
+        key = (self._token(handler), method, urllib.parse.urlparse(handler.path).path)
+        now = time.time()
+        with self.lock:
+            count, reset_at = self.windows.get(key, (0, 0))
+            if now >= reset_at:
+                count, reset_at = 0, int(now) + self.rate_limit_window
+            count += 1
+            self.windows[key] = (count, reset_at)
+        handler.rate_limit_headers = {'x-rate-limit-limit': str(self.rate_limit),
+                                      'x-rate-limit-remaining': str(max(0, self.rate_limit - count)),
+                                      'x-rate-limit-reset': str(reset_at)}
+        return count <= self.rate_limit
+
+    def _command(self, handler, method, body):
+        path = urllib.parse.urlparse(handler.path)
+        if path.path.endswith('/tweets'):
+            return 'TWEET', None
+        if path.path.endswith('/users/me'):
+            return 'USERS_ME', None
+        if method == 'GET':
+            return 'STATUS', urllib.parse.parse_qs(path.query)
+        if handler.headers.get('Content-Type', '').startswith('multipart'):
+            return 'APPEND', None
+        params = urllib.parse.parse_qs(body.decode())
+        return params.get('command', ['UNKNOWN'])[0], params
+
+    def handle(self, handler, method):
+        body = self._read_body(handler)
+        command, params = self._command(handler, method, body)
+        with self.lock:
+            self.bytes_in += len(body) + len(handler.requestline) + len(str(handler.headers))
+            self.requests[command] = self.requests.get(command, 0) + 1
+            roll = self.random.random()
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.rate_limit and not self._count_rate_limit(handler, method):
+            with self.lock:
+                self.injected['rate_limited'] += 1
+            return self._send(handler, 429, {'errors': [{'message': 'Too Many Requests'}]})
+        if roll < self.rate_limit_rate:
+            with self.lock:
+                self.injected['rate_limited'] += 1
+            reset = int(time.time()) + RATE_LIMIT_WINDOW_SECS
+            return self._send(handler, 429, {'errors': [{'message': 'Too Many Requests'}]},
+                              {'x-rate-limit-limit': '300', 'x-rate-limit-remaining': '0',
+                               'x-rate-limit-reset': str(reset), 'Retry-After': str(RATE_LIMIT_WINDOW_SECS)})
+        if roll < self.rate_limit_rate + self.error_rate:
+            with self.lock:
+                self.injected['error'] += 1
+            return self._send(handler, 503, {'errors': [{'message': 'Service Unavailable'}]})
+
+        if command == 'INIT':
+            with self.lock:
+                self.next_media_id += 1
+                media_id = self.next_media_id
+            return self._send(handler, 202, {'media_id': media_id, 'media_id_string': str(media_id), 'expires_after_secs': 86400})
+        if command == 'APPEND':
+            return self._send(handler, 204)
+        if command == 'FINALIZE':
+            media_id = int(params['media_id'][0])
+            with self.lock:
+                self.finalized_at[media_id] = time.time()
+            response = {'media_id': media_id, 'media_id_string': str(media_id)}
+            if self.processing_secs > 0:
+                response['processing_info'] = {'state': 'pending', 'check_after_secs': math.ceil(self.processing_secs)}
+            return self._send(handler, 201, response)
+        if command == 'STATUS':
+            media_id = int(params['media_id'][0])
+            with self.lock:
+                finalized_at = self.finalized_at.get(media_id)
+            if finalized_at is None:
+                return self._send(handler, 400, {'errors': [{'message': 'Invalid media_id'}]})
+            remaining = self.processing_secs - (time.time() - finalized_at)
+            if remaining > 0:
+                return self._send(handler, 200, {'media_id': media_id, 'processing_info': {
+                    'state': 'in_progress', 'check_after_secs': max(1, math.ceil(remaining))}})
+            return self._send(handler, 200, {'media_id': media_id, 'processing_info': {'state': 'succeeded', 'progress_percent': 100}})
+        if command == 'TWEET':
+            tweet = json.loads(body or b'{}')
+            with self.lock:
+                self.tweets.append(tweet)
+                tweet_id = str(len(self.tweets))
+            return self._send(handler, 201, {'data': {'id': tweet_id, 'text': tweet.get('text', '')}})
+        if command == 'USERS_ME':
+            # アクセストークンごとに別のユーザーIDを返す
+            token = self._token(handler)
+            return self._send(handler, 200, {'data': {'id': str(abs(hash(token)) % 10 ** 12), 'username': token}})
+        return self._send(handler, 400, {'errors': [{'message': f'Unknown command: {command}'}]})
+
+class StageRecorder:
+    # メトリクスに記録された所要時間を、ベンチマークの区間ごとに生の値のまま集める
+    def __init__(self, metrics):
+        self.samples = {}
+        self.phase = None
+        self.lock = threading.Lock()
+        self.observe = metrics.observe
+        metrics.observe = self.record
+
+    def record(self, name, value, **labels):
+        self.observe(name, value, **labels)
+        if name != 'xpost_stage_seconds' or self.phase is None:
+            return
+        with self.lock:
+            self.samples.setdefault(self.phase, {}).setdefault(labels.get('stage', ''), []).append(value)
+
+    def summary(self, phase):
+        with self.lock:
+            stages = {stage: sorted(values) for stage, values in self.samples.get(phase, {}).items()}
+        return {stage: {
+            'count': len(values),
+            'p50': round(percentile(values, 0.5), 4),
+            'p99': round(percentile(values, 0.99), 4),
+            'max': round(values[-1], 4)
+        } for stage, values in stages.items()}
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def peak_rss_mb():
+    # Linuxはキロバイト、macOSはバイト単位で返る
+    unit = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return {'self': round(own / 1024 / 1024, 1), 'children': round(children / 1024 / 1024, 1)}
+
+def generate_videos(ffmpeg_binary, folder, count, seconds, size):
+    # 内容が重複しないよう、動画ごとに音の周波数と映像のパターンを変える
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f'bench_{i}.mp4')
+        subprocess.run([
+            ffmpeg_binary, '-y', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=30:duration={seconds}',
+            '-f', 'lavfi', '-i', f'sine=frequency={440 + 20 * i}:duration={seconds}',
+            '-vf', f'hue=h={i * 37 % 360}',
+            '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest', path
+        ], check=True)
+        paths.append(path)
+    return paths
+
+def setup_data(appmod, args):
+    upload_folder = appmod.app.config['UPLOAD_FOLDER']
+    video_ids = []
+    for i, path in enumerate(generate_videos(appmod.FFMPEG_BINARY, upload_folder, args.videos, args.video_seconds, args.video_size)):
+        filename = os.path.basename(path)
+        video_ids.append(appmod.insert_video_data(filename, f'benchmark {i}', f'benchmark reply {i}', None, None,
+                                                  original_filename=filename, metadata=appmod.probe_video_metadata(path)))
+
+    conn = appmod.get_db()
+    try:
+        for i in range(args.accounts):
+            conn.execute("INSERT INTO twitter_accounts (username, consumer_key, consumer_secret, access_token, access_token_secret, post_flag) VALUES (?, ?, ?, ?, ?, 1)",
+                         (f'bench{i}', 'bench-key', 'bench-secret', f'bench-token-{i}', 'bench-token-secret'))
+        conn.commit()
+    finally:
+        conn.close()
+    return video_ids
+
+def point_app_at(appmod, base_url, args):
+    appmod.MEDIA_ENDPOINT_URL = base_url + '/1.1/media/upload.json'
+    appmod.POST_TWEET_URL = base_url + '/2/tweets'
+    appmod.USERS_ME_URL = base_url + '/2/users/me'
+    appmod.ACCOUNT_MIN_SPACING_SECS = args.account_spacing
+    appmod.ASYNC_POSTING = args.engine == 'async'
+
+def run_video_tweet_phase(appmod, args):
+    # 変換済みの動画を各アカウントから直接アップロードし、アップロード経路だけを計測する
+    conn = appmod.get_read_db()
+    try:
+        accounts = [appmod.account_to_dict(row) for row in conn.execute("SELECT * FROM twitter_accounts WHERE post_flag = 1").fetchall()]
+        videos = conn.execute("SELECT id, filename, caption FROM videos ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+    prepared = []
+    for video_id, filename, caption in videos:
+        path = os.path.join(appmod.app.config['UPLOAD_FOLDER'], filename)
+        processed_path, processing_method = appmod.prepare_processed_video(path, None, None)
+        prepared.append((processed_path, caption))
+
+    def post_steps(account, processed_path, caption):
+        # スレッドでもイベントループでも同じ手順で投稿する
+        account_client = appmod.account_client_registry.get(account)
+        video_tweet = appmod.VideoTweet(processed_path, account_client.oauth, session=account_client.session,
+                                        account_id=account_client.account_id)
+        processing = yield from video_tweet.upload_steps()
+        if processing is None or not (yield appmod.WaitStep(processing)):
+            return False, video_tweet.total_bytes
+        return (yield from video_tweet.tweet_steps(account_client, caption)) is not None, video_tweet.total_bytes
+
+    started_at = time.perf_counter()
+    if args.engine == 'async':
+        engine = appmod.async_posting_engine
+        futures = [engine.submit(engine.run_steps(post_steps(account, processed_path, caption)))
+                   for processed_path, caption in prepared for account in accounts]
+        results = [future.result() for future in futures]
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, args.accounts)) as executor:
+            futures = [executor.submit(appmod.run_steps, post_steps(account, processed_path, caption))
+                       for processed_path, caption in prepared for account in accounts]
+            results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started_at
+
+    for processed_path, caption in prepared:
+        if appmod.processed_video_cache.is_cached_path(processed_path):
+            appmod.processed_video_cache.release(processed_path)
+
+    return {
+        'attempted': len(results),
+        'succeeded': sum(1 for success, size in results if success),
+        'elapsed': elapsed,
+        'uploaded_bytes': sum(size for success, size in results)
+    }
+
+def run_post_tweet_phase(appmod, api, args):
+    # 投稿内容の選択・変換・アップロード・ツイート作成までを本番と同じ経路で実行する
+    before = api.media_tweet_count()
+    started_at = time.perf_counter()
+    for _ in range(args.rounds):
+        appmod.post_tweet(shared_media=args.shared_media)
+    elapsed = time.perf_counter() - started_at
+    return {
+        'attempted': args.accounts * args.rounds,
+        'succeeded': api.media_tweet_count() - before,
+        'elapsed': elapsed
+    }
+
+def run_benchmark(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='xpost-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    if not args.workdir and not args.keep:
+        # appの終了処理（ログの書き出しなど）より後に消すため、インポートより前に登録する
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    # appはインポート時にカレントディレクトリにDBやアップロード先を作るため、作業用ディレクトリに移ってから読み込む
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as appmod
+    import logging
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        appmod.app.logger.setLevel(logging.WARNING)
+
+    api = FakeTwitterAPI(latency=args.latency_ms / 1000, bandwidth=args.bandwidth_mbps * 1000 * 1000 / 8 if args.bandwidth_mbps else None,
+                         error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                         processing_secs=args.processing_secs, seed=args.seed,
+                         rate_limit=args.rate_limit, rate_limit_window=args.rate_limit_window)
+    base_url = api.start()
+    point_app_at(appmod, base_url, args)
+    appmod.start_background_services()
+    recorder = StageRecorder(appmod.metrics)
+
+    try:
+        setup_data(appmod, args)
+        phases = {}
+        if args.mode in ('all', 'video_tweet'):
+            recorder.phase = 'video_tweet'
+            phases['video_tweet'] = run_video_tweet_phase(appmod, args)
+        if args.mode in ('all', 'post_tweet'):
+            recorder.phase = 'post_tweet'
+            phases['post_tweet'] = run_post_tweet_phase(appmod, api, args)
+        recorder.phase = None
+
+        for name, phase in phases.items():
+            phase['elapsed'] = round(phase['elapsed'], 3)
+            phase['posts_per_minute'] = round(phase['succeeded'] * 60 / phase['elapsed'], 2) if phase['elapsed'] else 0.0
+            if 'uploaded_bytes' in phase:
+                phase['upload_mb_per_sec'] = round(phase['uploaded_bytes'] / 1024 / 1024 / phase['elapsed'], 2) if phase['elapsed'] else 0.0
+            phase['stages'] = recorder.summary(name)
+        return {
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'workdir', 'verbose')},
+            'phases': phases,
+            'server': api.stats(),
+            'peak_rss_mb': peak_rss_mb()
+        }
+    finally:
+        api.stop()
+
+def find_regressions(result, baseline, tolerance):
+    regressions = []
+    for name, phase in result['phases'].items():
+        base_phase = baseline.get('phases', {}).get(name)
+        if not base_phase:
+            continue
+        if phase['posts_per_minute'] < base_phase['posts_per_minute'] * (1 - tolerance):
+            regressions.append(f"{name}: スループット {base_phase['posts_per_minute']} -> {phase['posts_per_minute']} 件/分")
+        for stage, stats in phase['stages'].items():
+            base_stats = base_phase.get('stages', {}).get(stage)
+            if base_stats and stats['p99'] > base_stats['p99'] * (1 + tolerance) + REGRESSION_MIN_SLACK_SECS:
+                regressions.append(f"{name}/{stage}: p99 {base_stats['p99']} -> {stats['p99']} 秒")
+    return regressions
+
+def print_report(result):
+    for name, phase in result['phases'].items():
+        print(f"== {name} ==")
+        print(f"  成功 {phase['succeeded']}/{phase['attempted']}件, {phase['elapsed']}秒, {phase['posts_per_minute']} 件/分"
+              + (f", {phase['upload_mb_per_sec']} MB/秒" if 'upload_mb_per_sec' in phase else ''))
+        print(f"  {'段階':<18}{'件数':>6}{'p50(秒)':>10}{'p99(秒)':>10}{'最大(秒)':>10}")
+        for stage, stats in sorted(phase['stages'].items()):
+            print(f"  {stage:<18}{stats['count']:>6}{stats['p50']:>10}{stats['p99']:>10}{stats['max']:>10}")
+    server = result['server']
+    print("== server ==")
+    print(f"  受信 {server['bytes_in']}バイト, 送信 {server['bytes_out']}バイト, リクエスト {server['requests']}, 注入したエラー {server['injected']}")
+    print(f"  最大RSS: 本体 {result['peak_rss_mb']['self']}MB, 子プロセス {result['peak_rss_mb']['children']}MB")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='ローカルのダミーAPIに対して投稿処理のベンチマークを実行します')
+    parser.add_argument('--accounts', type=int, default=3, help='投稿するアカウント数')
+    parser.add_argument('--videos', type=int, default=2, help='生成する動画の本数')
+    parser.add_argument('--video-seconds', type=float, default=8, help='生成する動画の長さ（秒）')
+    parser.add_argument('--video-size', default='640x360', help='生成する動画の解像度')
+    parser.add_argument('--mode', choices=['all', 'video_tweet', 'post_tweet'], default='all')
+    parser.add_argument('--rounds', type=int, default=1, help='post_tweetを実行する回数')
+    parser.add_argument('--shared-media', action='store_true', help='post_tweetをメディア共有モードで実行する')
+    parser.add_argument('--engine', choices=['async', 'thread'], default='thread',
+                        help='アップロードとツイート作成をイベントループで行うか、スレッドで行うか（アプリのASYNC_POSTINGに相当）')
+    parser.add_argument('--account-spacing', type=int, default=0, help='同じアカウントで投稿を始める最小間隔（秒）')
+    parser.add_argument('--latency-ms', type=float, default=20, help='ダミーAPIの応答遅延（ミリ秒）')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='接続ごとの受信帯域（Mbps、0なら無制限）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='503を返す割合')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='429を返す割合')
+    parser.add_argument('--rate-limit', type=int, default=None, help='アクセストークン・エンドポイントごとのウィンドウ内の上限回数')
+    parser.add_argument('--rate-limit-window', type=int, default=15 * 60, help='レート制限のウィンドウ（秒）')
+    parser.add_argument('--processing-secs', type=float, default=2, help='FINALIZE後にメディア処理が終わるまでの時間（秒）')
+    parser.add_argument('--seed', type=int, default=None, help='エラー注入に使う乱数のシード')
+    parser.add_argument('--workdir', default=None, help='DBや動画を置く作業用ディレクトリ（省略時は一時ディレクトリ）')
+    parser.add_argument('--keep', action='store_true', help='一時ディレクトリを削除せずに残す')
+    parser.add_argument('--output', default=None, help='結果をJSONで保存するパス')
+    parser.add_argument('--baseline', default=None, help='比較する過去の結果（JSON）')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='劣化とみなす割合')
+    parser.add_argument('--verbose', action='store_true', help='アプリのログを出力する')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    result = run_benchmark(args)
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if baseline is not None:
+        regressions = find_regressions(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"劣化: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,16 +8,27 @@ document.addEventListener('DOMContentLoaded', function() {
     const startAutoPostButton = document.getElementById('startAutoPost');
     const stopAutoPostButton = document.getElementById('stopAutoPost');
     const postIntervalInput = document.getElementById('postInterval');
+    const sharedMediaCheckbox = document.getElementById('sharedMedia');
     const currentStatusElement = document.getElementById('currentStatus');
     const autoPostStatusElement = document.getElementById('autoPostStatus');
     const recentActivitiesElement = document.getElementById('recentActivities');
+    const accountProgressElement = document.getElementById('accountProgress');
     const toggleThemeButton = document.getElementById('toggleTheme');
 
     let autoPostingActive = false;
+    let autoPostInterval = null;
+    let nextPostTime = null;
+    let recentActivities = [];
+    let accountProgress = {};
+    // 最後に反映した状態の連番（nullなら全体を取得する）
+    let lastSeq = null;
+    const RECENT_ACTIVITIES_LIMIT = 10;
 
     socket.on('connect', function() {
         console.log('Socket.IOに接続しました');
         updateStatus('サーバーに接続しました');
+        // 再接続時は受け取り済みの連番以降の差分だけを要求する
+        requestAppStatus();
     });
 
     socket.on('disconnect', function() {
@@ -27,7 +38,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
     postTweetButton.addEventListener('click', function() {
         console.log('ツイート投稿ボタンがクリックされました');
-        socket.emit('post_tweet');
+        socket.emit('post_tweet', { shared_media: sharedMediaCheckbox.checked });
         updateStatus('ツイートを投稿中...');
     });
 
@@ -35,7 +46,7 @@ document.addEventListener('DOMContentLoaded', function() {
         const interval = parseInt(postIntervalInput.value);
         if (interval > 0) {
             console.log('自動投稿を開始します。間隔:', interval, '分');
-            socket.emit('start_auto_posting', { interval: interval });
+            socket.emit('start_auto_posting', { interval: interval, shared_media: sharedMediaCheckbox.checked });
             updateStatus('自動投稿を開始しています...');
             autoPostingActive = true;
             updateAutoPostStatus();
@@ -58,9 +69,12 @@ document.addEventListener('DOMContentLoaded', function() {
         updateStatus(data.message);
     });
 
-    socket.on('status_update', function(data) {
-        console.log('ステータス更新を受信:', data);
-        updateStatus(data.status);
+    socket.on('status_delta', function(delta) {
+        applyDelta(delta);
+    });
+
+    socket.on('status_deltas', function(data) {
+        data.deltas.forEach(applyDelta);
     });
 
     socket.on('app_status', function(data) {
@@ -76,17 +90,60 @@ document.addEventListener('DOMContentLoaded', function() {
         currentStatusElement.textContent = `現在の状態: ${message}`;
     }
 
+    function requestAppStatus() {
+        socket.emit('get_app_status', lastSeq === null ? {} : { since: lastSeq });
+    }
+
     function updateAppStatus(data) {
+        lastSeq = data.seq;
         updateStatus(data.current_status);
         autoPostingActive = data.auto_posting_active;
-        updateAutoPostStatus(data.auto_posting_interval, data.next_post_time);
-        updateRecentActivities(data.recent_activities);
+        autoPostInterval = data.auto_posting_interval;
+        nextPostTime = data.next_post_time;
+        updateAutoPostStatus();
+        recentActivities = data.recent_activities;
+        updateRecentActivities();
+        accountProgress = {};
+        data.accounts.forEach(progress => {
+            accountProgress[progress.account] = progress;
+        });
+        updateAccountProgress();
+    }
+
+    function applyDelta(delta) {
+        if (lastSeq === null || delta.seq <= lastSeq) {
+            return;
+        }
+        if (delta.seq !== lastSeq + 1) {
+            // 取りこぼしがあれば不足分を取り直す
+            requestAppStatus();
+            return;
+        }
+        lastSeq = delta.seq;
+        if ('current_status' in delta) {
+            updateStatus(delta.current_status);
+        }
+        if (delta.auto_posting) {
+            autoPostingActive = delta.auto_posting.active;
+            autoPostInterval = delta.auto_posting.interval;
+            nextPostTime = delta.auto_posting.next_post_time;
+            updateAutoPostStatus();
+        }
+        if (delta.activity) {
+            recentActivities = [delta.activity].concat(recentActivities).slice(0, RECENT_ACTIVITIES_LIMIT);
+            updateRecentActivities();
+        }
+        if (delta.account_progress) {
+            accountProgress[delta.account_progress.account] = delta.account_progress;
+            updateAccountProgress();
+        }
     }
 
-    function updateAutoPostStatus(interval, nextPostTime) {
+    function updateAutoPostStatus() {
         if (autoPostingActive) {
             const nextPostTimeStr = nextPostTime ? formatDateTime(nextPostTime) : '計算中...';
-            autoPostStatusElement.textContent = `自動投稿中 (間隔: ${interval}分, 次の投稿: ${nextPostTimeStr})`;
+            const intervalStr = autoPostInterval ? autoPostInterval : parseInt(postIntervalInput.value);
+            autoPostStatusElement.textContent = `自動投稿中 (間隔: ${intervalStr}分, 次の投稿: ${nextPostTimeStr})`;
             startAutoPostButton.disabled = true;
             stopAutoPostButton.disabled = false;
         } else {
@@ -96,15 +153,36 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    function updateRecentActivities(activities) {
+    function updateRecentActivities() {
         recentActivitiesElement.innerHTML = '';
-        activities.forEach(activity => {
+        recentActivities.forEach(activity => {
             const li = document.createElement('li');
             li.textContent = `${formatDateTime(activity.timestamp)} - ${activity.account}: ${activity.action} (${activity.result})`;
             recentActivitiesElement.appendChild(li);
         });
     }
 
+    function accountStageLabel(stage) {
+        const labels = {
+            preparing: '動画準備中',
+            uploading: 'アップロード中',
+            processing: 'メディア処理待ち',
+            tweeting: 'ツイート中',
+            succeeded: '投稿成功',
+            failed: '投稿失敗'
+        };
+        return labels[stage] || stage;
+    }
+
+    function updateAccountProgress() {
+        accountProgressElement.innerHTML = '';
+        Object.values(accountProgress).forEach(progress => {
+            const li = document.createElement('li');
+            li.textContent = `${progress.account}: ${accountStageLabel(progress.stage)} (${formatDateTime(progress.updated_at)})`;
+            accountProgressElement.appendChild(li);
+        });
+    }
+
     function formatDateTime(isoString) {
         if (!isoString) return 'N/A';
         const date = new Date(isoString);
@@ -122,7 +200,4 @@ document.addEventListener('DOMContentLoaded', function() {
             icon.classList.add('fa-moon');
         }
     });
-
-    // 初期状態を取得
-    socket.emit('get_app_status');
 });
\ No newline at end of file
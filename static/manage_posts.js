@@ -4,6 +4,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const postsTable = document.getElementById('postsTable').getElementsByTagName('tbody')[0];
     const editModal = document.getElementById('editModal');
     const closeModalBtn = document.getElementsByClassName('close')[0];
+    const loadMorePostsBtn = document.getElementById('loadMorePosts');
+    const POSTS_PAGE_SIZE = 100;
+    let nextPostsCursor = null;
 
     function timeToSeconds(timeString) {
         if (!timeString) return '';
@@ -18,20 +21,43 @@ document.addEventListener('DOMContentLoaded', function() {
         return `${minutes}:${remainingSeconds.toString().padStart(2, '0')}`;
     }
 
-    // 投稿一覧を取得して表示
-    function fetchPosts() {
-        fetch('/api/posts')
-            .then(response => response.json())
+    function processingStatusLabel(status) {
+        const labels = {
+            pending: '変換待ち',
+            processing: '変換中',
+            ready: '準備完了',
+            failed: '変換失敗'
+        };
+        return labels[status] || '';
+    }
+
+    // 投稿一覧を1ページずつ取得して表示（cursorがなければ先頭から表示し直す）
+    function fetchPosts(cursor) {
+        let url = `/api/posts?limit=${POSTS_PAGE_SIZE}`;
+        if (cursor) {
+            url += `&after=${cursor}`;
+        }
+        fetch(url)
+            .then(response => {
+                nextPostsCursor = response.headers.get('X-Next-Cursor');
+                loadMorePostsBtn.style.display = nextPostsCursor ? 'inline-block' : 'none';
+                return response.json();
+            })
             .then(posts => {
-                postsTable.innerHTML = '';
+                if (!cursor) {
+                    postsTable.innerHTML = '';
+                }
                 posts.forEach(post => {
                     const row = postsTable.insertRow();
                     row.innerHTML = `
-                        <td>${post.filename}</td>
+                        <td>${post.original_filename || post.filename}</td>
                         <td>${post.caption}</td>
                         <td>${post.reply_content}</td>
                         <td>${secondsToTime(post.start_time)}</td>
                         <td>${secondsToTime(post.end_time)}</td>
+                        <td>${post.duration ? secondsToTime(Math.round(post.duration)) : ''}</td>
+                        <td>${processingStatusLabel(post.processing_status)}</td>
+                        <td>${post.weight}</td>
                         <td>
                             <button onclick="editPost(${post.id})">編集</button>
                             <button onclick="deletePost(${post.id})">削除</button>
@@ -54,6 +80,10 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .then(response => response.json())
         .then(data => {
+            if (data.error) {
+                alert(data.error);
+                return;
+            }
             console.log('投稿が追加されました:', data);
             fetchPosts();
             addPostForm.reset();
@@ -71,6 +101,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 document.getElementById('editReplyContent').value = post.reply_content;
                 document.getElementById('editStartTime').value = secondsToTime(post.start_time);
                 document.getElementById('editEndTime').value = secondsToTime(post.end_time);
+                document.getElementById('editWeight').value = post.weight;
                 editModal.style.display = 'block';
             })
             .catch(error => console.error('Error:', error));
@@ -88,6 +119,10 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .then(response => response.json())
         .then(data => {
+            if (data.error) {
+                alert(data.error);
+                return;
+            }
             console.log('投稿が更新されました:', data);
             fetchPosts();
             editModal.style.display = 'none';
@@ -110,6 +145,10 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    loadMorePostsBtn.addEventListener('click', function() {
+        fetchPosts(nextPostsCursor);
+    });
+
     // モーダルを閉じる
     closeModalBtn.onclick = function() {
         editModal.style.display = 'none';
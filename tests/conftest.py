@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# appはインポート時にカレントディレクトリへvideos.dbやuploadsを作るため、一時ディレクトリで読み込む
+os.environ.setdefault('ACTIVITY_LOG_SYNC', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix='xpost-test-'))
@@ -0,0 +1,33 @@
+import app
+
+
+def read_activities(account):
+    conn = app.get_read_db()
+    try:
+        return conn.execute("SELECT account, action, result FROM activity_log WHERE account = ? ORDER BY id", (account,)).fetchall()
+    finally:
+        conn.close()
+
+
+def test_synchronous_writer_inserts_inline():
+    writer = app.ActivityLogWriter(app.ACTIVITY_LOG_BATCH_SIZE, app.ACTIVITY_LOG_FLUSH_SECS, app.ACTIVITY_LOG_QUEUE_SIZE,
+                                   synchronous=True)
+    writer.write('sync-writer', 'テスト', '成功')
+    writer.write('sync-writer', 'テスト', '失敗')
+    # 書き込みスレッドを起動せず、呼び出しから戻った時点で読める
+    assert writer.thread is None
+    assert writer.flush(timeout=0)
+    assert read_activities('sync-writer') == [('sync-writer', 'テスト', '成功'), ('sync-writer', 'テスト', '失敗')]
+
+
+def test_log_activity_uses_env_switch():
+    assert app.ACTIVITY_LOG_SYNC
+    app.log_activity('sync-env', 'ツイート投稿', '成功')
+    assert read_activities('sync-env') == [('sync-env', 'ツイート投稿', '成功')]
+
+
+def test_buffered_writer_flushes_in_background():
+    writer = app.ActivityLogWriter(app.ACTIVITY_LOG_BATCH_SIZE, app.ACTIVITY_LOG_FLUSH_SECS, app.ACTIVITY_LOG_QUEUE_SIZE)
+    writer.write('buffered-writer', 'テスト', '成功')
+    assert writer.flush(timeout=10)
+    assert read_activities('buffered-writer') == [('buffered-writer', 'テスト', '成功')]